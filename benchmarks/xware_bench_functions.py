@@ -0,0 +1,234 @@
+# Micro-benchmarks of the per-sample helpers (xware_lib_functions.py, and
+# lastUrlItem and DiscoveryListing in xware_lib_om2m.py)
+# See Github repo (github.com/d-sanchezl/xware) for license details
+
+# Each case runs a helper over a realistic input: a buffer of 6000 samples of
+# 3 sensors (6 s at 1 kHz), or an OM2M URI list of 1000 entries. The best of
+# several repeats is reported, both per call and per input.
+
+# csvFormatter formats the same 18000 CSV lines as preciseUnixTime plus
+# csvFormatLine do, in bulk (CsvFormatter), so their per-call times compare
+# directly.
+
+# The script also runs on libraries that predate some helpers (to store a
+# baseline of older code): csvFormatter then runs preciseUnixTime plus
+# csvFormatLine, discoveryListing runs lastUrlItem over the whole listing, and
+# writeCsvPassThrough runs writeCsvBuffer with the conversion, i.e. the work
+# those helpers replaced. benchmarks/baselines/reference.json was stored this
+# way from the code before they were optimised (commit [user-037]).
+
+# Results can be stored as a named baseline (benchmarks/baselines/[name].json)
+# and later runs compared against it, so that optimisations and regressions of
+# these helpers show up as numbers. Baselines depend on the machine and Python
+# version they were made on; compare runs from the same box.
+
+# Run from the repository root:
+#  python benchmarks/xware_bench_functions.py                    (print results)
+#  python benchmarks/xware_bench_functions.py --save reference   (store a baseline)
+#  python benchmarks/xware_bench_functions.py --compare reference
+#  python benchmarks/xware_bench_functions.py --compare reference --fail 0.2
+
+# Import necessary packages
+import argparse
+import platform
+import timeit
+import json
+import time
+import sys
+import io
+import os
+
+# Import xware libraries
+benchDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchDir, '..', 'libraries'))
+from xware_lib_functions import *
+from xware_lib_om2m import lastUrlItem
+try:
+    from xware_lib_om2m import DiscoveryListing
+except ImportError:
+    DiscoveryListing = None
+
+baselineLocation = os.path.join(benchDir, 'baselines')
+
+
+# ===========================================
+# Realistic inputs
+
+rows = 6000
+sensorTagList = ['x_accel', 'y_accel', 'z_accel']
+startTime = 1700000000.123456
+deltaTime = 0.001
+valueLines = ['%.5f,%.5f,%.5f' % (2.99808 + i*1e-5, -11.24914, -0.77331 + i*1e-5) for i in range(rows)]
+timedLines = ['%.6f\t%.5f\n' % (i*deltaTime, 2.99808 + i*1e-5) for i in range(rows)]
+relativeTimes = [i*deltaTime for i in range(rows)]
+unixTimes = [startTime + t for t in relativeTimes]
+unixTimeStrings = [preciseUnixTime(startTime,0,t,6,string=1) for t in relativeTimes]
+valueRows = [[float(value)/0.00989 for value in line.split(',')] for line in valueLines]
+uril = ['/in-cse/in-name/induction_motor_1/sampling/cin_' + str(1000000 + i) for i in range(1000)]
+
+
+# ===========================================
+# Benchmark cases: (name, calls per input, function running over one input)
+
+def runPreciseUnixTime():
+    for t in relativeTimes:
+        preciseUnixTime(startTime,0,t,6,string=1)
+
+def runCsvFormatLine():
+    for timeUnix, line in zip(unixTimeStrings, valueLines):
+        for sensorTag, value in zip(sensorTagList, line.split(',')):
+            csvFormatLine(timeUnix,'induction_motor',sensorTag,value,5)
+
+def runUnixToDateString():
+    for unixTime in unixTimes:
+        unixToDateString(unixTime,precision=6)
+
+def runSeparateStringFinder():
+    for line in valueLines:
+        separateStringFinder(line,',')
+
+def runCsvFormatter():
+    CsvFormatter(6,5).lines(startTime,relativeTimes,'induction_motor',sensorTagList,valueRows)
+
+def runCsvFormatterPerLine():
+    for t, row in zip(relativeTimes, valueRows):
+        timeUnix = preciseUnixTime(startTime,0,t,6,string=1)
+        for sensorTag, value in zip(sensorTagList, row):
+            csvFormatLine(timeUnix,'induction_motor',sensorTag,value,5)
+
+if not('CsvFormatter' in globals()):
+    runCsvFormatter = runCsvFormatterPerLine
+
+def runValueFromString():
+    for line in timedLines:
+        valueFromString(line)
+
+def runLastUrlItem():
+    lastUrlItem(uril)
+
+# A poll of a container whose messages were all seen before
+def runDiscoveryListing():
+    listing.update(uril)
+
+if DiscoveryListing is None:
+    runDiscoveryListing = runLastUrlItem
+else:
+    listing = DiscoveryListing()
+    listing.update(uril)
+
+def runWriteCsvBuffer():
+    writeCsvBuffer(io.StringIO(),valueLines,startTime,0,deltaTime,'induction_motor',sensorTagList,1/0.00989,6,5)
+
+# Values that need no conversion and already have 5 decimals
+def runWriteCsvBufferPassThrough():
+    writeCsvBuffer(io.StringIO(),valueLines,startTime,0,deltaTime,'induction_motor',sensorTagList,1,6,5,passThrough=1)
+
+if not('passThrough' in writeCsvBuffer.__code__.co_varnames):
+    def runWriteCsvBufferPassThrough():
+        writeCsvBuffer(io.StringIO(),valueLines,startTime,0,deltaTime,'induction_motor',sensorTagList,1,6,5)
+
+cases = [
+    ('preciseUnixTime', rows, runPreciseUnixTime),
+    ('csvFormatLine', rows*len(sensorTagList), runCsvFormatLine),
+    ('csvFormatter', rows*len(sensorTagList), runCsvFormatter),
+    ('unixToDateString', rows, runUnixToDateString),
+    ('separateStringFinder', rows, runSeparateStringFinder),
+    ('valueFromString', rows, runValueFromString),
+    ('lastUrlItem', len(uril), runLastUrlItem),
+    ('discoveryListing', len(uril), runDiscoveryListing),
+    ('writeCsvBuffer', rows, runWriteCsvBuffer),
+    ('writeCsvPassThrough', rows, runWriteCsvBufferPassThrough),
+    ]
+
+
+# ===========================================
+# Run every case; returns {name: seconds per input}
+
+def runCases(repeat=5,selected=None):
+    results = {}
+    for name, calls, function in cases:
+        if selected and not(name in selected):
+            continue
+        # Calibrate the number of runs to about 0.2 s per repeat
+        number, seconds = timeit.Timer(function).autorange()
+        number = max(int(number*0.2/max(seconds, 1e-9)), 1)
+        results[name] = min(timeit.repeat(function, number=number, repeat=repeat))/number
+    return results
+
+
+# ===========================================
+# Store and load baselines
+
+def saveBaseline(name,results):
+    if not(os.path.isdir(baselineLocation)):
+        os.mkdir(baselineLocation)
+    baseline = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'machine': platform.machine() + ' ' + platform.processor(),
+                'secondsPerInput': results}
+    with open(os.path.join(baselineLocation, name + '.json'), 'w') as file:
+        json.dump(baseline, file, indent=1, sort_keys=True)
+        file.write('\n')
+
+def loadBaseline(name):
+    with open(os.path.join(baselineLocation, name + '.json'), 'r') as file:
+        return json.load(file)
+
+
+# ===========================================
+# Print results, and their change against a baseline (if given)
+# Returns the names of the cases that are slower than the baseline by more
+# than 'threshold' (a fraction, e.g. 0.1 for 10%)
+
+def printReport(results,baseline=None,threshold=0.1):
+    callsByName = dict([(name, calls) for name, calls, function in cases])
+    header = 'case'.ljust(22) + 'per input'.rjust(12) + 'per call'.rjust(12)
+    if baseline is not None:
+        header += 'baseline'.rjust(12) + 'change'.rjust(10)
+    print(header)
+    regressions = []
+    for name, seconds in results.items():
+        line = name.ljust(22) + format(seconds*1e3, '9.2f') + ' ms' + format(seconds/callsByName[name]*1e6, '9.3f') + ' us'
+        if baseline is not None and name in baseline['secondsPerInput']:
+            reference = baseline['secondsPerInput'][name]
+            change = seconds/reference - 1
+            line += format(reference*1e3, '9.2f') + ' ms' + format(change*100, '+9.1f') + '%'
+            if change > threshold:
+                line += '  SLOWER'
+                regressions.append(name)
+            elif change < -threshold:
+                line += '  faster'
+        print(line)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the XWare per-sample helpers')
+    parser.add_argument('--save', default='', help='store the results as this baseline')
+    parser.add_argument('--compare', default='', help='compare the results with this baseline')
+    parser.add_argument('--threshold', type=float, default=0.1, help='change reported as slower/faster (fraction)')
+    parser.add_argument('--fail', type=float, default=0, help='exit with an error if a case is slower by more than this fraction')
+    parser.add_argument('--repeat', type=int, default=5, help='repeats of each case (the best one is kept)')
+    parser.add_argument('cases', nargs='*', help='only run these cases')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        baseline = loadBaseline(args.compare)
+        print('Baseline ' + args.compare + ': ' + baseline['created'] + ', Python ' + baseline['python'] + ', ' + baseline['machine'])
+    print('Python ' + platform.python_version() + ', ' + platform.machine() + ' ' + platform.processor())
+    print('')
+
+    results = runCases(args.repeat, args.cases)
+    printReport(results, baseline, args.threshold)
+    if args.save:
+        saveBaseline(args.save, results)
+        print('')
+        print('Baseline saved: ' + os.path.join(baselineLocation, args.save + '.json'))
+    if baseline is not None and args.fail:
+        failed = [name for name in results
+                  if name in baseline['secondsPerInput'] and results[name]/baseline['secondsPerInput'][name] - 1 > args.fail]
+        if failed:
+            print('')
+            print('Regressions over ' + format(args.fail*100, 'g') + '%: ' + ', '.join(failed))
+            sys.exit(1)
@@ -0,0 +1,59 @@
+# Micro-benchmarks of the OM2M payload codec (xware_lib_om2m.py)
+# See Github repo (github.com/d-sanchezl/xware) for license details
+
+# Measures building a create-message payload around a ~60 KB sample buffer,
+# and parsing an OM2M response of the same size. The string concatenation
+# builder that XWare used before the codec is kept here as a reference.
+
+# Run from the repository root:
+#  python benchmarks/xware_bench_payloads.py
+
+# Import necessary packages
+import os
+import sys
+import json
+import timeit
+
+# Import xware libraries
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'libraries'))
+from xware_lib_om2m import *
+
+# ===========================================
+# Reference: payload built by string concatenation (no escaping)
+
+def concatenatedMessagePayload(fr,to,rqi,message):
+    pc = '''{"m2m:cin": {"cnf": "message", "con": "'''+message+'''"}}'''
+    payload = '''{
+"m2m:rqp": {
+"m2m:fr" : "'''+fr+'''",
+"m2m:to" : "'''+to+'''",
+"m2m:op" : "'''+'1'+'''",
+"m2m:rqi": "'''+rqi+'''",
+"m2m:pc" : '''+pc+''',
+"m2m:ty" : "'''+'4'+'''"}}'''
+    return payload
+
+
+# ===========================================
+# Run one benchmark and print its time per call
+
+def bench(name,function,number=200):
+    seconds = min(timeit.repeat(function, number=number, repeat=5))/number
+    print(name.ljust(44) + format(seconds*1e6, '10.1f') + ' us')
+    return seconds
+
+
+if __name__ == '__main__':
+    # Sample buffer of 2300 samples x 3 sensors (~60 KB)
+    line = '2.99808,-11.24914,-0.77331\n'
+    buffer = line*2300
+    to = '/in-cse/in-name/induction_motor/sampling'
+    print('Buffer size: ' + str(len(buffer)) + ' bytes, JSON library: ' + jsonLoads.__module__)
+    print('')
+
+    bench('build payload (string concatenation)', lambda: concatenatedMessagePayload('admin:admin',to,'123456',buffer))
+    bench('build payload (codec)', lambda: createMessagePayload('admin:admin',to,'123456',buffer))
+
+    response = jsonDumps({'m2m:rsp': {'m2m:rsc': 2000, 'm2m:rqi': '1', 'm2m:pc': {'m2m:cin': {'rn': 'cin_1', 'con': buffer}}}})
+    bench('parse response twice (json.loads x2)', lambda: (json.loads(response), json.loads(response)))
+    bench('parse response once (codec)', lambda: jsonLoads(response))
@@ -0,0 +1,227 @@
+# End-to-end throughput benchmark of XWare, fully offline
+# See Github repo (github.com/d-sanchezl/xware) for license details
+
+# Runs N simulated gateways (examples/xware_simulated_gateway.py, replaying
+# examples/simulated_input.txt) and the Server (clients/xware_server.py)
+# against the in-process OM2M and MQTT stand-ins of xware_fake_om2m.py, and
+# reports for each configuration:
+
+# * samples/s: samples written to CSV files per second of run time
+# * latency: time from the end of a sampling to its CSV file being complete
+#   (p50, p95 and p99, from the Server's timer log)
+# * CPU time and peak memory (RSS) of the whole process (gateways, Server,
+#   broker and CSE)
+# * OM2M requests (and seconds the CSE spent serving them) and MQTT
+#   messages/bytes
+
+# Each configuration (data plane x ingestion mode) runs in its own process, so
+# results do not leak into each other. The scripts run unchanged; only their
+# top-level parameters are replaced.
+
+# Run from the repository root, e.g.:
+#  python benchmarks/xware_bench_throughput.py --gateways 8 --duration 20
+#  python benchmarks/xware_bench_throughput.py --planes om2m,mqtt --ingestion mqtt --chunk 200 --output results.json
+#  python benchmarks/xware_bench_throughput.py --planes mqtt --ingestion mqtt --F 10000 --speed 10
+
+# Linux only (uses the resource module)
+
+# Import necessary packages
+import argparse
+import subprocess
+import resource
+import tempfile
+import shutil
+import json
+import time
+import sys
+import os
+
+# Paths
+benchDir = os.path.dirname(os.path.abspath(__file__))
+repoDir = os.path.dirname(benchDir)
+serverScript = os.path.join(repoDir, 'clients', 'xware_server.py')
+gatewayScript = os.path.join(repoDir, 'examples', 'xware_simulated_gateway.py')
+inputFile = os.path.join(repoDir, 'examples', 'simulated_input.txt')
+sys.path[:0] = [benchDir, os.path.join(repoDir, 'libraries')]
+
+
+# ===========================================
+# Run one configuration (in this process) and return its results
+
+# args: parsed command line arguments
+# plane: data plane, 'om2m' or 'mqtt'
+# ingestion: Server ingestion mode, 'poll' or 'mqtt'
+
+def runConfiguration(args,plane,ingestion):
+    # The fake broker must be installed before any XWare module imports paho
+    from xware_fake_om2m import FakeBroker, FakeCSE, installFakeMQTT, runScript
+    broker = FakeBroker()
+    installFakeMQTT(broker)
+    cse = FakeCSE(broker=broker)
+    ipOM2M = cse.startHTTP()
+    from xware_lib_scheduler import percentile
+
+    workDir = tempfile.mkdtemp(prefix='xware_bench_')
+    samplesDir = os.path.join(workDir, 'input')
+    os.mkdir(samplesDir)
+    shutil.copy(inputFile, samplesDir)
+    silent = {'input': lambda prompt='': ''}
+
+    # Keep the scripts' progress messages out of the report
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        # Server
+        server, serverGlobals = runScript(serverScript, {
+            'csvLocation': os.path.join(workDir, 'csv'),
+            'logLocation': os.path.join(workDir, 'logs'),
+            'summaryLocation': os.path.join(workDir, 'summary'),
+            'ipOM2M': ipOM2M,
+            'dataPlane': plane,
+            'ingestionMode': ingestion,
+            }, 'server', silent)
+        while serverGlobals.get('starting', 1) and server.is_alive():
+            time.sleep(0.01)
+
+        # Gateways
+        cpuStart = resource.getrusage(resource.RUSAGE_SELF)
+        startTime = time.time()
+        gateways = []
+        for i in range(args.gateways):
+            gateways.append(runScript(gatewayScript, {
+                'deviceTag': 'bench_gateway_' + str(i+1),
+                'F': args.F, 't': args.t, 'T': args.T,
+                'samplesLocation': samplesDir,
+                'queueLocation': os.path.join(workDir, 'queue_' + str(i+1)) if args.queue else '',
+                'queueDrainTime': args.drainTime,
+                'cycleLogLocation': os.path.join(workDir, 'logs', 'cycles_' + str(i+1) + '.log'),
+                'dataPlane': plane,
+                'schedulerMode': args.scheduler,
+                'chunkSize': args.chunk,
+                'acquisitionMode': 'block' if args.speed else 'string',
+                'blockPacing': 0 if args.speed else 1,
+                'replaySpeed': args.speed or 1,
+                }, 'gateway_' + str(i+1), silent))
+        time.sleep(args.duration)
+
+        # Stop sampling (with --queue, each gateway delivers its queue before
+        # stopping), then wait for the Server to write every sampling
+        runtimes = [namespace['runtime'] for thread, namespace in gateways if 'runtime' in namespace]
+        for runtime in runtimes:
+            runtime.stopEvent.set()
+        for thread, namespace in gateways:
+            thread.join()
+        samplings = sum([device.messageIndex for runtime in runtimes for device in runtime.devices])
+        timerLoc = os.path.join(workDir, 'logs', 'timer.txt')
+        deadline = time.time() + args.drainTime
+        while time.time() < deadline:
+            with open(timerLoc, 'r') as file:
+                written = len(file.read().splitlines()) - 1
+            if written >= samplings:
+                break
+            time.sleep(0.05)
+        elapsed = time.time() - startTime
+        cpuEnd = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    # Samples written (one CSV line per sample and sensor)
+    sensors = 3
+    csvLines = 0
+    csvDir = os.path.join(workDir, 'csv')
+    for fileName in os.listdir(csvDir):
+        with open(os.path.join(csvDir, fileName), 'r') as file:
+            csvLines += len(file.read().splitlines()) - 1
+    samples = csvLines//sensors
+
+    # Latency of each sampling: CSV time (from START receipt) minus the time
+    # the sampling takes (t, or less when replayed faster than real time)
+    samplingTime = args.t/(args.speed or 1)
+    latencies = []
+    with open(timerLoc, 'r') as file:
+        for line in file.read().splitlines()[1:]:
+            items = line.split('\t')
+            latencies.append(max(float(items[-1]) - samplingTime, 0))
+    latencies.sort()
+
+    cpuTime = (cpuEnd.ru_utime - cpuStart.ru_utime) + (cpuEnd.ru_stime - cpuStart.ru_stime)
+    shutil.rmtree(workDir, ignore_errors=True)
+    return {
+        'plane': plane,
+        'ingestion': ingestion,
+        'gateways': args.gateways,
+        'samplings': samplings,
+        'written': len(latencies),
+        'samples': samples,
+        'seconds': elapsed,
+        'samplesPerSecond': samples/elapsed,
+        'p50LatencyMs': percentile(latencies, 50)*1e3,
+        'p95LatencyMs': percentile(latencies, 95)*1e3,
+        'p99LatencyMs': percentile(latencies, 99)*1e3,
+        'cpuSeconds': cpuTime,
+        'cpuPercent': 100*cpuTime/elapsed,
+        'maxRssMB': cpuEnd.ru_maxrss/1024,
+        'cseRequests': cse.requests,
+        'cseBusySeconds': cse.busyTime,
+        'brokerMessages': broker.publishedMessages,
+        'brokerMB': broker.publishedBytes/2**20,
+        }
+
+
+# ===========================================
+# Print the results of all configurations as a table
+
+columns = [('plane', 'plane', '%s'), ('ingestion', 'ingest', '%s'),
+           ('written', 'samplings', '%d'), ('samplesPerSecond', 'samples/s', '%.0f'),
+           ('p50LatencyMs', 'p50 ms', '%.1f'), ('p95LatencyMs', 'p95 ms', '%.1f'),
+           ('p99LatencyMs', 'p99 ms', '%.1f'), ('cpuPercent', 'CPU %', '%.0f'),
+           ('maxRssMB', 'RSS MB', '%.1f'), ('cseRequests', 'OM2M req', '%d'),
+           ('cseBusySeconds', 'OM2M busy', '%.2f'),
+           ('brokerMessages', 'MQTT msg', '%d'), ('brokerMB', 'MQTT MB', '%.2f')]
+
+def printTable(results):
+    print('  '.join([title.rjust(10) for key, title, form in columns]))
+    for result in results:
+        print('  '.join([(form % result[key]).rjust(10) for key, title, form in columns]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline end-to-end throughput benchmark of XWare')
+    parser.add_argument('--gateways', type=int, default=4, help='number of simulated gateways')
+    parser.add_argument('--duration', type=float, default=10, help='sampling time of the run [s]')
+    parser.add_argument('--F', type=float, default=1000, help='sampling frequency of each gateway [Hz]')
+    parser.add_argument('--t', type=float, default=1, help='time length of a sampling [s]')
+    parser.add_argument('--T', type=float, default=1, help='time between samplings [s]')
+    parser.add_argument('--planes', default='om2m,mqtt', help='data planes to compare')
+    parser.add_argument('--ingestion', default='poll,mqtt', help='Server ingestion modes to compare')
+    parser.add_argument('--chunk', type=int, default=0, help='chunk size of the gateways (0 = whole samplings)')
+    parser.add_argument('--scheduler', default='sleep', help='sampling scheduler of the gateways')
+    parser.add_argument('--speed', type=float, default=0, help='replay blocks at this multiple of real time (0 = per-sample string mode)')
+    parser.add_argument('--queue', action='store_true', help='use the store-and-forward queue')
+    parser.add_argument('--drainTime', type=float, default=30, help='maximum wait for the gateway queues and the last CSV files [s]')
+    parser.add_argument('--output', default='', help='also save the results to this JSON file')
+    parser.add_argument('--single', default='', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Child process: run one configuration and hand back its results
+    if args.single:
+        plane, ingestion = args.single.split(',')
+        print(json.dumps(runConfiguration(args, plane, ingestion)))
+        # (the Server thread never returns)
+        sys.stdout.flush()
+        os._exit(0)
+
+    results = []
+    print('XWare throughput: ' + str(args.gateways) + ' gateways x ' + str(args.F) + ' Hz x 3 sensors, ' +
+          str(args.t) + ' s every ' + str(args.T) + ' s, for ' + str(args.duration) + ' s')
+    print('')
+    for plane in args.planes.split(','):
+        for ingestion in args.ingestion.split(','):
+            command = [sys.executable, os.path.abspath(__file__), '--single', plane + ',' + ingestion] + sys.argv[1:]
+            output = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout
+            results.append(json.loads(output.decode('utf-8').splitlines()[-1]))
+    printTable(results)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=1)
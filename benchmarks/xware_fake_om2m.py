@@ -0,0 +1,428 @@
+# Local stand-ins for Eclipse OM2M and an MQTT broker, used by the benchmarks
+# See Github repo (github.com/d-sanchezl/xware) for license details
+
+# FakeBroker is an in-process publish/subscribe broker. installFakeMQTT()
+# makes 'import paho.mqtt.client' return a module whose Client class talks to
+# it, so the XWare gateway and Server code runs unchanged.
+
+# FakeCSE keeps an in-memory resource tree (applications, containers and
+# content instances) and implements the parts of the oneM2M HTTP and MQTT
+# bindings that xware_lib_om2m.py uses:
+# * HTTP: GET (discovery with fu=1 and the crb filter, applications,
+#   containers with their cni and cbs, messages), POST of content
+#   instances and DELETE, on http://127.0.0.1:[port]/~/in-cse/in-name/...
+# Containers with mni or mbs limits drop their oldest content instances.
+# * MQTT: create, retrieve, delete and discovery requests on
+#   /oneM2M/req/[originator]/in-cse/json, answered on
+#   /oneM2M/resp/in-cse/[originator]/json
+
+# Only the standard library is used, so the benchmarks run offline.
+
+# Import necessary packages
+import http.server
+import threading
+import itertools
+import queue
+import types
+import json
+import sys
+import time
+import os
+from urllib.parse import urlparse, parse_qs
+
+
+# ===========================================
+# Check if an MQTT topic matches a subscription (with + and # wildcards)
+
+def topicMatches(subscription,topic):
+    subLevels = subscription.split('/')
+    topicLevels = topic.split('/')
+    for i, level in enumerate(subLevels):
+        if level == '#':
+            return True
+        if i >= len(topicLevels) or (level != '+' and level != topicLevels[i]):
+            return False
+    return len(subLevels) == len(topicLevels)
+
+
+# ===========================================
+# In-process MQTT broker
+
+# Every client has its own inbox, delivered by its own network thread (as in
+# paho's loop_start()), so a slow subscriber does not block the publisher.
+
+class FakeBroker:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = []
+        self.publishedMessages = 0
+        self.publishedBytes = 0
+
+    def subscribe(self,client,topic):
+        with self.lock:
+            if not((client, topic) in self.subscriptions):
+                self.subscriptions.append((client, topic))
+
+    def unsubscribeAll(self,client):
+        with self.lock:
+            self.subscriptions = [sub for sub in self.subscriptions if sub[0] is not client]
+
+    def publish(self,topic,payload):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        with self.lock:
+            self.publishedMessages += 1
+            self.publishedBytes += len(payload)
+            targets = []
+            for client, subscription in self.subscriptions:
+                if topicMatches(subscription, topic) and not(client in targets):
+                    targets.append(client)
+        message = FakeMessage(topic, payload)
+        for client in targets:
+            client.inbox.put(message)
+
+
+class FakeMessage:
+
+    def __init__(self,topic,payload):
+        self.topic = topic
+        self.payload = payload
+        self.qos = 0
+
+
+class FakeMessageInfo:
+
+    rc = 0
+
+    def wait_for_publish(self,timeout=None):
+        pass
+
+    def is_published(self):
+        return True
+
+
+# ===========================================
+# Client with the parts of the paho.mqtt.client.Client API used by XWare
+
+class FakeClient:
+
+    broker = None
+
+    def __init__(self,client_id='',clean_session=None,userdata=None,*args,**kwargs):
+        self.client_id = client_id
+        self._userdata = userdata
+        self.on_message = None
+        self.on_connect = None
+        self.inbox = queue.Queue()
+        self.connected = False
+        self.thread = None
+
+    def connect(self,host,port=1883,keepalive=60):
+        self.connected = True
+        return 0
+
+    connect_async = connect
+
+    def is_connected(self):
+        return self.connected
+
+    def loop_start(self):
+        self.thread = threading.Thread(target=self.loop, name='mqtt-' + str(self.client_id), daemon=True)
+        self.thread.start()
+        if self.on_connect:
+            self.inbox.put('connect')
+
+    def loop(self):
+        while True:
+            message = self.inbox.get()
+            if message is None:
+                return
+            if message == 'connect':
+                self.on_connect(self, self._userdata, {}, 0)
+            elif self.on_message:
+                self.on_message(self, self._userdata, message)
+
+    def loop_stop(self):
+        if self.thread:
+            self.inbox.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def disconnect(self):
+        self.connected = False
+        self.broker.unsubscribeAll(self)
+
+    def subscribe(self,topic,qos=0):
+        self.broker.subscribe(self, topic)
+        return (0, 1)
+
+    def publish(self,topic,payload=None,qos=0,retain=False):
+        self.broker.publish(topic, payload)
+        return FakeMessageInfo()
+
+
+# ===========================================
+# Make 'import paho.mqtt.client' use the fake broker
+
+def installFakeMQTT(broker):
+    FakeClient.broker = broker
+    clientModule = types.ModuleType('paho.mqtt.client')
+    clientModule.Client = FakeClient
+    clientModule.MQTTMessage = FakeMessage
+    mqttModule = types.ModuleType('paho.mqtt')
+    mqttModule.client = clientModule
+    pahoModule = types.ModuleType('paho')
+    pahoModule.mqtt = mqttModule
+    sys.modules['paho'] = pahoModule
+    sys.modules['paho.mqtt'] = mqttModule
+    sys.modules['paho.mqtt.client'] = clientModule
+    return clientModule
+
+
+# ===========================================
+# HTTP server of the CSE
+# (a longer listen queue than the default 5, so that concurrent clients are
+# not held back by dropped connection attempts)
+
+class FakeHTTPServer(http.server.ThreadingHTTPServer):
+
+    request_queue_size = 128
+
+
+# ===========================================
+# In-memory OM2M CSE
+
+# serverCSE, serverName: CSE names, as in the XWare clients
+# broker: FakeBroker to serve the MQTT binding on (optional)
+
+class FakeCSE:
+
+    def __init__(self,serverCSE='in-cse',serverName='in-name',broker=None):
+        self.serverCSE = serverCSE
+        self.serverName = serverName
+        self.lock = threading.Lock()
+        self.resources = {'/'+serverCSE+'/'+serverName: {'ty': 5, 'rn': serverName}}
+        self.children = {'/'+serverCSE+'/'+serverName: []}
+        self.instanceCounter = itertools.count(1)
+        self.requests = 0
+        self.busyTime = 0.0
+        self.httpServer = None
+        self.broker = broker
+        if broker is not None:
+            self.client = FakeClient('cse')
+            self.client.broker = broker
+            self.client.on_message = self.onMessageMQTT
+            self.client.subscribe('/oneM2M/req/+/'+serverCSE+'/json')
+            self.client.loop_start()
+
+    # ===========
+    # Resource tree operations
+    # Each returns (status code, response content)
+
+    def create(self,parent,ty,resource):
+        with self.lock:
+            if not(parent in self.resources):
+                return 4004, None
+            if ty == 4:
+                resource['rn'] = 'cin_' + str(next(self.instanceCounter))
+            resource['ty'] = ty
+            resource['ct'] = time.strftime('%Y%m%dT%H%M%S')
+            path = parent + '/' + resource['rn']
+            if path in self.resources:
+                return 4105, None
+            resource['ri'] = path
+            self.resources[path] = resource
+            self.children[path] = []
+            self.children[parent].append(path)
+            if ty == 4:
+                self.enforceLimits(parent)
+            return 2001, resource
+
+    # Drop the oldest content instances of a container over its mni or mbs
+    def enforceLimits(self,path):
+        container = self.resources[path]
+        while True:
+            instances, size = self.fill(path)
+            if not((container.get('mni') and instances > container['mni']) or
+                   (container.get('mbs') and size > container['mbs'])):
+                return
+            oldest = self.children[path].pop(0)
+            del self.children[oldest]
+            del self.resources[oldest]
+
+    # Number and total size of the content instances of a container
+    def fill(self,path):
+        contents = [self.resources[child].get('con', '') for child in self.children[path]
+                    if self.resources[child]['ty'] == 4]
+        return len(contents), sum([len(content) for content in contents])
+
+    def retrieve(self,path):
+        with self.lock:
+            if not(path in self.resources):
+                return 4004, None
+            resource = self.resources[path]
+            if resource['ty'] == 3:
+                resource = dict(resource)
+                resource['cni'], resource['cbs'] = self.fill(path)
+            return 2000, resource
+
+    # createdBefore: only resources created before this time ('crb' filter)
+    def discover(self,path,ty,createdBefore=None):
+        with self.lock:
+            if not(path in self.resources):
+                return 4004, None
+            found = []
+            pending = list(self.children[path])
+            while pending:
+                child = pending.pop(0)
+                if self.resources[child]['ty'] == ty and (createdBefore is None or self.resources[child]['ct'] < createdBefore):
+                    found.append(child)
+                pending += self.children[child]
+            return 2000, found
+
+    def delete(self,path):
+        with self.lock:
+            if not(path in self.resources):
+                return 4004, None
+            pending = [path]
+            while pending:
+                child = pending.pop()
+                pending += self.children.pop(child)
+                del self.resources[child]
+            parent = path[:path.rfind('/')]
+            if parent in self.children:
+                self.children[parent].remove(path)
+            return 2002, None
+
+    def countInstances(self):
+        with self.lock:
+            return len([1 for resource in self.resources.values() if resource['ty'] == 4])
+
+    # ===========
+    # MQTT binding
+
+    def onMessageMQTT(self,client,userdata,msg):
+        startTime = time.perf_counter()
+        originator = msg.topic.split('/')[3]
+        request = json.loads(str(msg.payload, 'utf-8'), strict=False)['m2m:rqp']
+        target = request['m2m:to']
+        op = str(request['m2m:op'])
+        content = None
+        if 'm2m:fc' in request:
+            code, content = self.discover(target, int(request['m2m:fc']['m2m:ty']))
+            if code == 2000:
+                content = {'m2m:uril': {'m2m:uril': content}} if content else {'m2m:uril': ''}
+        elif op == '1':
+            (key, resource), = request['m2m:pc'].items()
+            code, content = self.create(target, int(request['m2m:ty']), dict(resource))
+            if code == 2001:
+                content = {key: content}
+        elif op == '2':
+            code, content = self.retrieve(target)
+            if code == 2000:
+                content = {'m2m:cin': content}
+        elif op == '4':
+            code, content = self.delete(target)
+        else:
+            code = 4000
+        response = {'m2m:rsp': {'m2m:rsc': code, 'm2m:rqi': request['m2m:rqi'], 'm2m:pc': content}}
+        self.client.publish('/oneM2M/resp/'+self.serverCSE+'/'+originator+'/json', json.dumps(response))
+        self.requests += 1
+        self.busyTime += time.perf_counter() - startTime
+
+    # ===========
+    # HTTP binding
+
+    def startHTTP(self,port=0):
+        cse = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def log_message(self,*args):
+                pass
+
+            def reply(self,code,content):
+                body = b'' if content is None else json.dumps(content).encode('utf-8')
+                self.send_response(200 if code < 3000 and code != 2001 else (201 if code == 2001 else 404))
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def target(self):
+                url = urlparse(self.path)
+                return url.path[2:], parse_qs(url.query)
+
+            def do_GET(self):
+                startTime = time.perf_counter()
+                path, query = self.target()
+                if 'fu' in query:
+                    code, found = cse.discover(path, int(query['ty'][0]), query.get('crb', [None])[0])
+                    self.reply(code, {'m2m:uril': found} if code == 2000 else None)
+                else:
+                    code, resource = cse.retrieve(path)
+                    key = {2: 'm2m:ae', 3: 'm2m:cnt', 4: 'm2m:cin'}.get(resource['ty'] if resource else 0, 'm2m:cb')
+                    self.reply(code, {key: resource} if code == 2000 else None)
+                cse.requests += 1
+                cse.busyTime += time.perf_counter() - startTime
+
+            def do_POST(self):
+                startTime = time.perf_counter()
+                path, query = self.target()
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                (key, resource), = body.items()
+                ty = int(self.headers['Content-Type'].split('ty=')[-1])
+                code, content = cse.create(path, ty, dict(resource))
+                self.reply(code, {key: content} if content else None)
+                cse.requests += 1
+                cse.busyTime += time.perf_counter() - startTime
+
+            def do_DELETE(self):
+                startTime = time.perf_counter()
+                path, query = self.target()
+                code, content = cse.delete(path)
+                self.reply(code, None)
+                cse.requests += 1
+                cse.busyTime += time.perf_counter() - startTime
+
+        self.httpServer = FakeHTTPServer(('127.0.0.1', port), Handler)
+        self.httpServer.daemon_threads = True
+        thread = threading.Thread(target=self.httpServer.serve_forever, name='cse-http', daemon=True)
+        thread.start()
+        return '127.0.0.1:' + str(self.httpServer.server_address[1])
+
+    def stop(self):
+        if self.httpServer is not None:
+            self.httpServer.shutdown()
+        if self.broker is not None:
+            self.client.loop_stop()
+
+
+# ===========================================
+# Run an XWare client script with some of its parameters replaced
+
+# The scripts define their parameters as 'name = value' lines at the top level.
+# Each of those lines whose name is in 'overrides' is replaced before the
+# script runs, so the script itself does not have to be changed.
+
+# scriptPath: path of the script, e.g. clients/xware_server.py
+# overrides: dictionary of parameter names and values (must support repr())
+# extraGlobals: names defined before the script runs (e.g. a silent input())
+
+def configuredScript(scriptPath,overrides):
+    with open(scriptPath, 'r') as file:
+        lines = file.read().splitlines()
+    for i, line in enumerate(lines):
+        name = line.split('=')[0].strip()
+        if name in overrides and not(line.startswith(' ')) and '=' in line:
+            lines[i] = name + ' = ' + repr(overrides[name])
+    return compile('\n'.join(lines) + '\n', scriptPath, 'exec')
+
+def runScript(scriptPath,overrides,name='script',extraGlobals=None):
+    code = configuredScript(scriptPath, overrides)
+    namespace = {'__name__': '__xware_' + name + '__', '__file__': scriptPath}
+    namespace.update(extraGlobals or {})
+    thread = threading.Thread(target=exec, args=(code, namespace), name=name, daemon=True)
+    thread.start()
+    return thread, namespace
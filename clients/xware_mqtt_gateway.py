@@ -7,14 +7,8 @@
 # Make sure you review the "USER PARAMETERS" and "DATA AQUISITION FUNCTION"
 # sections before executing this code.
 
-# Import necessary packages
-import paho.mqtt.client as mqtt # MQTT
-import time # To time sending intervals
-
 # Import xware libraries
-from xware_lib_functions import *
-from xware_lib_om2m import *
-import xware_globals
+from xware_lib_gateway import *
 
 
 
@@ -68,9 +62,113 @@
 waitTime = 0.1
 # Time between message sent retries
 retryWaitTime = 1
-# Maximum time before message sending stops and code exits
+# Maximum time to wait for OM2M before the device stops (or, with a queue,
+# before it works offline)
 maxWaitTime = 6
 
+# Store-and-forward queue: buffers are kept on disk until the broker
+# acknowledges them, so acquisition keeps running during outages
+# queueLocation: folder of the queue, e.g. '/home/pi/XWare/queue' ('' = disabled,
+# buffers are sent directly)
+queueLocation = ''
+# Maximum disk space used by the queue [bytes]
+queueMaxDiskUsage = 512*1024*1024
+# Size of each queue segment file [bytes]
+queueSegmentSize = 16*1024*1024
+# When the queue is full: 'drop-oldest' or 'drop-newest'
+queueEvictionPolicy = 'drop-oldest'
+# When stopped, wait up to this long [s] for the queue to be delivered
+# (0 = queued buffers are sent at the next start)
+queueDrainTime = 0
+
+# Data plane: 'om2m' (sample buffers are stored in OM2M) or 'mqtt' (sample
+# buffers are published straight to the Server through the broker; OM2M only
+# keeps the device labels and events). Must match the Server setting.
+dataPlane = 'om2m'
+# MQTT topic prefix for sample buffers ('mqtt' data plane)
+dataTopicPrefix = 'xware/data'
+
+# OM2M container limits, set when the 'sampling' and 'events' containers are
+# created: maximum number of messages (mni), total bytes (mbs) and age [s]
+# (mia). Once a limit is reached, OM2M drops the oldest messages, so they
+# bound the CSE storage when the Server lags (None = no limit)
+containerMaxInstances = None
+containerMaxBytes = None
+containerMaxAge = None
+
+# Metrics: stage latencies, counters and queue depth are served in the
+# Prometheus text format on http://[metricsAddress]:[metricsPort]/metrics
+# (0 = disabled)
+metricsPort = 0
+metricsAddress = '127.0.0.1'
+# Trace file: one line (span) per stage of every sampling ('' = disabled)
+traceLocation = ''
+
+# Profiling: sample the stacks of all threads every profileInterval seconds and
+# write flamegraph-ready collapsed stacks to profileLocation, one file every
+# profileDumpInterval seconds ('' = disabled)
+profileLocation = ''
+profileInterval = 0.005
+profileDumpInterval = 60
+
+# Data acquisition contract: 'string', 'numeric' or 'block'
+acquisitionMode = 'string'
+# Samples requested per getBlockFromSensor(n) call ('block' mode)
+blockSize = 100
+# Set to 0 if getBlockFromSensor(n) already waits for the hardware to
+# acquire the samples; otherwise, XWare paces each block at n/F
+blockPacing = 1
+# Decimal places used to send numeric values (None = exact)
+# ('numeric' and 'block' modes). If it matches the valuePrecision of the
+# Server and valueConversion is 1, the Server writes the values as they are
+sendPrecision = None
+
+# Sampling scheduler: 'hybrid' (sleep, then spin), 'sleep' or 'spin'
+schedulerMode = 'hybrid'
+# Time before each sample when the 'hybrid' scheduler stops sleeping [s]
+schedulerSpinTime = 0.002
+# Set to 1 to send the capture time of every sample along with its values
+sendTimestamps = 0
+# Set to 1 to send jitter statistics to the 'events' container after each buffer
+publishJitterStats = 1
+
+# Cycle log: one line per cycle with the handshake latency, actual vs. nominal
+# sample interval, time spent reading the sensor, formatting and publishing,
+# and payload bytes. Rotated at cycleLogMaxBytes ('' = disabled)
+cycleLogLocation = ''
+cycleLogMaxBytes = 1024*1024
+cycleLogBackups = 3
+# Set to 1 to also send each cycle summary to the 'events' container
+publishCycleStats = 0
+
+# Send the sampling in chunks of this many samples while it is acquired
+# (0 = send the whole sampling at once). Use it for long samplings, so that
+# messages stay small and data reaches the Server during the sampling.
+chunkSize = 0
+
+# Edge analytics: 'raw' (send every sample) or 'features' (send per-window
+# features of each sampling; samples are only sent when an anomaly is
+# detected). 'features' requires NumPy and does not use chunkSize.
+edgeMode = 'raw'
+# Length of each feature window [s]
+featureWindow = 0.1
+# Frequency bands for band power features [Hz]
+featureBands = [(0,50),(50,200),(200,500)]
+# Number of spectral peaks (frequency and amplitude) in the features
+featurePeaks = 3
+# Feature limits that trip an alarm, e.g. {'rms': 5.0, 'kurtosis': 6}
+featureThresholds = {}
+# Anomaly score (deviation from the learnt normal features, in standard
+# deviations) that trips an alarm (0 = only use featureThresholds)
+anomalyScoreLimit = 0
+# Normal samplings used to learn the baseline before scoring
+baselineSamplings = 10
+# Sampling frequency [Hz] and time [s] while in alarm (None = F and t)
+alarmF = None
+alarmT = None
+# Samplings sent in full after the last one that tripped an alarm
+alarmHold = 3
+
 
 
 
@@ -100,6 +198,18 @@
 # Note 2: The getValueFromSensor() function does not take any inputs. If you
 # require any inputs, use python globals.
 
+# Note 3: Two numeric contracts are also available (see "acquisitionMode" in
+# the ADVANCED PARAMETERS section):
+
+# * 'numeric': "getValueFromSensor()" returns numbers instead of a string,
+#   e.g. 2.99808 or (2.99808,-11.24914,-0.77331) or a 1D NumPy array.
+# * 'block': define a function "getBlockFromSensor(n)" that returns n samples
+#   at once, e.g. a list of n tuples or an (n x sensors) NumPy array. This is
+#   meant for DAQ hardware that delivers data in chunks.
+
+# Numeric values are only converted to text once per sampling, when the
+# buffer is sent.
+
 # ==========
 # Code:
 
@@ -110,6 +220,10 @@ def getValueFromSensor():
     z = '345.678'
     return x + ',' + y + ',' + z
 
+# Example block function for 3 values ('block' mode)
+def getBlockFromSensor(n):
+    return [(123.456, -789.012, 345.678)] * n
+
 
 
 
@@ -122,191 +236,61 @@ def getValueFromSensor():
 
 
 #====================
-# SET UP FLAGS AND VARIABLES
-
-xware_globals.newMessage = None
-xware_globals.messageString = ''
-messageIndex = 0
+# WAIT FOR OPERATOR INPUT
+print('Selected sampling frequency is ' + str(F) + ' Hz')
+print('Selected sampling time is ' + str(t) + ' s')
+print('Selected sampling period is ' + str(T) + ' s')
+print('Make sure that XWare Server is active before starting!') #!!!
+input('Press Return to begin...')
+print('')
 
 
 #====================
-# Time parameters
-deltaTime = 1/F
-sampleWaitTime = deltaTime/10
+# METRICS ENDPOINT, TRACE FILE AND PROFILER
+if metricsPort:
+    metrics.startHTTP(metricsPort,metricsAddress)
+if traceLocation:
+    metrics.enableTracing(traceLocation)
+if profileLocation:
+    profiler = SamplingProfiler(profileLocation,deviceName,profileInterval,profileDumpInterval)
+    profiler.start()
 
 
 #====================
-# OM2M SETTINGS
-topicReq = '/oneM2M/req/'+deviceName+'/'+serverCSE+'/json'
-topicResp = '/oneM2M/resp/'+serverCSE+'/'+deviceName+'/json'
-to_app  = '/'+serverCSE+'/'+serverName
-to_cont = '/'+serverCSE+'/'+serverName+'/'+deviceName
-to_data  = '/'+serverCSE+'/'+serverName+'/'+deviceName+'/'+containerName
-to_events  = '/'+serverCSE+'/'+serverName+'/'+deviceName+'/'+eventsContName
+# OPEN LOCAL QUEUE
+queue = None
+if queueLocation:
+    queue = DiskQueue(queueLocation,queueSegmentSize,queueMaxDiskUsage,queueEvictionPolicy)
 
 
 #====================
-# WAIT FOR OPERATOR INPUT
-print('Selected sampling frequency is ' + str(F) + ' Hz')
-print('Selected sampling time is ' + str(t) + ' s')
-print('Selected sampling period is ' + str(T) + ' s')
-print('Make sure that XWare Server is active before starting!') #!!!
-input('Press Return to begin...')
-print('')
+# OPEN CYCLE LOG
+cycleLog = None
+if cycleLogLocation:
+    cycleLog = RollingLog(cycleLogLocation,cycleLogMaxBytes,cycleLogBackups)
 
 
 #====================
 # MQTT CONNECT TO OM2M
-client = mqtt.Client(deviceName, userdata = topicResp)
-client.on_message = onMessageMQTT
-client.on_connect = onConnectMQTT
-client.connect(brokerAddress)
-client.loop_start()
-
-
-# ===========
-# Check if OM2M application exists via MQTT
-payload = searchApplicationsPayload(authOM2M,to_app,'123456')
-# Send message and wait for response
-sendAndWaitMQTT(client,topicReq,payload,waitTime,retryWaitTime,maxWaitTime)
-# Check if this device is in the list
-if json.loads(xware_globals.messageString)['m2m:rsp']['m2m:pc']['m2m:uril']:
-    apps = lastUrlItem(json.loads(xware_globals.messageString)['m2m:rsp']['m2m:pc']['m2m:uril']['m2m:uril'])
-else: apps = []
-# Otherwise, create app
-if not(deviceName in apps):
-    payload = createApplicationPayload(authOM2M,to_app,'123456',F,t,T,valueConversion,deviceTag,sensorTag,deviceName)
-    sendAndWaitMQTT(client,topicReq,payload,waitTime,retryWaitTime,maxWaitTime)
-
-
-# ===========
-# Check if OM2M container exists via MQTT
-payload = searchContainersPayload(authOM2M,to_cont,'123456')
-# Send message and wait for response
-sendAndWaitMQTT(client,topicReq,payload,waitTime,retryWaitTime,maxWaitTime)
-# Check if this container is in the list
-if json.loads(xware_globals.messageString)['m2m:rsp']['m2m:pc']['m2m:uril']:
-    containers = lastUrlItem(json.loads(xware_globals.messageString)['m2m:rsp']['m2m:pc']['m2m:uril']['m2m:uril'])
-else: containers = []
-# Otherwise, create container
-if not(containerName in containers):
-    payload = createContainerPayload(authOM2M,to_cont,'123456',containerName)
-    sendAndWaitMQTT(client,topicReq,payload,waitTime,retryWaitTime,maxWaitTime)
-
-
-# ===========
-# Check if OM2M container (events) exists via MQTT
-# Otherwise, create container
-if not(eventsContName in containers):
-    payload = createContainerPayload(authOM2M,to_cont,'123456',eventsContName)
-    sendAndWaitMQTT(client,topicReq,payload,waitTime,retryWaitTime,maxWaitTime)
+runtime = GatewayRuntime(brokerAddress,deviceName,serverCSE,serverName,containerName,eventsContName,
+                         authOM2M,waitTime,retryWaitTime,maxWaitTime,queue,
+                         dataPlane=dataPlane,dataTopicPrefix=dataTopicPrefix,cycleLog=cycleLog,
+                         containerMaxInstances=containerMaxInstances,containerMaxBytes=containerMaxBytes,
+                         containerMaxAge=containerMaxAge,drainTime=queueDrainTime)
+
+
+#====================
+# ADD THIS DEVICE
+runtime.addDevice(GatewayDevice(deviceName,F,t,T,valueConversion,deviceTag,sensorTag,
+                                getValueFromSensor,getBlockFromSensor,
+                                acquisitionMode,blockSize,blockPacing,sendPrecision,
+                                schedulerMode,schedulerSpinTime,sendTimestamps,publishJitterStats,
+                                chunkSize,edgeMode,featureWindow,featureBands,featurePeaks,
+                                featureThresholds,anomalyScoreLimit,baselineSamplings,
+                                alarmF,alarmT,alarmHold,publishCycleStats))
 
 
 #====================
-# OPEN EMPTY BUFFER
-deviceBuffer = '' # Store as str
-currentBufferSize = 0
-totalSamples = 0
-
-
-# ======================
-# Set clock for first period
-startTimePeriodT = time.time()
-currentTimePeriodT = startTimePeriodT
-nextTimePeriodT = currentTimePeriodT + T
-
-while True:
-
-    print('Begin cycle!')
-
-    # ======================
-    # Start a new sampling cycle (t)
-    # Send START as MQTT+OM2M message, and wait for response
-    messageIndex += 1
-    payload = createMessagePayload(authOM2M,to_events,'123456','START\n'+deviceName+'\n'+str(messageIndex))
-    sendAndWaitMQTT(client,topicReq,payload,waitTime,retryWaitTime,maxWaitTime)
-
-    # ======================
-    # WAIT FOR  RESPONSE
-    ready = 0
-    while not(ready):
-        time.sleep(waitTime)
-
-        # Search for all messages
-        payload = searchMessagesPayload(authOM2M,to_events,'123456')
-        sendAndWaitMQTT(client,topicReq,payload,waitTime,retryWaitTime,maxWaitTime)
-        obj = json.loads(xware_globals.messageString)
-
-        # If there are messages
-        if obj['m2m:rsp']['m2m:pc']:
-            if obj['m2m:rsp']['m2m:pc']['m2m:uril']:
-                messageList = lastUrlItem(obj['m2m:rsp']['m2m:pc']['m2m:uril']['m2m:uril'])
-
-                # Read each message
-                for messageName in messageList:
-                    payload = readMessagePayload(authOM2M,to_events+'/'+messageName,'123456')
-                    sendAndWaitMQTT(client,topicReq,payload,waitTime,retryWaitTime,maxWaitTime)
-                    obj = json.loads(xware_globals.messageString)
-                    try:
-                        messageText = obj["m2m:rsp"]["m2m:pc"]["m2m:cin"]["con"][1:-1]
-                    except:
-                        messageText = '     '
-
-                    # Check if this is the message we need
-                    if messageText[:5] == 'TIMER':
-
-                        # Indicate readiness and delete received message
-                        ready = 1
-                        payload = deleteMessagePayload(authOM2M,to_events+'/'+messageName,'123456')
-                        sendAndWaitMQTT(client,topicReq,payload,waitTime,retryWaitTime,maxWaitTime)
-
-
-    # ======================
-    # Set clock for first sample
-    startTime = time.monotonic()
-    currentTime = startTime
-    nextTime = currentTime + deltaTime
-
-    # ======================
-    # 1/F loop: request sensor data
-
-    samplesInSampling = int(t*F)
-    while currentBufferSize < samplesInSampling:
-
-        # ======================
-        # Request and get sensor value
-        value = getValueFromSensor()
-
-        # Append value to device buffer
-        deviceBuffer += (str(value)+'\n')
-
-        # Update read samples
-        currentBufferSize += 1
-
-        # Stop the code until enough time has passed
-        while time.monotonic() < nextTime:
-            time.sleep(sampleWaitTime)
-
-        # Update current and next time
-        currentTime = nextTime
-        nextTime += deltaTime
-
-    # Debug
-    print('Done reading data! Sending buffer...')
-
-    # Send device buffer as MQTT+OM2M message
-    payload = createMessagePayload(authOM2M,to_data,'123456',deviceBuffer)
-    client.publish(topicReq, payload)
-
-    # Clear buffer
-    deviceBuffer = ''
-    currentBufferSize = 0
-
-    # Wait for next cycle
-    print('Done sending data! Waiting for next period...')
-    while time.time() < nextTimePeriodT:
-        time.sleep(sampleWaitTime)
-
-    # Update clock time for next sampling
-    currentTimePeriodT = nextTimePeriodT
-    nextTimePeriodT += T
+# BEGIN CYCLING
+# (registers the device in OM2M, then samples every T seconds)
+runtime.run()
@@ -0,0 +1,197 @@
+# MQTT to OM2M gateway client for several devices in one process
+# See Github repo (github.com/d-sanchezl/xware) for license details
+
+# This code is made to be executed in a Gateway (e.g. an edge PC) that is wired
+# to several devices. All devices share one connection to the MQTT broker, and
+# each device samples its sensors in its own thread.
+
+# Make sure you review the "USER PARAMETERS" and "DATA AQUISITION FUNCTIONS"
+# sections before executing this code.
+
+# Import xware libraries
+from xware_lib_gateway import *
+
+
+
+# ==================================================================
+# DATA AQUISITION FUNCTIONS:
+
+# Create one acquisition function per device. Each function follows the same
+# contract as "getValueFromSensor()" in xware_mqtt_gateway.py (or
+# "getBlockFromSensor(n)" in 'block' mode).
+
+# ==========
+# Code:
+
+# Example function for 3 values
+def readMotor1():
+    return '123.456,-789.012,345.678'
+
+# Example function for 1 value ('numeric' mode)
+def readMotor2():
+    return 123.456
+
+
+
+
+# ==================================================================
+# USER PARAMETERS:
+# Change these to your liking
+
+# MQTT address, change to target (server) IP address
+brokerAddress = '192.138.6.70'
+
+# Gateway identifier (MQTT client name)
+gatewayName = 'edge_pc_1'
+
+# Devices connected to this gateway
+# Each entry holds the same parameters as xware_mqtt_gateway.py:
+# GatewayDevice(deviceName, F, t, T, valueConversion, deviceTag, sensorTag, acquisition function)
+# Optional parameters (e.g. acquisitionMode) can be given by name
+
+devices = [
+    GatewayDevice('induction_motor_1',1000,2,5,1/0.00989,'induction_motor_1','x_accel,y_accel,z_accel',
+                  readMotor1,schedulerMode='sleep'),
+    GatewayDevice('induction_motor_2',500,2,5,1/0.00989,'induction_motor_2','x_accel',
+                  readMotor2,acquisitionMode='numeric',schedulerMode='sleep'),
+    ]
+
+# Set to 1 to wait for the operator before starting
+waitForOperator = 0
+
+
+# =================================
+# ADVANCED PARAMETERS:
+# Do not change these unless you know what you are doing
+
+# OM2M names
+serverCSE = 'in-cse'
+serverName = 'in-name'
+containerName = 'sampling'
+eventsContName = 'events'
+authOM2M = 'admin:admin' # user:password
+
+# Time between message receipt verification
+waitTime = 0.1
+# Time between message sent retries
+retryWaitTime = 1
+# Maximum time to wait for OM2M before a device stops (or, with a queue,
+# before it works offline)
+maxWaitTime = 6
+
+# Store-and-forward queue: buffers are kept on disk until the broker
+# acknowledges them, so acquisition keeps running during outages
+# queueLocation: folder of the queue, e.g. '/home/pi/XWare/queue' ('' = disabled,
+# buffers are sent directly)
+queueLocation = ''
+# Maximum disk space used by the queue [bytes]
+queueMaxDiskUsage = 512*1024*1024
+# Size of each queue segment file [bytes]
+queueSegmentSize = 16*1024*1024
+# When the queue is full: 'drop-oldest' or 'drop-newest'
+queueEvictionPolicy = 'drop-oldest'
+# When stopped, wait up to this long [s] for the queue to be delivered
+# (0 = queued buffers are sent at the next start)
+queueDrainTime = 0
+
+# Data plane: 'om2m' (sample buffers are stored in OM2M) or 'mqtt' (sample
+# buffers are published straight to the Server through the broker; OM2M only
+# keeps the device labels and events). Must match the Server setting.
+dataPlane = 'om2m'
+# MQTT topic prefix for sample buffers ('mqtt' data plane)
+dataTopicPrefix = 'xware/data'
+
+# OM2M container limits, set when the 'sampling' and 'events' containers are
+# created: maximum number of messages (mni), total bytes (mbs) and age [s]
+# (mia). Once a limit is reached, OM2M drops the oldest messages, so they
+# bound the CSE storage when the Server lags (None = no limit)
+containerMaxInstances = None
+containerMaxBytes = None
+containerMaxAge = None
+
+# Metrics: stage latencies, counters and queue depth are served in the
+# Prometheus text format on http://[metricsAddress]:[metricsPort]/metrics
+# (0 = disabled)
+metricsPort = 0
+metricsAddress = '127.0.0.1'
+# Trace file: one line (span) per stage of every sampling ('' = disabled)
+traceLocation = ''
+
+# Profiling: sample the stacks of all threads every profileInterval seconds and
+# write flamegraph-ready collapsed stacks to profileLocation, one file every
+# profileDumpInterval seconds ('' = disabled)
+profileLocation = ''
+profileInterval = 0.005
+profileDumpInterval = 60
+
+# Cycle log: one line per cycle and device with the handshake latency, actual
+# vs. nominal sample interval, time spent reading the sensor, formatting and
+# publishing, and payload bytes. Rotated at cycleLogMaxBytes ('' = disabled)
+# (publishCycleStats=1 can be given to a GatewayDevice to also send them to
+# the 'events' container)
+cycleLogLocation = ''
+cycleLogMaxBytes = 1024*1024
+cycleLogBackups = 3
+
+# Note: spinning ('hybrid' and 'spin' schedulers) keeps a CPU core busy per
+# device. With many devices in one process, the 'sleep' scheduler is advised.
+
+
+
+
+# ==================================================================
+# XWARE CODE
+
+# This is the XWare code.
+# You should not have to change anything beyond this point.
+
+
+#====================
+# WAIT FOR OPERATOR INPUT
+for device in devices:
+    print(device.deviceName + ': ' + str(device.F) + ' Hz, ' + str(device.t) + ' s every ' + str(device.T) + ' s')
+if waitForOperator:
+    print('Make sure that XWare Server is active before starting!')
+    input('Press Return to begin...')
+print('')
+
+
+#====================
+# METRICS ENDPOINT, TRACE FILE AND PROFILER
+if metricsPort:
+    metrics.startHTTP(metricsPort,metricsAddress)
+if traceLocation:
+    metrics.enableTracing(traceLocation)
+if profileLocation:
+    profiler = SamplingProfiler(profileLocation,gatewayName,profileInterval,profileDumpInterval)
+    profiler.start()
+
+
+#====================
+# OPEN LOCAL QUEUE
+queue = None
+if queueLocation:
+    queue = DiskQueue(queueLocation,queueSegmentSize,queueMaxDiskUsage,queueEvictionPolicy)
+
+
+#====================
+# OPEN CYCLE LOG
+cycleLog = None
+if cycleLogLocation:
+    cycleLog = RollingLog(cycleLogLocation,cycleLogMaxBytes,cycleLogBackups)
+
+
+#====================
+# MQTT CONNECT TO OM2M
+runtime = GatewayRuntime(brokerAddress,gatewayName,serverCSE,serverName,containerName,eventsContName,
+                         authOM2M,waitTime,retryWaitTime,maxWaitTime,queue,
+                         dataPlane=dataPlane,dataTopicPrefix=dataTopicPrefix,cycleLog=cycleLog,
+                         containerMaxInstances=containerMaxInstances,containerMaxBytes=containerMaxBytes,
+                         containerMaxAge=containerMaxAge,drainTime=queueDrainTime)
+for device in devices:
+    runtime.addDevice(device)
+
+
+#====================
+# BEGIN CYCLING
+runtime.run()
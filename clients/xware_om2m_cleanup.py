@@ -0,0 +1,80 @@
+# OM2M cleanup client: delete old XWare data from OM2M
+# See Github repo (github.com/d-sanchezl/xware) for license details
+
+# This code deletes OM2M applications, or only their older messages, with
+# several requests at once. It can be run while the Server is stopped (e.g.
+# to clear a CSE with a large history before starting it), or, with a
+# retention policy, from time to time while XWare runs.
+
+# Make sure you review the "USER PARAMETERS" section before executing this
+# code.
+
+# Import xware libraries
+from xware_lib_om2m import *
+
+
+
+# ==================================================================
+# USER PARAMETERS:
+# Change these to your liking
+
+# OM2M address
+ipOM2M = '127.0.0.1:8080'
+
+# Applications to clean up (empty list = all applications)
+appNames = []
+
+# Retention policy (None = not used)
+# If both are None, whole applications are deleted. Otherwise, only messages
+# are deleted:
+# * keepMessages: keep the last N messages of each container
+# * maxAge: only delete messages older than this [s]
+keepMessages = None
+maxAge = None
+
+
+# =================================
+# ADVANCED PARAMETERS:
+# Do not change these unless you know what you are doing
+
+# OM2M parameters
+serverCSE = 'in-cse'
+serverName = 'in-name'
+authOM2M = 'admin:admin'
+
+# Requests sent at once
+workers = 8
+
+# Time between progress messages [s]
+progressInterval = 5
+
+# Set to 1 to wait for the operator before deleting
+waitForOperator = 1
+
+
+
+
+# ==================================================================
+# XWARE CODE
+
+# This is the XWare code.
+# You should not have to change anything beyond this point.
+
+
+#====================
+# FIND APPLICATIONS
+if not(appNames):
+    appNames = lastUrlItem(listApplicationsREST(authOM2M,ipOM2M,serverCSE,serverName))
+print('Applications: ' + ', '.join(appNames))
+if keepMessages is None and maxAge is None:
+    print('Whole applications will be deleted')
+else:
+    print('Messages will be deleted (keep last: ' + str(keepMessages) + ', older than: ' + str(maxAge) + ' s)')
+if waitForOperator and appNames:
+    input('Press Return to begin...')
+
+
+#====================
+# CLEAN UP
+cleaner = OM2MCleaner(authOM2M,ipOM2M,serverCSE,serverName,workers,keepMessages,maxAge,progressInterval)
+cleaner.run(appNames)
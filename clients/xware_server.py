@@ -9,10 +9,18 @@
 import paho.mqtt.client as mqtt # MQTT
 import os # To create and manage directories
 import time # To time sending intervals
+import queue # To hand MQTT messages to the main loop
+import threading # To profile the main thread
 
 # Import xware libraries
 from xware_lib_functions import *
 from xware_lib_om2m import *
+from xware_lib_scheduler import *
+from xware_lib_stream import *
+from xware_lib_metrics import *
+from xware_lib_profiler import *
+from xware_lib_state import *
+from xware_lib_encoder import *
 
 
 
@@ -33,6 +41,29 @@
 timePrecision = 6
 valuePrecision = 5
 
+# Pass-through: the values of devices with a ValueConversion of 1 that send
+# exactly valuePrecision decimals (sendPrecision on the gateway) are copied
+# to the CSV files as they are, without being converted to numbers
+# (0 = always convert)
+passThroughValues = 1
+
+# Summary folder:
+# Features (computed here, or sent by gateways in 'features' edge mode) and
+# decimated samples will be stored here
+summaryLocation = 'C:/Users/User/XWare/summary'
+
+# Feature extraction (requires NumPy)
+# Set to 1 to also write, for every sampling, windowed features (RMS, peak,
+# crest factor, mean, standard deviation, kurtosis and band powers) and a
+# decimated copy of the samples to summaryLocation
+extractFeatures = 0
+# Length of each feature window [s]
+featureWindow = 0.1
+# Frequency bands for band power features [Hz]
+featureBands = [(0,50),(50,200),(200,500)]
+# Decimation factor of the summary samples (0 or 1 to disable)
+decimationFactor = 10
+
 
 # =================================
 # ADVANCED PARAMETERS:
@@ -49,6 +80,82 @@
 # Wait time between cycles (can be 0)
 waitTime = 0.05
 
+# Old OM2M data found at startup is deleted with up to cleanupWorkers requests
+# at once. Set cleanupInBackground to 1 to start processing new devices right
+# away while it is deleted (devices being cleaned up are skipped until they
+# are done, so only start their gateways once the cleanup is logged as done)
+cleanupWorkers = 8
+cleanupInBackground = 0
+
+# OM2M container limits: every containerCheckInterval seconds, the fill level
+# of the containers of every device is read (number of messages and bytes,
+# relative to the mni and mbs limits set by the gateways), exported as the
+# xware_container_fill_ratio metric, and a warning is logged when it goes
+# over containerWarnLevel, before OM2M starts dropping the oldest messages
+# (0 = not checked)
+containerCheckInterval = 30
+containerWarnLevel = 0.8
+
+# Data plane: 'om2m' (sample buffers are read from OM2M) or 'mqtt' (gateways
+# publish sample buffers straight to the broker; OM2M only keeps the device
+# labels and events). Must match the gateway setting.
+dataPlane = 'om2m'
+# MQTT address and topic prefix for sample buffers ('mqtt' data plane)
+brokerAddress = '127.0.0.1'
+dataTopicPrefix = 'xware/data'
+# Ingestion: 'poll' (the Server polls OM2M for events and buffers) or 'mqtt'
+# (the Server receives the messages that gateways send to OM2M as they are
+# published on the broker, so it does not have to poll)
+ingestionMode = 'poll'
+# Maximum number of received messages waiting to be processed (MQTT)
+ingestQueueSize = 1000
+
+# Metrics: stage latencies, counters and backlogs are served in the Prometheus
+# text format on http://[metricsAddress]:[metricsPort]/metrics (0 = disabled)
+metricsPort = 0
+metricsAddress = '127.0.0.1'
+# Trace file: one line (span) per processing stage of every buffer, e.g.
+# 'C:/Users/User/XWare/logs/trace.jsonl' ('' = disabled)
+traceLocation = ''
+
+# Profiling: sample the stack of the Server every profileInterval seconds and
+# write flamegraph-ready collapsed stacks to profileLocation, one file every
+# profileDumpInterval seconds ('' = disabled)
+profileLocation = ''
+profileInterval = 0.005
+profileDumpInterval = 60
+
+# Device state: the current sampling index and the start times of pending
+# samplings of every device, kept in a ring of stateRingSize samplings per
+# device. It is saved to stateLocation every stateCheckpointInterval seconds
+# (and at exit), so that a restarted Server resumes pending samplings and
+# keeps the OM2M data of known devices ('' = not saved)
+stateLocation = logLocation + '/state.txt'
+stateRingSize = 16
+stateCheckpointInterval = 10
+
+# Ingestion journal: every START, output file and OM2M delete is logged to
+# journalLocation before it is acted on, and CSV files are written as .part
+# files that are renamed once complete. After a crash, the Server finishes or
+# redoes the samplings that were in flight, so that each CSV file is written
+# exactly once and never left truncated ('' = disabled)
+journalLocation = logLocation + '/journal.txt'
+# Set to 1 to fsync every journal line (slower, survives power cuts)
+journalSync = 0
+
+# Encoder workers: whole buffers are converted to CSV (and summarised) by this
+# many worker processes, so several devices are encoded at once and polling
+# does not stop while a buffer is written. Their OM2M message is deleted once
+# the CSV is complete. Needs a platform that can fork processes (e.g. Linux);
+# elsewhere, or with 0, buffers are encoded by the Server process
+encoderWorkers = 0
+
+# A whole buffer that cannot be written (e.g. a malformed value) is handed
+# again up to this many times, then its values are moved aside to
+# [file name].failed in csvLocation and the device goes on with its next
+# sampling
+maxBufferRetries = 3
+
 
 
 # ==================================================================
@@ -61,172 +168,730 @@
 # SET UP FLAGS AND VARIABLES
 
 # Variables
-startTimers = {}
+reassembler = ChunkReassembler()
+# Failed attempts of the buffers being retried, by (device, index)
+bufferFailures = {}
+
+# Feature extraction library (only needed, with NumPy, if enabled)
+if extractFeatures:
+    from xware_lib_features import *
 
 #====================
 # Check for directory existance and start LOG
 if not(os.path.isdir(csvLocation)):
     os.mkdir(csvLocation)
 
+if not(os.path.isdir(summaryLocation)):
+    os.mkdir(summaryLocation)
+
 if not(os.path.isdir(logLocation)):
     os.mkdir(logLocation)
 fullLogLoc = logLocation + '/' + 'log.txt'
 fullTimerLoc = logLocation + '/' + 'timer.txt'
 printAndLog('deviceName\tFlight\tCSV ',fullTimerLoc)
+fullJitterLoc = logLocation + '/' + 'jitter.txt'
+fullCycleLoc = logLocation + '/' + 'cycles.txt'
 
 printAndLog('gateway is active',fullLogLoc)
 
+# Device states (warm start from the last checkpoint, if any)
+deviceStates = DeviceStateStore(stateLocation,stateRingSize,stateCheckpointInterval)
+
+# Ingestion journal: finish the samplings that were in flight at the last stop
+journal = IngestJournal(journalLocation,journalSync)
+resumedChunks = []
+for deviceName, index, fileName, chunked, done, messageName, nextSeq, currentTime, size in journal.recover(deviceStates):
+    partPath = csvLocation + '/' + fileName + '.part'
+    if done:
+        # Output complete: only its message is left to delete
+        if messageName:
+            deleteMessageREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName,containerName,messageName)
+    elif chunked and nextSeq and os.path.isfile(partPath) and deviceStates.get(deviceName).hasStart(index):
+        # Earlier chunks were already deleted: go on from the last one written
+        # (see RESUME CHUNKED SAMPLINGS)
+        resumedChunks.append((deviceName, index, fileName, nextSeq, currentTime, size))
+        continue
+    elif chunked and nextSeq:
+        printAndLog(deviceName + ' sampling ' + str(index) + ' is incomplete: ' + partPath,fullLogLoc)
+    else:
+        # The buffer (or first chunk) is still in OM2M and will be written again
+        if os.path.isfile(partPath):
+            os.remove(partPath)
+    journal.end(deviceName,index)
+journal.compact(deviceStates,1)
+if len(deviceStates):
+    printAndLog('Resuming ' + str(len(deviceStates)) + ' devices from ' + stateLocation,fullLogLoc)
+
+# Encoder workers (started before any other thread)
+encoder = None
+if encoderWorkers and encoderPoolAvailable:
+    encoder = EncoderPool(encoderWorkers)
+    metrics.setFunction('xware_queue_depth',lambda: len(encoder),queue='encoder',unit='buffers')
+elif encoderWorkers:
+    printAndLog('Encoder workers need a platform that can fork processes, buffers are encoded by the Server',fullLogLoc)
+
+# Metrics endpoint and trace file
+if metricsPort:
+    metrics.startHTTP(metricsPort,metricsAddress)
+if traceLocation:
+    metrics.enableTracing(traceLocation)
+
+# Profiler (only the thread that processes buffers)
+if profileLocation:
+    profiler = SamplingProfiler(profileLocation,'server',profileInterval,profileDumpInterval,
+                                [threading.current_thread().name])
+    profiler.start()
+
+#====================
+# PROCESS AN EVENT MESSAGE
+# Returns 1 if the message was handled and can be deleted from OM2M
+
+def processEvent(deviceName,messageText):
+    if messageText[:5] == 'START':
+        # Extract message contents
+        oldMessage = messageText.splitlines()
+        index = int(oldMessage[2])
+        # Store in dictio
+        # (STARTs that a gateway stored while offline carry their own start time)
+        if len(oldMessage) > 3:
+            startTime = float(oldMessage[3])
+        else:
+            startTime = time.time()
+        # (a repeated START, e.g. one that was not deleted before a restart,
+        # keeps the first start time, and so the same CSV file name)
+        state = deviceStates.get(deviceName)
+        # (a gateway that restarted counts its samplings from 1 again)
+        if state.isRestart(index):
+            printAndLog(deviceName + ' restarted at sampling ' + str(index) + ' (last sampling written: ' +
+                        str(state.currentIndex) + ')',fullLogLoc)
+            state.restart(index)
+            journal.restart(deviceName,index)
+            deviceStates.checkpoint(1)
+        if not(index > state.currentIndex and state.hasStart(index)):
+            state.setStart(index,startTime)
+            journal.start(deviceName,index,startTime)
+        # Talkback to device
+        newMessage = 'TIMERBEGIN\n'+deviceName+'\n'+str(index)
+        createMessageREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName,eventsContName,newMessage)
+        return 1
+    elif messageText[:5] == 'STATS':
+        # Log the sampling jitter statistics of the device
+        oldMessage = messageText.splitlines()
+        stats = textToStats(oldMessage[3])
+        writeLineToFile(fullJitterLoc, deviceName + '\t' + oldMessage[2] + '\t' + oldMessage[3] + '\n')
+        if stats['missedDeadlines'] > 0:
+            printAndLog(deviceName + ' missed ' + str(int(stats['missedDeadlines'])) + ' sample deadlines',fullLogLoc)
+        return 1
+    elif messageText[:5] == 'CYCLE':
+        # Log the acquisition cycle summary of the device
+        oldMessage = messageText.splitlines()
+        writeLineToFile(fullCycleLoc, unixToDateString(time.time(),precision=3) + '\t' + deviceName + '\t' + oldMessage[3] + '\n')
+        return 1
+    return 0
+
+
+#====================
+# CHECK IF THE VALUES OF A DEVICE CAN BE COPIED AS THEY ARE
+# (no conversion, and sent with valuePrecision decimals)
+
+def isPassThrough(labels):
+    return bool(passThroughValues) and float(labels['ValueConversion']) == 1 and \
+           labels.get('Precision') == str(valuePrecision)
+
+
+#====================
+# PROCESS A WHOLE SAMPLING
+# Returns 0 (and does nothing) if the START of the sampling is still unknown
+# (or the previous buffer of the device is still being encoded), 1 once the
+# CSV is written, or 2 if it was handed to the encoder workers (its message
+# is then deleted by finishBuffer)
+# messageName: OM2M name of the message (None if it was not stored in OM2M)
+
+def processBuffer(deviceName,messageText,messageName=None):
+    # Wait until the START of the next sampling has been received
+    state = deviceStates.get(deviceName)
+    if not(state.hasStart(state.currentIndex+1)) or (encoder is not None and encoder.busy(deviceName)):
+        return 0
+    trace = deviceName + '/' + str(state.currentIndex+1)
+
+    # Read metadata of this device
+    with metrics.stage('labels',trace,device=deviceName):
+        labels = readApplicationLabelsREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName)
+    F = float(labels['Frequency[Hz]'])
+    valueConversion = float(labels['ValueConversion'])
+    deviceTag = labels['Device']
+    sensorTag = labels['Sensor']
+
+    # ===== Get start time =====
+    index = state.currentIndex+1
+    startTime = state.startTime(index)
+    print(startTime)
+
+    # Flight time
+    timerFlight = time.time() - startTime
+
+    # Set time delta
+    deltaTime = 1/F
+
+    # File name for new CSV
+    fileName = csvFileName(deviceName,startTime)
+
+    # Separte sensor tags (if there are multiple)
+    sensorTagList = sensorTag.split(',')
+
+    # Copy the values as they are, if they need no conversion
+    passThrough = isPassThrough(labels)
+
+    # Hand the buffer to the encoder workers
+    journal.begin(deviceName,index,fileName)
+    if encoder is not None:
+        summaryOptions = None
+        if extractFeatures:
+            summaryOptions = (summaryLocation,fileName,deviceName,startTime,F,deviceTag,sensorTagList,
+                              featureWindow,featureBands,decimationFactor,timePrecision,valuePrecision)
+        context = {'deviceName': deviceName, 'index': index, 'messageName': messageName,
+                   'startTime': startTime, 'timerFlight': timerFlight, 'fileName': fileName,
+                   'messageText': messageText}
+        encoder.submit(deviceName,messageText,context,csvLocation + '/' + fileName,startTime,deltaTime,
+                       deviceTag,sensorTagList,valueConversion,timePrecision,valuePrecision,summaryOptions,passThrough)
+        return 2
+
+    with metrics.stage('decode',trace,device=deviceName):
+        valueBuffer = messageText.splitlines()
+
+    try:
+        # Create new CSV (renamed once complete)
+        file = open(csvLocation + '/' + fileName + '.part', 'w')
+        try:
+            file.write('ID,,,\n')
+
+            # ==============
+            # Create each CSV line
+            with metrics.stage('write',trace,device=deviceName):
+                writeCsvBuffer(file,valueBuffer,startTime,0,deltaTime,deviceTag,sensorTagList,valueConversion,
+                               timePrecision,valuePrecision,passThrough)
+        finally:
+            # End CSV
+            file.close()
+        os.replace(csvLocation + '/' + fileName + '.part', csvLocation + '/' + fileName)
+    except Exception as error:
+        return bufferFailed(deviceName,index,fileName,messageName,messageText,error)
+
+    # Features and decimated samples
+    if extractFeatures:
+        summary = SamplingSummary(summaryLocation,fileName,deviceName,startTime,F,deviceTag,sensorTagList,
+                                  featureWindow,featureBands,decimationFactor,timePrecision,valuePrecision)
+        summary.add(valueBuffer,valueConversion)
+        summary.close()
+    bufferWritten(deviceName,index,messageName,startTime,timerFlight,len(valueBuffer),len(messageText))
+    return 1
+
+
+#====================
+# A WHOLE SAMPLING WAS WRITTEN
+# Update current index for this device, journal it and print timers
+
+def bufferWritten(deviceName,index,messageName,startTime,timerFlight,samples,messageBytes):
+    deviceStates.get(deviceName).advance(index)
+    journal.done(deviceName,index,messageName)
+    bufferFailures.pop((deviceName,index),None)
+    metrics.inc('xware_buffers_total',device=deviceName,direction='received')
+    metrics.inc('xware_samples_total',samples,device=deviceName,direction='received')
+    metrics.inc('xware_bytes_total',messageBytes,device=deviceName,direction='received')
+    printAndLog(deviceName + ' CSV file created',fullLogLoc)
+
+    # CSVTime
+    timerCSV = time.time() - startTime
+
+    # Print timers
+    timerString = deviceName + '\t' + str(timerFlight) + \
+                  '\t' + str(timerCSV)
+    printAndLog(timerString,fullTimerLoc)
+
+
+#====================
+# A WHOLE SAMPLING COULD NOT BE WRITTEN
+# Returns 0 while it is to be handed again (its message stays in OM2M), or 1
+# once maxBufferRetries attempts have failed: its values are then moved to
+# [file name].failed and the device goes on with its next sampling (the
+# message can be deleted)
+
+def bufferFailed(deviceName,index,fileName,messageName,messageText,error):
+    partPath = csvLocation + '/' + fileName + '.part'
+    if os.path.exists(partPath):
+        os.remove(partPath)
+    failures = bufferFailures.get((deviceName,index),0) + 1
+    printAndLog(deviceName + ' sampling ' + str(index) + ' could not be written (attempt ' + str(failures) +
+                '): ' + repr(error),fullLogLoc)
+    if failures <= maxBufferRetries:
+        bufferFailures[(deviceName,index)] = failures
+        journal.end(deviceName,index)
+        return 0
+    bufferFailures.pop((deviceName,index),None)
+    with open(csvLocation + '/' + fileName + '.failed', 'w') as file:
+        file.write(messageText)
+    printAndLog(deviceName + ' sampling ' + str(index) + ' moved to ' + fileName + '.failed',fullLogLoc)
+    deviceStates.get(deviceName).advance(index)
+    journal.done(deviceName,index,messageName)
+    return 1
+
+
+#====================
+# FINISH THE SAMPLINGS WRITTEN BY THE ENCODER WORKERS
+# (and delete their OM2M message)
+# A buffer that could not be written is handed again in the next cycle (see
+# bufferFailed)
+
+def finishBuffers():
+    for context, future in encoder.completed():
+        deviceName = context['deviceName']
+        index = context['index']
+        messageName = context['messageName']
+        try:
+            samples, writeTime = future.result()
+        except Exception as error:
+            if not(bufferFailed(deviceName,index,context['fileName'],messageName,context['messageText'],error)):
+                listing = dataListings.get(deviceName)
+                if ingestionMode == 'poll' and dataPlane == 'om2m' and messageName and listing is not None:
+                    listing.retry([messageName])
+                else:
+                    heldMessages.insert(0,(containerName, deviceName, messageName, context['messageText']))
+                continue
+        else:
+            metrics.observe('xware_stage_seconds',writeTime,stage='write',device=deviceName)
+            bufferWritten(deviceName,index,messageName,context['startTime'],
+                          context['timerFlight'],samples,len(context['messageText']))
+        if messageName:
+            with metrics.stage('delete',device=deviceName):
+                deleteMessageREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName,containerName,messageName)
+        journal.endDevice(deviceName)
+
+
+#====================
+# STATE OF A CHUNKED SAMPLING BEING WRITTEN
+# labels: OM2M labels of the device
+# currentTime: relative time of the next sample [s]
+
+def chunkContext(labels,file,fileName,startTime,currentTime):
+    return {'file': file, 'fileName': fileName, 'startTime': startTime, 'currentTime': currentTime,
+            'timerFlight': time.time() - startTime,
+            'deltaTime': 1/float(labels['Frequency[Hz]']),
+            'valueConversion': float(labels['ValueConversion']),
+            'deviceTag': labels['Device'],
+            'sensorTagList': labels['Sensor'].split(','),
+            'passThrough': isPassThrough(labels),
+            'summary': None}
+
+
+#====================
+# DELETE THE OM2M MESSAGES OF CHUNKS THAT WERE HELD, ONCE THEY ARE WRITTEN
+
+def deleteHeldChunks(deviceName,messageNames):
+    for messageName in messageNames:
+        if messageName:
+            with metrics.stage('delete',device=deviceName):
+                deleteMessageREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName,containerName,messageName)
+
+
+#====================
+# PROCESS A CHUNK OF A SAMPLING
+# Each chunk is written to the CSV of its sampling as soon as it is in order
+# Returns 0 (and does nothing) if the START of its sampling is still unknown,
+# 1 once it is written (its message can be deleted), or 2 if it is held until
+# the chunks before it arrive (its message is then deleted by processChunk,
+# once it is written, so a restarted Server reads it again)
+# messageName: OM2M name of the message (None if it was not stored in OM2M)
+
+def processChunk(deviceName,messageText,messageName=None):
+    index, seq, final, valueBuffer = parseChunkMessage(messageText)
+    state = deviceStates.get(deviceName)
+    # (chunk of a sampling already written, whose message was not deleted)
+    if index <= state.currentIndex:
+        return 1
+    if not(state.hasStart(index)):
+        return 0
+    trace = deviceName + '/' + str(index)
+    with metrics.stage('decode',trace,device=deviceName):
+        stream, ready = reassembler.add((deviceName,index),seq,final,valueBuffer,messageName)
+    metrics.inc('xware_buffers_total',device=deviceName,direction='received')
+    metrics.inc('xware_samples_total',len(valueBuffer),device=deviceName,direction='received')
+    metrics.inc('xware_bytes_total',len(messageText),device=deviceName,direction='received')
+    if not(ready):
+        # (a chunk received twice is only deleted)
+        return 2 if seq in stream.pending else 1
+
+    # First chunk: read metadata and create the CSV
+    if ready and stream.context is None:
+        with metrics.stage('labels',trace,device=deviceName):
+            labels = readApplicationLabelsREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName)
+        startTime = state.startTime(index)
+        fileName = csvFileName(deviceName,startTime)
+        journal.begin(deviceName,index,fileName,1)
+        file = open(csvLocation + '/' + fileName + '.part', 'w')
+        file.write('ID,,,\n')
+        stream.context = chunkContext(labels,file,fileName,startTime,0)
+        if extractFeatures:
+            stream.context['summary'] = SamplingSummary(summaryLocation,fileName,deviceName,startTime,
+                                                        float(labels['Frequency[Hz]']),labels['Device'],
+                                                        stream.context['sensorTagList'],featureWindow,featureBands,
+                                                        decimationFactor,timePrecision,valuePrecision)
+
+    # Write the chunks that are now in order
+    context = stream.context
+    for valueBuffer in ready:
+        with metrics.stage('write',trace,device=deviceName):
+            context['currentTime'] = writeCsvBuffer(context['file'],valueBuffer,context['startTime'],context['currentTime'],
+                                                    context['deltaTime'],context['deviceTag'],context['sensorTagList'],
+                                                    context['valueConversion'],timePrecision,valuePrecision,
+                                                    context['passThrough'])
+        if context['summary']:
+            context['summary'].add(valueBuffer,context['valueConversion'])
+
+    # Journal the chunks written so far (a restarted Server goes on from here)
+    if ready and not(stream.done):
+        context['file'].flush()
+        journal.chunk(deviceName,index,stream.nextSeq,context['currentTime'],context['file'].tell())
+        deleteHeldChunks(deviceName,stream.readyTags[1:])
+
+    # Last chunk: end CSV
+    if stream.done:
+        context['file'].close()
+        os.replace(csvLocation + '/' + context['fileName'] + '.part', csvLocation + '/' + context['fileName'])
+        if context['summary']:
+            context['summary'].close()
+        reassembler.close((deviceName,index))
+        state.advance(index)
+        journal.done(deviceName,index,messageName)
+        deleteHeldChunks(deviceName,stream.readyTags[1:])
+        printAndLog(deviceName + ' CSV file created',fullLogLoc)
+        timerCSV = time.time() - context['startTime']
+        timerString = deviceName + '\t' + str(context['timerFlight']) + \
+                      '\t' + str(timerCSV)
+        printAndLog(timerString,fullTimerLoc)
+    return 1
+
+
+#====================
+# PROCESS THE FEATURES OF A SAMPLING ('features' edge mode)
+# Rows are appended to [device name]_edge_features.csv in summaryLocation
+# Returns 0 (and does nothing) if the START of its sampling is still unknown
+# messageName: OM2M name of the message (None if it was not stored in OM2M)
+
+def processFeatures(deviceName,messageText,messageName=None):
+    index, tripped, score, names, rows = parseFeatureMessage(messageText)
+    state = deviceStates.get(deviceName)
+    if not(state.hasStart(index)):
+        return 0
+    startTime = state.startTime(index)
+    featuresPath = summaryLocation + '/' + deviceName + '_edge_features.csv'
+    newFile = not(os.path.isfile(featuresPath))
+    lines = []
+    if newFile:
+        lines.append(','.join(['time', 'device', 'sensor', 'tripped', 'score'] + names) + '\n')
+    for offset, sensorTag, values in rows:
+        timeUnix = preciseUnixTime(startTime,0,offset,timePrecision,string=1)
+        timeStr = unixToDateString(float(timeUnix),precision=timePrecision)
+        lines.append(timeStr + ',' + deviceName + ',' + sensorTag + ',' + str(tripped) + ',' + str(score) + ',' + ','.join(values) + '\n')
+    with open(featuresPath, 'a') as file:
+        file.write(''.join(lines))
+    state.advance(index)
+    journal.done(deviceName,index,messageName)
+    if tripped:
+        printAndLog(deviceName + ' anomaly detected in sampling ' + str(index) + ' (score ' + str(score) + ')',fullLogLoc)
+    return 1
+
+
+#====================
+# RESUME CHUNKED SAMPLINGS
+# Chunked samplings that were being written at the last stop go on from their
+# last journaled chunk: the .part file is cut back to its size then, and the
+# chunks after it are still in OM2M (features and decimated samples are not
+# written for these samplings)
+for deviceName, index, fileName, nextSeq, currentTime, size in resumedChunks:
+    partPath = csvLocation + '/' + fileName + '.part'
+    labels = readApplicationLabelsREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName)
+    if not(labels):
+        printAndLog(deviceName + ' sampling ' + str(index) + ' is incomplete: ' + partPath,fullLogLoc)
+        journal.end(deviceName,index)
+        continue
+    os.truncate(partPath,size)
+    stream = reassembler.resume((deviceName,index),nextSeq)
+    stream.context = chunkContext(labels,open(partPath, 'a'),fileName,
+                                  deviceStates.get(deviceName).startTime(index),currentTime)
+    printAndLog(deviceName + ' sampling ' + str(index) + ' resumed from chunk ' + str(nextSeq),fullLogLoc)
+
+
+#====================
+# MQTT INGESTION
+# Messages pushed by the broker wait in a bounded queue until the main loop
+# processes them (the MQTT network thread blocks while the queue is full).
+# Each item is (container name, device name, OM2M message name, text); the
+# message name is None for buffers that were never stored in OM2M.
+
+# * 'mqtt' data plane: gateways publish buffers to dataTopicPrefix/[device]
+# * 'mqtt' ingestion: the Server listens to the requests that gateways send to
+#   OM2M. Each create request is paired with the OM2M response (same
+#   originator and rqi) to learn the name given to the new message, so that it
+#   can be deleted once it has been processed.
+
+ingestQueue = queue.Queue(ingestQueueSize)
+pendingCreates = {}
+heldMessages = []
+metrics.setFunction('xware_queue_depth',ingestQueue.qsize,queue='ingest',unit='messages')
+metrics.setFunction('xware_queue_depth',lambda: len(heldMessages),queue='held',unit='messages')
+
+def onMessageServerMQTT(client, userdata, msg):
+    topic = msg.topic.split('/')
+    # Sample buffer published straight to the Server
+    if msg.topic.startswith(dataTopicPrefix + '/'):
+        ingestQueue.put((containerName, topic[-1], None, str(msg.payload, 'utf-8')))
+        return
+    try:
+        obj = jsonLoads(msg.payload)
+    except ValueError:
+        return
+    # Request from a gateway: remember the messages it creates
+    if 'm2m:rqp' in obj:
+        request = obj['m2m:rqp']
+        if request.get('m2m:op') == '1' and request.get('m2m:ty') == '4':
+            target = request['m2m:to'].split('/')
+            text = request['m2m:pc']['m2m:cin']['con']
+            pendingCreates.setdefault((topic[3], request['m2m:rqi']), []).append((target[-1], target[-2], text))
+    # Response from OM2M: the message has been created, hand it to the main loop
+    elif 'm2m:rsp' in obj:
+        response = obj['m2m:rsp']
+        created = pendingCreates.get((topic[4], response.get('m2m:rqi')))
+        if created:
+            container, deviceName, text = created.pop(0)
+            if not(created):
+                del pendingCreates[(topic[4], response.get('m2m:rqi'))]
+            try:
+                messageName = response['m2m:pc']['m2m:cin']['rn']
+            except (KeyError, TypeError):
+                return
+            ingestQueue.put((container, deviceName, messageName, text))
+
+def onConnectServerMQTT(client, userdata, flags, rc):
+    if dataPlane == 'mqtt':
+        client.subscribe(dataTopic(dataTopicPrefix,'+'))
+    if ingestionMode == 'mqtt':
+        client.subscribe('/oneM2M/req/+/'+serverCSE+'/json')
+        client.subscribe('/oneM2M/resp/'+serverCSE+'/+/json')
+
+if dataPlane == 'mqtt' or ingestionMode == 'mqtt':
+    client = mqtt.Client('xware_server')
+    client.on_message = onMessageServerMQTT
+    client.on_connect = onConnectServerMQTT
+    client.connect_async(brokerAddress)
+    client.loop_start()
+
+
+#====================
+# OLD OM2M DATA CLEANUP
+cleaner = OM2MCleaner(authOM2M,ipOM2M,serverCSE,serverName,cleanupWorkers,
+                      log=lambda text: printAndLog(text,fullLogLoc))
+
+
+#====================
+# CHECK OM2M CONTAINER LIMITS
+# Containers without limits are skipped
+warnedContainers = set()
+
+def checkContainers():
+    for deviceName in list(deviceStates.states):
+        for container in (containerName, eventsContName):
+            attributes = readContainerREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName,container)
+            for limit, count, maximum in (('messages', 'cni', 'mni'), ('bytes', 'cbs', 'mbs')):
+                if not(attributes.get(maximum)):
+                    continue
+                ratio = attributes.get(count, 0) / attributes[maximum]
+                metrics.set('xware_container_fill_ratio',ratio,device=deviceName,container=container,limit=limit)
+                key = (deviceName, container, limit)
+                if ratio >= containerWarnLevel and not(key in warnedContainers):
+                    warnedContainers.add(key)
+                    printAndLog(deviceName + '/' + container + ' is ' + str(round(100*ratio)) + '% full (' +
+                                str(attributes.get(count, 0)) + ' of ' + str(attributes[maximum]) + ' ' + limit +
+                                '), OM2M will drop the oldest messages',fullLogLoc)
+                elif ratio < containerWarnLevel:
+                    warnedContainers.discard(key)
+
+
 #====================
 # BEGIN CYCLING
 
 # Indicate first cycle (to delete old apps)
 starting = 1
-
-# Start buffers
-valueBuffer = []
+# Messages already seen in the containers of every device
+eventListings = {}
+dataListings = {}
+lastContainerCheck = time.time()
 
 while 1:
 
     # Get URL list of devices
-    applicationListUrl = listApplicationsREST(authOM2M,ipOM2M,serverCSE,serverName)
-    # Get device names from url's
-    devicesList = lastUrlItem(applicationListUrl)
-    # Number of devices
-    numOfDevices = len(devicesList)
-
+    # (with 'mqtt' ingestion, devices are found through their messages)
+    if starting or ingestionMode == 'poll':
+        with metrics.stage('discover'):
+            applicationListUrl = listApplicationsREST(authOM2M,ipOM2M,serverCSE,serverName)
+        # Get device names from url's
+        devicesList = lastUrlItem(applicationListUrl)
+    else:
+        devicesList = []
     # If starting, prompt to delete old apps
+    # (except those of the devices resumed from the state file)
     if starting:
-        if numOfDevices > 0:
+        oldDevices = [deviceName for deviceName in devicesList if not(deviceName in deviceStates)]
+        if len(oldDevices) > 0:
             input('Press Return to delete old OM2M data and continue.')
-            for deviceName in devicesList:
-                deleteApplicationREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName)
-            print('Old data removed! You may start XWare (gateway) in your device(s).')
+            if cleanupInBackground:
+                cleaner.start(oldDevices)
+                print('Old data is being removed in the background. You may start XWare (gateway) in new devices.')
+            else:
+                cleaner.run(oldDevices)
+                print('Old data removed! You may start XWare (gateway) in your device(s).')
             print('')
         devicesList = []
         starting = 0
 
-    # Create dictionary entry for devices if necessary
-    for deviceName in devicesList:
-        if not(deviceName in startTimers):
-            startTimers[deviceName] = {'currentIndex':0}
-
-    # Cycle through devices in list
+    # Cycle through devices in list (except those being cleaned up)
     for deviceName in devicesList:
+        if cleaner.isPending(deviceName):
+            continue
 
         #====================
         # CHECK FOR RECEIVED EVENTS
 
-        # Get messages list
-        messageListUrl = listMessagesREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName,eventsContName)
-        messageList = lastUrlItem(messageListUrl)
+        # Get the messages that were not seen yet
+        # (messages that are not handled here, e.g. TIMER answers, stay in
+        # OM2M but are only read once)
+        with metrics.stage('list',device=deviceName):
+            messageListUrl = listMessagesREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName,eventsContName)
+        messageList = eventListings.setdefault(deviceName,DiscoveryListing()).update(messageListUrl)
 
         # Check if there are messages
         for messageName in messageList:
             # Process each message
-            messageText = getMessageREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName,eventsContName,messageName)
-            if messageText[:5] == 'START':
+            with metrics.stage('fetch',device=deviceName):
+                messageText = getMessageREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName,eventsContName,messageName)
+            if processEvent(deviceName,messageText):
                 # Delete message from OM2M
-                deleteMessageREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName,eventsContName,messageName)
-                # Extract message contents
-                oldMessage = messageText.splitlines()
-                index = int(oldMessage[2])
-                # Store in dictio
-                startTimers[deviceName][index] = time.time()
-                # Talkback to device
-                newMessage = 'TIMERBEGIN\n'+deviceName+'\n'+str(index)
-                createMessageREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName,eventsContName,newMessage)
+                with metrics.stage('delete',device=deviceName):
+                    deleteMessageREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName,eventsContName,messageName)
 
         #====================
         # CHECK FOR RECEIVED VALUES
 
-        # Get messages list
-        messageListUrl = listMessagesREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName,containerName)
-        messageList = lastUrlItem(messageListUrl)
+        # Get the messages that were not handed here yet (with the 'mqtt' data
+        # plane, values arrive by MQTT)
+        messageList = []
+        if dataPlane == 'om2m':
+            listing = dataListings.setdefault(deviceName,DiscoveryListing())
+            with metrics.stage('list',device=deviceName):
+                messageListUrl = listMessagesREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName,containerName)
+            messageList = listing.update(messageListUrl)
+            metrics.set('xware_backlog_messages',len(listing),device=deviceName)
 
         # Check if there are pending messages
-        if messageList:
-
-            # Grab the first message in the list!
-            messageName = messageList[0]
+        # (the ones left when the loop stops are handed again next time)
+        for position, messageName in enumerate(messageList):
 
             # Download message contents from OM2M
-            valueBuffer = getMessageREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName,containerName,messageName).splitlines()
-
-            # Read metadata of this device
-            labels = readApplicationLabelsREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName)
-            F = float(labels['Frequency[Hz]'])
-            valueConversion = float(labels['ValueConversion'])
-            deviceTag = labels['Device']
-            sensorTag = labels['Sensor']
-
-            # ===== Get start time =====
-            # Update current index for this device
-            startTimers[deviceName]['currentIndex'] += 1
-            currentIndex = startTimers[deviceName]['currentIndex']
-            startTime = startTimers[deviceName][currentIndex]
-            print(startTime)
-
-            # Flight time
-            timerFlight = time.time() - startTime
-
-            # Set time delta
-            deltaTime = 1/F
-
-            # Start time counter
-            currentTime = 0
-
-            # File name for new CSV
-            dateStr = time.strftime('%Y%m%dT%H%M%S',time.localtime(startTime))
-            decimalsStr = str(int((startTime-int(startTime))*(10**2)))
-            fileName = deviceName + '_' + dateStr + decimalsStr + '.csv'
-
-            # Create new CSV
-            file = open(csvLocation + '/' + fileName, 'w')
-            file.write('ID,,,\n')
-
-            # Separte sensor tags (if there are multiple)
-            sensorTagList = sensorTag.split(',')
-
-            # ==============
-            # Create each CSV line
-            for valueStrRaw in valueBuffer:
-                # Create time for this measurement
-                timeUnix = preciseUnixTime(startTime,0,currentTime,timePrecision,string=1)
-                # Separate values (if there are multiple)
-                valueStringList = valueStrRaw.split(',')
-                # Convert values to numbers, considering the conversion factor
-                valueListConverted = []
-                for singleValue in valueStringList:
-                    valueListConverted.append(float(singleValue)*valueConversion)
-                # Check that the length of the sensor tag list and sensor values is the same
-                if len(sensorTagList) != len(valueListConverted):
-                    print("Error: There are " + str(len(sensorTagList)) + "sensor tags but only " + len(valueListConverted) + "values.")
-                # Cycle through the different tags and values, and save to csv
-                for singleTag, singleValue in zip(sensorTagList, valueListConverted):
-                    # Join everything into one text
-                    csvLine = csvFormatLine(timeUnix,deviceTag,singleTag,singleValue,valuePrecision)
-                    # Write text to file
-                    file.write(csvLine)
-                # Update time
-                currentTime += deltaTime
-
-            # End CSV
-            file.close()
-            printAndLog(deviceName + ' CSV file created',fullLogLoc)
-
-            # CSVTime
-            timerCSV = time.time() - startTime
-
-            # Print timers
-            timerString = deviceName + '\t' + str(timerFlight) + \
-                          '\t' + str(timerCSV)
-            printAndLog(timerString,fullTimerLoc)
-
-            # CLEAR gateway local buffer
-            valueBuffer = []
-
-            # CLEAR gateway OM2M buffer
-            deleteMessageREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName,containerName,messageName)
+            with metrics.stage('fetch',device=deviceName):
+                messageText = getMessageREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName,containerName,messageName)
+
+            # Chunk of a sampling: write it as soon as it is in order
+            if isChunkMessage(messageText):
+                processed = processChunk(deviceName,messageText,messageName)
+                if not(processed):
+                    listing.retry(messageList[position:])
+                    break
+                # CLEAR gateway OM2M buffer
+                # (a chunk held until the ones before it arrive is deleted once written)
+                if processed == 1:
+                    with metrics.stage('delete',device=deviceName):
+                        deleteMessageREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName,containerName,messageName)
+                    journal.endDevice(deviceName)
+                continue
+
+            # Features of a sampling (gateway in 'features' edge mode)
+            if isFeatureMessage(messageText):
+                if not(processFeatures(deviceName,messageText,messageName)):
+                    listing.retry(messageList[position:])
+                    break
+                with metrics.stage('delete',device=deviceName):
+                    deleteMessageREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName,containerName,messageName)
+                journal.endDevice(deviceName)
+                continue
+
+            # Whole sampling (only the first one in the list is processed;
+            # a buffer handed to the encoder workers is deleted once written)
+            processed = processBuffer(deviceName,messageText,messageName)
+            if processed == 1:
+                # CLEAR gateway OM2M buffer
+                with metrics.stage('delete',device=deviceName):
+                    deleteMessageREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName,containerName,messageName)
+                journal.endDevice(deviceName)
+            if processed:
+                listing.retry(messageList[position+1:])
+            else:
+                listing.retry(messageList[position:])
+            break
+
+    #====================
+    # CHECK FOR MESSAGES RECEIVED BY MQTT
+    # (values whose START is not known yet are kept for later, in order)
+    pendingMessages = heldMessages
+    heldMessages = []
+    while not(ingestQueue.empty()):
+        pendingMessages.append(ingestQueue.get_nowait())
+    for container, deviceName, messageName, messageText in pendingMessages:
+        if cleaner.isPending(deviceName):
+            heldMessages.append((container, deviceName, messageName, messageText))
+            continue
+        if container == eventsContName:
+            processed = processEvent(deviceName,messageText)
+            if not(processed):
+                continue
+        elif any([held[1] == deviceName for held in heldMessages]):
+            processed = 0
+        elif isChunkMessage(messageText):
+            processed = processChunk(deviceName,messageText,messageName)
+        elif isFeatureMessage(messageText):
+            processed = processFeatures(deviceName,messageText,messageName)
+        else:
+            processed = processBuffer(deviceName,messageText,messageName)
+        if not(processed):
+            heldMessages.append((container, deviceName, messageName, messageText))
+            continue
+        if processed == 2:
+            # Deleted once the encoder workers (or processChunk) have written it
+            continue
+        if messageName:
+            with metrics.stage('delete',device=deviceName):
+                deleteMessageREST(authOM2M,ipOM2M,serverCSE,serverName,deviceName,container,messageName)
+        if container != eventsContName:
+            journal.endDevice(deviceName)
+
+    # Finish the buffers written by the encoder workers
+    if encoder is not None:
+        finishBuffers()
+
+    # Save the device states (every stateCheckpointInterval seconds) and
+    # compact the journal
+    deviceStates.checkpoint()
+    journal.compact(deviceStates)
+
+    # Check the fill level of the OM2M containers
+    if containerCheckInterval and time.time() - lastContainerCheck >= containerCheckInterval:
+        lastContainerCheck = time.time()
+        checkContainers()
 
     # Let the program breathe!
-    time.sleep(waitTime)
+    # (with 'mqtt' ingestion, wake up as soon as a message arrives)
+    if ingestionMode == 'mqtt':
+        try:
+            heldMessages.append(ingestQueue.get(timeout=waitTime))
+        except queue.Empty:
+            pass
+    else:
+        time.sleep(waitTime)
@@ -0,0 +1,136 @@
+# Fleet simulator: hundreds of virtual gateway devices in a few processes
+# See Github repo (github.com/d-sanchezl/xware) for license details
+
+# This code emulates a whole plant to load-test the XWare Server. Each virtual
+# device registers in OM2M, runs the START/TIMER handshake and sends its
+# buffers like a real gateway, through the configured broker, but replays the
+# samples of simulated input files (such as 'simulated_input.txt', found in
+# the repo) instead of reading sensors.
+
+# Devices are started following a ramp-up profile, and the achieved
+# throughput and handshake latency of the whole fleet are printed every
+# statsInterval seconds, and once more (for the whole run) at the end.
+
+# Make sure you review the "USER PARAMETERS" section before executing this
+# code. Requires NumPy.
+
+# Import necessary packages
+import json # To save the fleet report
+
+# Import xware libraries
+from xware_lib_fleet import *
+
+
+
+# ==================================================================
+# USER PARAMETERS:
+# Change these to your liking
+
+# MQTT address, change to target (server) IP address
+brokerAddress = '192.138.6.70'
+
+# Fleet identifier (start of the MQTT client names of the workers)
+fleetName = 'fleet_1'
+
+# Device groups
+# Devices are named [prefix]_1 to [prefix]_[count]. Any other GatewayDevice
+# parameter can be added by name (e.g. 'chunkSize': 200)
+deviceGroups = [
+    {'prefix': 'sim_motor', 'count': 200, 'F': 1000, 't': 1, 'T': 5,
+     'sensorTag': 'x_accel,y_accel,z_accel', 'valueConversion': 1/0.00989},
+    {'prefix': 'sim_pump', 'count': 50, 'F': 500, 't': 2, 'T': 10,
+     'sensorTag': 'pressure'},
+    ]
+
+# Folder with the simulated input files
+samplesLocation = "/home/pi/Documents/simulated_acquisition"
+
+# Ramp-up profile: 'instant' (all devices at once), 'linear' (evenly over
+# rampTime seconds) or 'step' (rampStepSize devices every rampStepTime seconds)
+rampProfile = 'linear'
+rampTime = 60
+rampStepSize = 25
+rampStepTime = 10
+
+# Time before the fleet stops [s] (0 = until Ctrl+C)
+runTime = 300
+
+# Set to 1 to wait for the operator before starting
+waitForOperator = 1
+
+
+# =================================
+# ADVANCED PARAMETERS:
+# Do not change these unless you know what you are doing
+
+# Worker processes (devices are dealt out to them in turn; each worker has one
+# MQTT connection). 0 runs all devices in this process
+processes = 4
+
+# Time between fleet statistics [s]
+statsInterval = 5
+
+# Time covered by each block of replayed samples [s]
+blockTime = 0.05
+
+# Set to 0 to show the progress messages of every device
+quiet = 1
+
+# OM2M names
+serverCSE = 'in-cse'
+serverName = 'in-name'
+containerName = 'sampling'
+eventsContName = 'events'
+authOM2M = 'admin:admin' # user:password
+
+# Time between message receipt verification
+waitTime = 0.1
+# Time between message sent retries
+retryWaitTime = 1
+# Maximum time to wait for OM2M before a device stops
+maxWaitTime = 6
+
+# Data plane: 'om2m' or 'mqtt'. Must match the Server setting.
+dataPlane = 'om2m'
+# MQTT topic prefix for sample buffers ('mqtt' data plane)
+dataTopicPrefix = 'xware/data'
+
+# Fleet statistics of the whole run are also saved to this JSON file
+# ('' = disabled)
+fleetReportLocation = 'xware_fleet_report.json'
+
+
+
+
+# ==================================================================
+# XWARE CODE
+
+# This is the XWare code.
+# You should not have to change anything beyond this point.
+
+# (worker processes may import this file again; only the main one runs it)
+if __name__ == '__main__':
+
+    #====================
+    # WAIT FOR OPERATOR INPUT
+    fleet = FleetSimulator(brokerAddress,fleetName,deviceGroups,samplesLocation,processes,
+                           rampProfile,rampTime,rampStepSize,rampStepTime,statsInterval,runTime,blockTime,quiet,
+                           serverCSE=serverCSE,serverName=serverName,containerName=containerName,
+                           eventsContName=eventsContName,authOM2M=authOM2M,waitTime=waitTime,
+                           retryWaitTime=retryWaitTime,maxWaitTime=maxWaitTime,
+                           dataPlane=dataPlane,dataTopicPrefix=dataTopicPrefix)
+    started, nominalRate = fleet.nominal(max(fleet.delays))
+    print('Fleet of ' + str(len(fleet.specs)) + ' devices, ' + str(round(nominalRate)) + ' samples/s at full load')
+    print('Ramp-up: ' + rampProfile + ', over ' + str(max(fleet.delays)) + ' s')
+    if waitForOperator:
+        print('Make sure that XWare Server is active before starting!')
+        input('Press Return to begin...')
+    print('')
+
+
+    #====================
+    # RUN FLEET
+    summary = fleet.run()
+    if fleetReportLocation:
+        with open(fleetReportLocation, 'w') as file:
+            json.dump(summary, file, indent=1)
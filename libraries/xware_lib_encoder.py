@@ -0,0 +1,129 @@
+# Encoder pool of the XWare Server: sample buffers converted to CSV in worker
+# processes
+# See Github repo (github.com/d-sanchezl/xware) for license details
+
+# Converting a buffer of thousands of samples to CSV lines is CPU-bound, and a
+# single Python process can only use one core for it. An EncoderPool hands
+# whole buffers to a pool of worker processes, so the Server keeps polling
+# OM2M (or reading MQTT messages) while they are written, and devices are
+# encoded in parallel.
+
+# submit() copies the text of the buffer once into a shared memory block (it
+# is not pickled through a pipe) and passes its name, with the metadata of
+# the sampling (start time, time delta, conversion, tags), to a worker. The
+# worker writes [file name].part, renames it once complete and, if asked to,
+# writes the features and decimated samples (xware_lib_features).
+# completed() returns the jobs that are done, with the context given to
+# submit(), so the Server can journal them and delete their OM2M message.
+
+# One buffer per key (device) is encoded at a time, so the files of a device
+# are written in order: check busy() before submitting.
+
+# Workers are forked, and started when the pool is created (before the
+# Server starts any thread). Where processes cannot be forked (Windows),
+# encoderPoolAvailable is False and the Server encodes buffers itself.
+
+# Usage:
+
+#encoder = EncoderPool(4)
+#encoder.submit(deviceName,messageText,context,csvPath,startTime,deltaTime,deviceTag,sensorTagList,valueConversion)
+#...
+#for context, future in encoder.completed():
+#    samples, writeTime = future.result()
+
+# Import necessary packages
+import concurrent.futures
+import multiprocessing
+import time
+import os
+from multiprocessing import shared_memory, resource_tracker
+
+# Import xware libraries
+from xware_lib_functions import writeCsvBuffer
+
+# Processes can be forked on this platform
+encoderPoolAvailable = 'fork' in multiprocessing.get_all_start_methods()
+
+
+# ===========================================
+# Write the CSV of one buffer (runs in a worker process)
+
+# memoryName, size: shared memory block with the text of the buffer
+# csvPath: full path of the CSV file
+# summaryOptions: SamplingSummary arguments (None = no summary)
+# passThrough: see writeCsvBuffer
+
+# Returns the number of samples and the time spent writing the CSV [s]
+
+def encodeBuffer(memoryName,size,csvPath,startTime,deltaTime,deviceTag,sensorTagList,valueConversion,
+                 timePrecision=6,valuePrecision=5,summaryOptions=None,passThrough=0):
+    memory = shared_memory.SharedMemory(memoryName)
+    try:
+        valueBuffer = bytes(memory.buf[:size]).decode().splitlines()
+    finally:
+        memory.close()
+    writeStart = time.perf_counter()
+    with open(csvPath + '.part', 'w') as file:
+        file.write('ID,,,\n')
+        writeCsvBuffer(file,valueBuffer,startTime,0,deltaTime,deviceTag,sensorTagList,valueConversion,
+                       timePrecision,valuePrecision,passThrough)
+    os.replace(csvPath + '.part', csvPath)
+    writeTime = time.perf_counter() - writeStart
+    if summaryOptions is not None:
+        from xware_lib_features import SamplingSummary
+        summary = SamplingSummary(*summaryOptions)
+        summary.add(valueBuffer,valueConversion)
+        summary.close()
+    return len(valueBuffer), writeTime
+
+
+# ===========================================
+# Pool of encoder worker processes
+
+# workers: number of worker processes
+
+class EncoderPool:
+
+    def __init__(self,workers=2):
+        # Workers share the tracker of the shared memory blocks of this
+        # process (it unlinks them if the Server dies)
+        resource_tracker.ensure_running()
+        self.executor = concurrent.futures.ProcessPoolExecutor(workers, multiprocessing.get_context('fork'))
+        # key: (future, shared memory block, context)
+        self.jobs = {}
+        # Fork the workers now, while this process has a single thread
+        list(self.executor.map(abs, range(workers)))
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def busy(self,key):
+        return key in self.jobs
+
+    # ===========
+    # Encode the buffer 'text' (see encodeBuffer for the other arguments)
+    # context: anything the caller needs once the job is done
+
+    def submit(self,key,text,context,*args,**kwargs):
+        data = text.encode()
+        memory = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+        memory.buf[:len(data)] = data
+        future = self.executor.submit(encodeBuffer, memory.name, len(data), *args, **kwargs)
+        self.jobs[key] = (future, memory, context)
+
+    # ===========
+    # Jobs that are done, as (context, future) pairs
+    # (future.result() returns what encodeBuffer returned, or raises its error)
+
+    def completed(self):
+        done = []
+        for key in [key for key, job in self.jobs.items() if job[0].done()]:
+            future, memory, context = self.jobs.pop(key)
+            memory.close()
+            memory.unlink()
+            done.append((context, future))
+        return done
+
+    # Wait for every job and stop the workers
+    def shutdown(self):
+        self.executor.shutdown()
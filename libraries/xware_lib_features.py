@@ -0,0 +1,389 @@
+# Feature extraction and decimation of sampled data in XWare
+# See Github repo (github.com/d-sanchezl/xware) for license details
+
+# Splits each sampling into fixed-length windows and computes, for every
+# window and sensor, time-domain statistics (RMS, peak, crest factor, mean,
+# standard deviation, kurtosis), the power in given frequency bands and the
+# strongest spectral peaks. A low-pass filtered, decimated copy of the samples
+# can also be produced.
+
+# AnomalyDetector decides, from the features of a sampling, whether a device
+# looks abnormal (used by gateways in 'features' edge mode).
+
+# Samples can be added in blocks (e.g. one per chunk of a sampling); windows
+# and filter state carry over from one block to the next.
+
+# This module requires NumPy
+
+# Import necessary packages
+import numpy as np
+import os
+
+# Import xware libraries
+from xware_lib_functions import *
+
+# Names of the time-domain features, in output order
+timeFeatureNames = ['rms', 'peak', 'crest', 'mean', 'std', 'kurtosis']
+
+# ===========================================
+# Convert buffer lines to an array of values (one column per sensor)
+
+# valueBuffer: list of sample lines, either 'values' or 'time\tvalues'
+# valueConversion: sensor to real value scaling
+
+def bufferToArray(valueBuffer,valueConversion=1):
+    rows = []
+    for line in valueBuffer:
+        tabPos = line.find('\t')
+        if tabPos != -1:
+            line = line[tabPos+1:]
+        rows.append(line.split(','))
+    if not(rows):
+        return np.zeros((0, 0))
+    return np.array(rows, dtype=float)*valueConversion
+
+
+# ===========================================
+# Names of the band power features
+
+# bands: list of (low, high) frequency limits [Hz]
+
+def bandFeatureNames(bands):
+    return ['band_' + format(low, 'g') + '_' + format(high, 'g') for low, high in bands]
+
+
+# ===========================================
+# Names of the spectral peak features
+
+# peakCount: number of peaks (frequency and amplitude of each)
+
+def peakFeatureNames(peakCount):
+    names = []
+    for i in range(1, peakCount+1):
+        names += ['peak' + str(i) + '_freq', 'peak' + str(i) + '_amp']
+    return names
+
+
+# ===========================================
+# Names of all features, in output order
+
+def featureNames(bands,peakCount=0):
+    return timeFeatureNames + bandFeatureNames(bands) + peakFeatureNames(peakCount)
+
+
+# ===========================================
+# Features of complete windows
+
+# windows: array of shape (windows, samples per window, sensors)
+# F: sampling frequency [Hz]
+# bands: list of (low, high) frequency limits [Hz]
+# peakCount: number of spectral peaks (largest bins, DC excluded)
+
+# Returns an array of shape (windows, sensors, features), with the features
+# in the order featureNames(bands,peakCount)
+
+def windowFeatures(windows,F,bands,peakCount=0):
+    mean = windows.mean(axis=1)
+    centered = windows - mean[:, None, :]
+    variance = (centered**2).mean(axis=1)
+    std = np.sqrt(variance)
+    rms = np.sqrt((windows**2).mean(axis=1))
+    peak = np.abs(windows).max(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crest = np.where(rms > 0, peak/rms, 0.0)
+        kurtosis = np.where(variance > 0, (centered**4).mean(axis=1)/variance**2, 0.0)
+    features = [rms, peak, crest, mean, std, kurtosis]
+    # Band powers from the one-sided power spectrum of each window
+    n = windows.shape[1]
+    spectrum = np.abs(np.fft.rfft(centered, axis=1))**2/(n*n)
+    spectrum[:, 1:(n+1)//2, :] *= 2
+    frequencies = np.fft.rfftfreq(n, 1/F)
+    for low, high in bands:
+        inBand = (frequencies >= low) & (frequencies < high)
+        features.append(spectrum[:, inBand, :].sum(axis=1))
+    # Spectral peaks: frequency and amplitude of a sine of the same power
+    if peakCount:
+        order = np.argsort(-spectrum[:, 1:, :], axis=1)[:, :peakCount, :] + 1
+        power = np.take_along_axis(spectrum, order, axis=1)
+        for i in range(min(peakCount, order.shape[1])):
+            features.append(frequencies[order[:, i, :]])
+            features.append(np.sqrt(2*power[:, i, :]))
+        for i in range(order.shape[1], peakCount):
+            features += [np.zeros_like(rms), np.zeros_like(rms)]
+    return np.stack(features, axis=2)
+
+
+# ===========================================
+# Low-pass FIR filter for decimation (windowed sinc, Hamming window)
+
+# factor: decimation factor; the cutoff is 80% of the new Nyquist frequency
+
+def decimationFilter(factor,tapsPerFactor=8):
+    numTaps = tapsPerFactor*factor + 1
+    cutoff = 0.8*0.5/factor
+    n = np.arange(numTaps) - (numTaps - 1)/2
+    taps = 2*cutoff*np.sinc(2*cutoff*n)*np.hamming(numTaps)
+    return taps/taps.sum()
+
+
+# ===========================================
+# Windowed features and decimation of one sampling, added block by block
+
+# F: sampling frequency [Hz]
+# windowLength: length of each feature window [s]
+# bands: list of (low, high) frequency limits [Hz]
+# decimationFactor: keep one of every decimationFactor filtered samples
+#   (0 or 1 disables decimation)
+# peakCount: number of spectral peak features
+
+# Usage:
+
+#extractor = FeatureExtractor(F,0.1,[(0,50),(50,200)],10)
+#features, decimated = extractor.add(values)   # for each block
+#features, decimated = extractor.finish()      # partial last window
+
+class FeatureExtractor:
+
+    def __init__(self,F,windowLength,bands,decimationFactor=0,peakCount=0):
+        self.F = F
+        self.bands = bands
+        self.peakCount = peakCount
+        self.windowSize = max(int(round(windowLength*F)), 1)
+        self.decimationFactor = decimationFactor if decimationFactor and decimationFactor > 1 else 0
+        self.remainder = None
+        self.windowCount = 0
+        if self.decimationFactor:
+            self.taps = decimationFilter(self.decimationFactor)
+            self.history = None
+            self.phase = 0
+
+    # ===========
+    # Add a block of values (samples x sensors)
+    # Returns the features of the windows completed by this block (or None),
+    # and the decimated samples of this block (or None)
+
+    def add(self,values):
+        values = np.asarray(values, dtype=float)
+        if values.ndim == 1:
+            values = values[:, None]
+        decimated = self.decimate(values) if self.decimationFactor else None
+        if self.remainder is not None:
+            values = np.concatenate((self.remainder, values))
+        complete = (len(values)//self.windowSize)*self.windowSize
+        self.remainder = values[complete:]
+        if complete == 0:
+            return None, decimated
+        windows = values[:complete].reshape(-1, self.windowSize, values.shape[1])
+        self.windowCount += len(windows)
+        return windowFeatures(windows,self.F,self.bands,self.peakCount), decimated
+
+    # ===========
+    # Features of the last, partial window (if any), and the last decimated
+    # samples (the filter is flushed by repeating the last sample)
+
+    def finish(self):
+        features = None
+        decimated = None
+        if self.decimationFactor and self.history is not None:
+            delay = (len(self.taps) - 1)//2
+            decimated = self.decimate(np.repeat(self.history[-1:], delay, axis=0))
+        if self.remainder is not None and len(self.remainder) > 0:
+            features = windowFeatures(self.remainder[None, :, :],self.F,self.bands,self.peakCount)
+            self.windowCount += 1
+        self.remainder = None
+        return features, decimated
+
+    # ===========
+    # Filter and decimate a block, keeping the filter state between blocks
+    # (the filter delay is compensated, so decimated samples line up in time)
+
+    def decimate(self,values):
+        delay = (len(self.taps) - 1)//2
+        if self.history is None:
+            # Pad the start with the first sample to avoid a step response
+            self.history = np.repeat(values[:1], len(self.taps) - 1 - delay, axis=0)
+        extended = np.concatenate((self.history, values))
+        filtered = np.empty((len(extended) - len(self.taps) + 1, values.shape[1]))
+        for column in range(values.shape[1]):
+            filtered[:, column] = np.convolve(extended[:, column], self.taps, mode='valid')
+        self.history = extended[len(extended) - len(self.taps) + 1:]
+        # Select every decimationFactor-th sample of the continuous stream
+        decimated = filtered[self.phase::self.decimationFactor]
+        self.phase = (self.phase - len(filtered)) % self.decimationFactor
+        return decimated
+
+
+# ===========================================
+# Summary of one sampling, written next to its raw CSV
+
+# Features of every window are appended to '[device name]_features.csv' in
+# summaryLocation (one row per window and sensor). If decimationFactor > 1, a
+# decimated copy of the samples, in the same format as the raw CSV, is written
+# to '[raw CSV name]_dec[factor].csv'.
+
+# summaryLocation: folder of the summary files
+# fileName: name of the raw CSV of the sampling
+# deviceName, startTime: OM2M name and UNIX start time of the sampling
+# F, deviceTag, sensorTagList: device metadata (from its OM2M labels)
+# windowLength, bands, decimationFactor: see FeatureExtractor
+
+class SamplingSummary:
+
+    def __init__(self,summaryLocation,fileName,deviceName,startTime,F,deviceTag,sensorTagList,
+                 windowLength=0.1,bands=[],decimationFactor=0,timePrecision=6,valuePrecision=5):
+        self.startTime = startTime
+        self.deltaTime = 1/F
+        self.windowLength = windowLength
+        self.deviceTag = deviceTag
+        self.sensorTagList = sensorTagList
+        self.timePrecision = timePrecision
+        self.valuePrecision = valuePrecision
+        self.extractor = FeatureExtractor(F,windowLength,bands,decimationFactor)
+        self.decimatedCount = 0
+        # Features file (one per device, header written once)
+        featuresPath = summaryLocation + '/' + deviceName + '_features.csv'
+        newFile = not(os.path.isfile(featuresPath))
+        self.featuresFile = open(featuresPath, 'a')
+        if newFile:
+            self.featuresFile.write(','.join(['time', 'device', 'sensor'] + featureNames(bands)) + '\n')
+        # Decimated samples file
+        self.decimatedFile = None
+        if self.extractor.decimationFactor:
+            self.decimatedFile = open(summaryLocation + '/' + fileName[:-4] + '_dec' + str(decimationFactor) + '.csv', 'w')
+            self.decimatedFile.write('ID,,,\n')
+
+    # ===========
+    # Add a buffer (list of sample lines) of the sampling
+
+    def add(self,valueBuffer,valueConversion=1):
+        values = bufferToArray(valueBuffer,valueConversion)
+        if len(values):
+            self.write(*self.extractor.add(values))
+
+    def close(self):
+        self.write(*self.extractor.finish())
+        self.featuresFile.close()
+        if self.decimatedFile:
+            self.decimatedFile.close()
+
+    # ===========
+    # Write features and decimated samples
+
+    def write(self,features,decimated):
+        valueForm = '%.' + str(self.valuePrecision) + 'f'
+        if features is not None:
+            firstWindow = self.extractor.windowCount - len(features)
+            lines = []
+            for i, windowRows in enumerate(features.tolist()):
+                timeUnix = preciseUnixTime(self.startTime,0,(firstWindow+i)*self.windowLength,self.timePrecision,string=1)
+                timeStr = unixToDateString(float(timeUnix),precision=self.timePrecision)
+                for sensorTag, row in zip(self.sensorTagList, windowRows):
+                    lines.append(timeStr + ',' + self.deviceTag + ',' + sensorTag + ',' + ','.join([valueForm % value for value in row]) + '\n')
+            self.featuresFile.write(''.join(lines))
+        if decimated is not None and self.decimatedFile:
+            deltaTime = self.deltaTime*self.extractor.decimationFactor
+            for row in decimated.tolist():
+                timeUnix = preciseUnixTime(self.startTime,0,self.decimatedCount*deltaTime,self.timePrecision,string=1)
+                for sensorTag, value in zip(self.sensorTagList, row):
+                    self.decimatedFile.write(csvFormatLine(timeUnix,self.deviceTag,sensorTag,value,self.valuePrecision))
+                self.decimatedCount += 1
+
+
+# ===========================================
+# Features of a whole sampling (the last window may be shorter)
+
+# values: array of samples x sensors
+# Returns an array of shape (windows, sensors, features)
+
+def samplingFeatures(values,F,windowLength,bands,peakCount=0):
+    extractor = FeatureExtractor(F,windowLength,bands,0,peakCount)
+    blocks = [extractor.add(values)[0], extractor.finish()[0]]
+    return np.concatenate([block for block in blocks if block is not None])
+
+
+# ===========================================
+# Anomaly detection from window features
+
+# names: feature names, as given by featureNames()
+# thresholds: dictionary of feature name and upper limit, e.g. {'rms': 5.0}
+#   (a sampling trips if any window and sensor goes over a limit)
+# scoreLimit: anomaly score over which a sampling trips (0 disables scoring)
+# baselineSamplings: normal samplings learnt before the score is used
+# adaptation: weight of each new normal sampling in the baseline, once learnt
+# scoreFeatures: names of the features used for the score (default: RMS, peak,
+#   crest factor, kurtosis and band powers)
+
+# The anomaly score of a sampling is the largest distance, in standard
+# deviations of the baseline, of any scored feature of any window and sensor
+# from its baseline mean. Standard deviations are floored at 5% of the mean
+# (band powers: 1% of the total power of the bands), so that a very steady
+# signal, or an empty band, does not trip on the tiniest change.
+
+# Usage:
+
+#detector = AnomalyDetector(featureNames(bands),{'kurtosis': 6},scoreLimit=6)
+#tripped, score = detector.check(features)
+#if not(tripped):
+#    detector.learn(features)
+
+class AnomalyDetector:
+
+    def __init__(self,names,thresholds=None,scoreLimit=0,baselineSamplings=10,adaptation=0.1,scoreFeatures=None):
+        self.thresholds = [(names.index(name), limit) for name, limit in (thresholds or {}).items()]
+        if scoreFeatures is None:
+            scoreFeatures = ['rms', 'peak', 'crest', 'kurtosis'] + [name for name in names if name[:5] == 'band_']
+        self.scoreColumns = [names.index(name) for name in scoreFeatures if name in names]
+        self.bandColumns = [i for i, column in enumerate(self.scoreColumns) if names[column][:5] == 'band_']
+        self.scoreLimit = scoreLimit
+        self.baselineSamplings = baselineSamplings
+        self.adaptation = adaptation
+        self.samplings = 0
+        self.windows = 0
+        self.mean = None
+        self.variance = None
+
+    # ===========
+    # Check the features (windows x sensors x features) of a sampling
+    # Returns (1 if it trips, anomaly score)
+
+    def check(self,features):
+        tripped = 0
+        for column, limit in self.thresholds:
+            if features[:, :, column].max() > limit:
+                tripped = 1
+        score = 0.0
+        if self.samplings >= self.baselineSamplings and self.mean is not None and self.scoreColumns:
+            mean = self.mean[:, self.scoreColumns]
+            std = np.maximum(np.sqrt(self.variance[:, self.scoreColumns]), 0.05*np.abs(mean))
+            if self.bandColumns:
+                totalPower = mean[:, self.bandColumns].sum(axis=1, keepdims=True)
+                std[:, self.bandColumns] = np.maximum(std[:, self.bandColumns], 0.01*totalPower)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                distance = np.where(std > 0, np.abs(features[:, :, self.scoreColumns] - mean)/std, 0.0)
+            score = float(distance.max())
+            if self.scoreLimit and score > self.scoreLimit:
+                tripped = 1
+        return tripped, score
+
+    # ===========
+    # Add the features of a normal sampling to the baseline
+
+    def learn(self,features):
+        batchMean = features.mean(axis=0)
+        batchVariance = features.var(axis=0)
+        n = len(features)
+        if self.mean is None:
+            self.mean, self.variance, self.windows = batchMean, batchVariance, n
+        elif self.samplings < self.baselineSamplings:
+            # Exact mean and variance of all windows learnt so far
+            total = self.windows + n
+            delta = batchMean - self.mean
+            self.variance = (self.windows*self.variance + n*batchVariance + delta**2*self.windows*n/total)/total
+            self.mean = self.mean + delta*n/total
+            self.windows = total
+        else:
+            # Exponentially weighted, to follow slow changes of the machine
+            delta = batchMean - self.mean
+            self.mean = self.mean + self.adaptation*delta
+            self.variance = (1 - self.adaptation)*(self.variance + self.adaptation*delta**2) + self.adaptation*batchVariance
+        self.samplings += 1
@@ -0,0 +1,311 @@
+# Fleet simulator for XWare: many virtual gateway devices, for load tests
+# See Github repo (github.com/d-sanchezl/xware) for license details
+
+# Every virtual device is a real GatewayDevice (registration, START/TIMER
+# handshake, buffers and events, against the configured broker) that replays
+# recorded samples (xware_lib_replay) instead of reading sensors. Devices are
+# spread over worker processes, each with one GatewayRuntime (one MQTT
+# connection), and are started following a ramp-up profile:
+
+# * 'instant': all devices at once
+# * 'linear': one after the other, evenly over rampTime seconds
+# * 'step': rampStepSize devices every rampStepTime seconds
+
+# The workers collect the cycle summaries of their devices (the lines of the
+# gateway cycle log) and report them to the main process, which prints the
+# aggregate throughput and handshake latency every statsInterval seconds.
+
+# This module requires NumPy
+
+# Usage:
+
+#groups = [{'prefix': 'sim_motor', 'count': 200, 'F': 1000, 't': 1, 'T': 5, 'sensorTag': 'x_accel,y_accel,z_accel'}]
+#fleet = FleetSimulator(brokerAddress,'fleet_1',groups,samplesLocation,processes=4,rampProfile='linear',rampTime=60)
+#summary = fleet.run()
+
+# Import necessary packages
+import multiprocessing
+import threading
+import queue
+import time
+import sys
+import os
+
+# Import xware libraries
+from xware_lib_gateway import *
+from xware_lib_replay import ReplaySource
+
+# Keys of a device group that are not GatewayDevice options
+groupKeys = ('prefix', 'count', 'F', 't', 'T', 'sensorTag', 'deviceTag', 'valueConversion')
+
+
+# ===========================================
+# Expand device groups into one specification (dictionary) per device
+
+# Each group holds 'prefix' and 'count' (devices are named [prefix]_1 to
+# [prefix]_[count]), 'F', 't', 'T' and 'sensorTag', and optionally
+# 'deviceTag' (default: the prefix), 'valueConversion' (default: 1) and any
+# other GatewayDevice option, given by name (e.g. 'chunkSize': 200)
+
+def expandGroups(deviceGroups):
+    specs = []
+    for group in deviceGroups:
+        options = dict([(key, value) for key, value in group.items() if not(key in groupKeys)])
+        for i in range(group['count']):
+            specs.append({'deviceName': group['prefix'] + '_' + str(i+1),
+                          'F': group['F'], 't': group['t'], 'T': group['T'],
+                          'sensorTag': group['sensorTag'],
+                          'deviceTag': group.get('deviceTag', group['prefix']),
+                          'valueConversion': group.get('valueConversion', 1),
+                          'options': options})
+    return specs
+
+
+# ===========================================
+# Start delay of each of 'count' devices [s], for a ramp-up profile
+
+def rampDelays(count,profile='instant',rampTime=60,rampStepSize=10,rampStepTime=10):
+    if profile == 'instant':
+        return [0.0]*count
+    if profile == 'linear':
+        return [i*rampTime/count for i in range(count)]
+    if profile == 'step':
+        return [(i//rampStepSize)*rampStepTime for i in range(count)]
+    raise ValueError('Unknown ramp-up profile: ' + str(profile))
+
+
+# ===========================================
+# Cycle log of a worker: keeps the totals of the cycle summaries written
+# since the last take()
+
+class CycleCollector:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.cycles = 0
+        self.samples = 0
+        self.payloadBytes = 0
+        self.missedDeadlines = 0
+        self.handshakeMs = []
+        self.deviceNames = set()
+
+    # Line format: [date]\t[device name]\t[key=value,...]
+    def write(self,line):
+        dateText, deviceName, text = line.rstrip('\n').split('\t')
+        stats = textToStats(text)
+        with self.lock:
+            self.cycles += 1
+            self.samples += int(stats.get('samples', 0))
+            self.payloadBytes += int(stats.get('payloadBytes', 0))
+            self.missedDeadlines += int(stats.get('missedDeadlines', 0))
+            self.handshakeMs.append(stats.get('handshakeMs', 0.0))
+            self.deviceNames.add(deviceName)
+
+    def take(self):
+        with self.lock:
+            report = {'cycles': self.cycles, 'samples': self.samples,
+                      'payloadBytes': self.payloadBytes, 'missedDeadlines': self.missedDeadlines,
+                      'handshakeMs': self.handshakeMs, 'deviceNames': sorted(self.deviceNames)}
+            self.reset()
+        return report
+
+
+# ===========================================
+# Worker: run some of the devices in one GatewayRuntime, and put a report in
+# 'reports' every statsInterval seconds until stopEvent is set
+
+# specs, delays: devices of this worker and their start delays
+# settings: see FleetSimulator
+
+def runFleetWorker(workerIndex,specs,delays,settings,reports,stopEvent):
+    if settings['quiet']:
+        sys.stdout = open(os.devnull, 'w')
+    source = ReplaySource(settings['samplesLocation'])
+    collector = CycleCollector()
+    runtime = GatewayRuntime(settings['brokerAddress'],settings['fleetName'] + '_' + str(workerIndex+1),
+                             cycleLog=collector,**settings['runtimeOptions'])
+    for i, (spec, delay) in enumerate(zip(specs, delays)):
+        sensors = len(spec['sensorTag'].split(','))
+        # Each device replays the shared values from its own starting point
+        replay = ReplaySource(source.values,sensors)
+        replay.position = (i*7919*sensors) % len(source.values)
+        options = {'acquisitionMode': 'block', 'blockSize': max(int(spec['F']*settings['blockTime']), 1),
+                   'schedulerMode': 'sleep', 'publishJitterStats': 0}
+        options.update(spec['options'])
+        runtime.addDevice(GatewayDevice(spec['deviceName'],spec['F'],spec['t'],spec['T'],spec['valueConversion'],
+                                        spec['deviceTag'],spec['sensorTag'],getBlockFromSensor=replay.readBlock,
+                                        startDelay=delay,**options))
+    runtime.start()
+    while not(stopEvent.wait(settings['statsInterval'])):
+        reports.put((workerIndex, collector.take()))
+    runtime.stop()
+    reports.put((workerIndex, collector.take()))
+    reports.put((workerIndex, None))
+
+
+# ===========================================
+# Fleet of virtual devices
+
+# brokerAddress: IP address of the MQTT broker
+# fleetName: start of the MQTT client names of the workers
+# deviceGroups: list of device groups (see expandGroups())
+# samplesLocation: input files replayed by every device (see xware_lib_replay)
+# processes: worker processes (0 = run all devices in this process)
+# rampProfile, rampTime, rampStepSize, rampStepTime: see rampDelays()
+# statsInterval: time between aggregate statistics [s]
+# runTime: time before the fleet stops [s] (0 = until Ctrl+C)
+# blockTime: time covered by each block of replayed samples [s]
+# quiet: set to 1 to hide the progress messages of the devices
+# runtimeOptions: GatewayRuntime parameters, given by name (e.g. dataPlane)
+
+class FleetSimulator:
+
+    def __init__(self,brokerAddress,fleetName,deviceGroups,samplesLocation,processes=4,
+                 rampProfile='linear',rampTime=60,rampStepSize=10,rampStepTime=10,
+                 statsInterval=5,runTime=0,blockTime=0.05,quiet=1,**runtimeOptions):
+        self.specs = expandGroups(deviceGroups)
+        self.delays = rampDelays(len(self.specs),rampProfile,rampTime,rampStepSize,rampStepTime)
+        self.processes = processes
+        self.statsInterval = statsInterval
+        self.runTime = runTime
+        self.settings = {'brokerAddress': brokerAddress, 'fleetName': fleetName,
+                         'samplesLocation': samplesLocation, 'statsInterval': statsInterval,
+                         'blockTime': blockTime, 'quiet': quiet and processes > 0,
+                         'runtimeOptions': runtimeOptions}
+        self.quiet = quiet
+
+    # ===========
+    # Start the workers (devices are dealt out to them in turn)
+
+    def start(self):
+        workerCount = max(self.processes, 1)
+        if self.processes:
+            self.reports = multiprocessing.Queue()
+            self.stopEvent = multiprocessing.Event()
+            workerClass = multiprocessing.Process
+        else:
+            self.reports = queue.Queue()
+            self.stopEvent = threading.Event()
+            workerClass = threading.Thread
+        self.workers = []
+        for k in range(workerCount):
+            args = (k, self.specs[k::workerCount], self.delays[k::workerCount], self.settings, self.reports, self.stopEvent)
+            worker = workerClass(target=runFleetWorker, args=args, name='fleet_' + str(k+1), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        self.startTime = time.time()
+
+    # ===========
+    # Run until runTime, or until Ctrl+C is pressed
+    # Returns the statistics of the whole run, as a dictionary
+
+    def run(self):
+        output = sys.stdout
+        if self.quiet and not(self.processes):
+            sys.stdout = open(os.devnull, 'w')
+        self.start()
+        self.totals = self.emptyTotals()
+        self.deviceNames = set()
+        interval = self.emptyTotals()
+        nextPrint = self.startTime + self.statsInterval
+        output.write(self.header() + '\n')
+        try:
+            while not(self.runTime) or time.time() < self.startTime + self.runTime:
+                self.collect(interval, max(nextPrint - time.time(), 0))
+                if time.time() >= nextPrint:
+                    output.write(self.intervalLine(interval, self.statsInterval) + '\n')
+                    output.flush()
+                    interval = self.emptyTotals()
+                    nextPrint += self.statsInterval
+        except KeyboardInterrupt:
+            pass
+        # Stop, and wait for the last cycle of every worker
+        self.stopEvent.set()
+        running = len(self.workers)
+        while running:
+            try:
+                workerIndex, report = self.reports.get(timeout=1)
+            except queue.Empty:
+                if not(any([worker.is_alive() for worker in self.workers])):
+                    break
+                continue
+            if report is None:
+                running -= 1
+            else:
+                self.add(interval, report)
+        for worker in self.workers:
+            worker.join(1)
+        if sys.stdout is not output:
+            sys.stdout.close()
+            sys.stdout = output
+        summary = self.summary()
+        output.write('\n' + '\n'.join([key + ': ' + str(value) for key, value in summary.items()]) + '\n')
+        return summary
+
+    # ===========
+    # Aggregate the reports of the workers
+
+    def emptyTotals(self):
+        return {'cycles': 0, 'samples': 0, 'payloadBytes': 0, 'missedDeadlines': 0, 'handshakeMs': []}
+
+    def collect(self,interval,timeout):
+        try:
+            workerIndex, report = self.reports.get(timeout=timeout)
+        except queue.Empty:
+            return
+        if report is not None:
+            self.add(interval, report)
+
+    def add(self,interval,report):
+        for totals in (interval, self.totals):
+            for key in ('cycles', 'samples', 'payloadBytes', 'missedDeadlines'):
+                totals[key] += report[key]
+            totals['handshakeMs'] += report['handshakeMs']
+        self.deviceNames.update(report['deviceNames'])
+
+    # Devices started so far, and the samples per second they should produce
+    # (on average over their period)
+    def nominal(self,elapsed):
+        started = [spec for spec, delay in zip(self.specs, self.delays) if delay <= elapsed]
+        return len(started), sum([spec['F']*min(spec['t'], spec['T'])/spec['T'] for spec in started])
+
+    # ===========
+    # Statistics as text and as a dictionary
+
+    def header(self):
+        titles = ['time s', 'started', 'cycling', 'cycles', 'nominal/s', 'samples/s', 'MB/s',
+                  'hs p50 ms', 'hs p99 ms', 'hs max ms', 'missed']
+        return '  '.join([title.rjust(10) for title in titles])
+
+    def intervalLine(self,interval,duration):
+        elapsed = time.time() - self.startTime
+        started, nominalRate = self.nominal(elapsed)
+        handshakes = sorted(interval['handshakeMs'])
+        items = ['%.0f' % elapsed, '%d' % started, '%d' % len(self.deviceNames), '%d' % interval['cycles'],
+                 '%.0f' % nominalRate, '%.0f' % (interval['samples']/duration),
+                 '%.3f' % (interval['payloadBytes']/duration/2**20),
+                 '%.1f' % percentile(handshakes, 50), '%.1f' % percentile(handshakes, 99),
+                 '%.1f' % (handshakes[-1] if handshakes else 0.0), '%d' % interval['missedDeadlines']]
+        return '  '.join([item.rjust(10) for item in items])
+
+    def summary(self):
+        elapsed = time.time() - self.startTime
+        started, nominalRate = self.nominal(elapsed)
+        handshakes = sorted(self.totals['handshakeMs'])
+        return {'seconds': round(elapsed, 1),
+                'devices': len(self.specs),
+                'startedDevices': started,
+                'cyclingDevices': len(self.deviceNames),
+                'cycles': self.totals['cycles'],
+                'samples': self.totals['samples'],
+                'samplesPerSecond': round(self.totals['samples']/elapsed, 1),
+                'nominalSamplesPerSecond': round(nominalRate, 1),
+                'payloadMB': round(self.totals['payloadBytes']/2**20, 3),
+                'p50HandshakeMs': round(percentile(handshakes, 50), 1),
+                'p95HandshakeMs': round(percentile(handshakes, 95), 1),
+                'p99HandshakeMs': round(percentile(handshakes, 99), 1),
+                'maxHandshakeMs': round(handshakes[-1] if handshakes else 0.0, 1),
+                'missedDeadlines': self.totals['missedDeadlines']}
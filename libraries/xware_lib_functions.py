@@ -5,6 +5,7 @@
 import os
 import time
 import math
+import threading
 
 # ===========================================
 # Separate elements in a line into a list, given a separator
@@ -107,6 +108,38 @@ def writeLineToFile(fullFileName,line):
     file.close()
 
 
+# ===========================================
+# Log file that is rotated when it grows too large
+
+# fullFileName: path of the log file
+# maxBytes: size at which the file is renamed to [name].1 and a new one begun
+# backups: number of old files kept ([name].1 is the newest)
+
+# Lines can be written from several threads
+
+class RollingLog:
+
+    def __init__(self,fullFileName,maxBytes=1024*1024,backups=3):
+        self.fullFileName = fullFileName
+        self.maxBytes = maxBytes
+        self.backups = backups
+        self.lock = threading.Lock()
+
+    def write(self,line):
+        with self.lock:
+            if os.path.isfile(self.fullFileName) and os.path.getsize(self.fullFileName) + len(line) > self.maxBytes:
+                self.rotate()
+            writeLineToFile(self.fullFileName,line)
+
+    def rotate(self):
+        for i in range(self.backups, 0, -1):
+            source = self.fullFileName + ('.' + str(i-1) if i > 1 else '')
+            if os.path.isfile(source):
+                os.replace(source, self.fullFileName + '.' + str(i))
+        if os.path.isfile(self.fullFileName):
+            os.remove(self.fullFileName)
+
+
 # ===========================================
 # Print to both the console output and to a specified log file
 
@@ -137,3 +170,176 @@ def csvFormatLine(timeUnixStr,deviceStr,sensorStr,valueStr,valuePrecision=16):
     # Correct value
     newValueStr = format(round(float(valueStr),valuePrecision), '.'+str(valuePrecision)+'f')
     return newDateStr + ',' + deviceStr + ',' + sensorStr + ',' + newValueStr + '\n'
+
+
+# ===========================================
+# Format a block of samples as newline-terminated buffer text
+
+# Each row of the block is one sample, each column one sensor. The output is
+# the same text that the string contract would produce, one line per sample,
+# so the Server reads it unchanged.
+
+# If capture timestamps are given, each line is prefixed with 'time\t', where
+# time is the capture time of the sample relative to the start of the sampling.
+
+# block: list of samples (numbers, sequences or strings, e.g. one 1D NumPy
+#   array per sample), or a 1D/2D NumPy array
+# precision: decimal places to keep; None keeps the shortest exact representation
+# timestamps: optional list of capture times [s], one per sample
+
+def formatSampleBlock(block,precision=None,timestamps=None):
+    if hasattr(block, 'tolist'):
+        block = block.tolist()
+    if not(block):
+        return ''
+    if isinstance(block[0], str):
+        lines = block
+    else:
+        block = [row.tolist() if hasattr(row, 'tolist') else row for row in block]
+        # A single sensor may deliver a flat list of numbers
+        if not(hasattr(block[0], '__iter__')):
+            block = [[value] for value in block]
+        if precision is None:
+            lines = [','.join(map(repr, map(float, row))) for row in block]
+        else:
+            form = ','.join(['%.' + str(precision) + 'f'] * len(block[0]))
+            lines = [form % tuple(row) for row in block]
+    if timestamps is not None:
+        lines = ['%.7f\t%s' % pair for pair in zip(timestamps, lines)]
+    return '\n'.join(lines) + '\n'
+
+
+# ===========================================
+# Create the name of the CSV file of a sampling
+
+# deviceName: OM2M name of the device
+# startTime: UNIX start time of the sampling
+
+def csvFileName(deviceName,startTime):
+    dateStr = time.strftime('%Y%m%dT%H%M%S',time.localtime(startTime))
+    decimalsStr = str(int((startTime-int(startTime))*(10**2)))
+    return deviceName + '_' + dateStr + decimalsStr + '.csv'
+
+
+# ===========================================
+# Format CSV lines in bulk, with fixed precisions
+
+# Times are turned into integer ticks of 10^-timePrecision s once (a single
+# rounding: the start time is split into whole seconds and a fraction, so no
+# digits are lost), and the date string of each whole second is only built
+# once. Values are formatted straight from their float value to
+# valuePrecision decimals (or, with raw=1, given as text and copied as they
+# are). Lines are the same as those of csvFormatLine:
+
+#  [date and time],[device tag],[sensor tag],[value]
+
+# Usage:
+
+#formatter = CsvFormatter(6,5)
+#text = formatter.lines(startTime,[0.0, 0.001],deviceTag,['x','y'],[[1.0, 2.0], [3.0, 4.0]])
+
+class CsvFormatter:
+
+    def __init__(self,timePrecision=6,valuePrecision=5,form='%Y-%m-%dT%H:%M:%S'):
+        self.timePrecision = min(timePrecision, 16)
+        self.scale = 10**self.timePrecision
+        self.form = form
+        self.fractionForm = '.%0' + str(self.timePrecision) + 'd' if self.timePrecision > 0 else ''
+        self.valueForm = '%.' + str(valuePrecision) + 'f'
+        # Date string of the last whole second
+        self.lastSecond = None
+        self.lastDate = ''
+
+    # ===========
+    # Date strings of relativeTimes [s] (list or NumPy array) after startTime
+
+    def timeStrings(self,startTime,relativeTimes):
+        if hasattr(relativeTimes, 'tolist'):
+            relativeTimes = relativeTimes.tolist()
+        scale = self.scale
+        startSecond = math.floor(startTime)
+        startFraction = startTime - startSecond
+        baseTicks = startSecond*scale
+        fractionForm = self.fractionForm
+        strings = []
+        for relativeTime in relativeTimes:
+            second, fraction = divmod(baseTicks + round((startFraction + relativeTime)*scale), scale)
+            if second != self.lastSecond:
+                self.lastSecond = second
+                self.lastDate = time.strftime(self.form, time.localtime(second))
+            strings.append(self.lastDate + (fractionForm % fraction if fractionForm else ''))
+        return strings
+
+    # Values (list or NumPy array), as strings
+    def valueStrings(self,values):
+        if hasattr(values, 'tolist'):
+            values = values.tolist()
+        valueForm = self.valueForm
+        return [valueForm % value for value in values]
+
+    # ===========
+    # CSV text of a block of samples
+    # valueRows: one row of values (one per sensor) per relative time (list of
+    #   lists, or 2D NumPy array)
+    # raw: set to 1 if the values are strings to write as they are
+
+    def lines(self,startTime,relativeTimes,deviceTag,sensorTagList,valueRows,raw=0):
+        if hasattr(valueRows, 'tolist'):
+            valueRows = valueRows.tolist()
+        timeStrings = self.timeStrings(startTime,relativeTimes)
+        valueForm = self.valueForm
+        tails = [',' + deviceTag + ',' + sensorTag + ',' for sensorTag in sensorTagList]
+        parts = []
+        if raw:
+            for timeStr, row in zip(timeStrings, valueRows):
+                for tail, value in zip(tails, row):
+                    parts.append(timeStr + tail + value + '\n')
+        else:
+            for timeStr, row in zip(timeStrings, valueRows):
+                for tail, value in zip(tails, row):
+                    parts.append(timeStr + tail + valueForm % value + '\n')
+        return ''.join(parts)
+
+
+# ===========================================
+# Write the CSV lines of a buffer to an open file
+
+# file: open CSV file
+# valueBuffer: list of sample lines, either 'values' or 'time\tvalues'
+# startTime: UNIX start time of the sampling
+# currentTime: time of the first sample relative to startTime [s], used for
+#   lines that do not carry their own capture time
+# deltaTime: time between samples [s]
+# deviceTag, sensorTagList: device tag and list of sensor tags
+# valueConversion: sensor to real value scaling
+# passThrough: set to 1 to copy the value text as it is (only if
+#   valueConversion is 1 and the values already have valuePrecision decimals)
+
+# Returns the relative time of the sample that would follow this buffer
+
+def writeCsvBuffer(file,valueBuffer,startTime,currentTime,deltaTime,deviceTag,sensorTagList,valueConversion,timePrecision=6,valuePrecision=5,passThrough=0):
+    relativeTimes = []
+    valueRows = []
+    for valueStrRaw in valueBuffer:
+        # Use the capture time sent by the device, if any ('time\tvalues')
+        tabPos = valueStrRaw.find('\t')
+        if tabPos != -1:
+            currentTime = float(valueStrRaw[:tabPos])
+            valueStrRaw = valueStrRaw[tabPos+1:]
+        # Convert values to numbers, considering the conversion factor
+        # (or keep their text, in pass-through mode)
+        if passThrough:
+            valueListConverted = valueStrRaw.split(',')
+        else:
+            valueListConverted = [float(singleValue)*valueConversion for singleValue in valueStrRaw.split(',')]
+        # Check that the length of the sensor tag list and sensor values is the same
+        if len(sensorTagList) != len(valueListConverted):
+            print("Error: There are " + str(len(sensorTagList)) + " sensor tags but " + str(len(valueListConverted)) + " values.")
+        relativeTimes.append(currentTime)
+        valueRows.append(valueListConverted)
+        # Update time
+        currentTime += deltaTime
+    # Format and write all lines at once
+    formatter = CsvFormatter(timePrecision,valuePrecision)
+    file.write(formatter.lines(startTime,relativeTimes,deviceTag,sensorTagList,valueRows,passThrough))
+    return currentTime
@@ -0,0 +1,681 @@
+# Gateway runtime for XWare: one or many devices in a single process
+# See Github repo (github.com/d-sanchezl/xware) for license details
+
+# A GatewayRuntime holds a single MQTT connection to the broker, shared by all
+# of its devices. Requests to OM2M are matched to their responses by request
+# ID (rqi), so several devices can wait for responses at the same time. Each
+# GatewayDevice runs its START/TIMER handshake and acquisition in its own
+# thread.
+
+# If the runtime is given a DiskQueue (xware_lib_queue), buffers are stored on
+# disk before they are sent, and a forwarding thread delivers them with QoS 1.
+# Acquisition then keeps running while the broker or OM2M are unreachable.
+
+# Stage latencies (register, handshake, acquire, format, upload), buffer,
+# sample and byte counts, OM2M retries and queue depth are recorded in the
+# shared registry of xware_lib_metrics.
+
+# Every cycle of a device is also summarised in one line (handshake latency,
+# actual vs. nominal sample interval, time spent reading the sensor,
+# formatting and publishing, and payload bytes), written to the runtime's
+# cycle log and optionally sent to the 'events' container as a CYCLE message.
+
+# In 'features' edge mode, a device sends per-window features of each sampling
+# instead of its samples (see xware_lib_features, which requires NumPy). When
+# a sampling trips a threshold or the anomaly score, its samples are sent too,
+# and the next alarmHold samplings are acquired at alarmF and alarmT and sent
+# in full.
+
+# Usage:
+
+#runtime = GatewayRuntime(brokerAddress,'edge_pc_1')
+#runtime.addDevice(GatewayDevice('motor_1',F,t,T,valueConversion,'motor_1','x_accel',getValueFromSensor))
+#runtime.addDevice(GatewayDevice('motor_2',F,t,T,valueConversion,'motor_2','x_accel',readMotor2))
+#runtime.run()
+
+# Import necessary packages
+import paho.mqtt.client as mqtt # MQTT
+import threading
+import itertools
+import time
+
+# Import xware libraries
+from xware_lib_functions import *
+from xware_lib_om2m import *
+from xware_lib_scheduler import *
+from xware_lib_queue import *
+from xware_lib_stream import *
+from xware_lib_metrics import *
+from xware_lib_profiler import *
+
+
+# ===========================================
+# Raised when OM2M does not answer a request within maxWaitTime
+
+class OM2MTimeoutError(Exception):
+    pass
+
+
+# ===========================================
+# MQTT request/response multiplexer
+
+# clientName: MQTT client ID of the process
+# brokerAddress: IP address of the MQTT broker
+# retryWaitTime: time between message sent retries [s]
+# maxWaitTime: maximum time to wait for a response [s]
+
+class MQTTMultiplexer:
+
+    def __init__(self,clientName,brokerAddress,retryWaitTime=1,maxWaitTime=6):
+        self.brokerAddress = brokerAddress
+        self.retryWaitTime = retryWaitTime
+        self.maxWaitTime = maxWaitTime
+        self.topics = []
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.requestCounter = itertools.count(1)
+        self.client = mqtt.Client(clientName)
+        self.client.on_message = self.onMessage
+        self.client.on_connect = self.onConnect
+
+    # ===========
+    # Connect to the broker and start the network thread
+    # (the network thread keeps reconnecting if the broker is unreachable)
+
+    def connect(self):
+        self.client.connect_async(self.brokerAddress)
+        self.client.loop_start()
+
+    def disconnect(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+    # ===========
+    # Subscribe to an OM2M response topic (also after every reconnection)
+
+    def subscribe(self,topicResp):
+        if not(topicResp in self.topics):
+            self.topics.append(topicResp)
+            self.client.subscribe(topicResp)
+
+    def onConnect(self,client,userdata,flags,rc):
+        for topic in self.topics:
+            client.subscribe(topic)
+
+    # ===========
+    # Hand each response to the request waiting for its rqi
+
+    def onMessage(self,client,userdata,msg):
+        try:
+            obj = jsonLoads(msg.payload)
+            rqi = obj['m2m:rsp']['m2m:rqi']
+        except (ValueError, KeyError, TypeError):
+            return
+        with self.lock:
+            waiting = self.pending.get(rqi)
+        if waiting:
+            waiting[1] = obj
+            waiting[0].set()
+
+    # ===========
+    # Send a request to OM2M and wait for its response
+
+    # topicReq: MQTT Request Topic of the device
+    # buildPayload: function that creates the payload for a given rqi, e.g.
+    #   lambda rqi: searchApplicationsPayload(authOM2M,to_app,rqi)
+
+    # The parsed response is returned, or OM2MTimeoutError is raised
+
+    def request(self,topicReq,buildPayload):
+        rqi = str(next(self.requestCounter))
+        payload = buildPayload(rqi)
+        waiting = [threading.Event(), None]
+        with self.lock:
+            self.pending[rqi] = waiting
+        try:
+            maxWaitTimer = time.time()
+            device = topicReq.split('/')[3]
+            while True:
+                self.client.publish(topicReq, payload)
+                if waiting[0].wait(self.retryWaitTime):
+                    return waiting[1]
+                if time.time() - maxWaitTimer > self.maxWaitTime:
+                    metrics.inc('xware_timeouts_total',device=device)
+                    raise OM2MTimeoutError('could not connect to OM2M')
+                metrics.inc('xware_retries_total',device=device)
+        finally:
+            with self.lock:
+                del self.pending[rqi]
+
+    # ===========
+    # Send a message without waiting for a response
+
+    def publish(self,topicReq,payload,qos=0):
+        return self.client.publish(topicReq, payload, qos)
+
+    def isConnected(self):
+        return self.client.is_connected()
+
+
+# ===========================================
+# Get the resource names listed in a discovery response
+# listing: optional DiscoveryListing (xware_lib_om2m) to only get the names
+#   that are new since its last update
+
+def urilFromResponse(obj,listing=None):
+    content = obj['m2m:rsp'].get('m2m:pc')
+    uris = []
+    if content and content.get('m2m:uril'):
+        uris = content['m2m:uril']['m2m:uril']
+    if listing is not None:
+        return listing.update(uris)
+    return lastUrlItem(uris)
+
+
+# ===========================================
+# A single device handled by the gateway runtime
+
+# deviceName: OM2M application name (and MQTT topic name) of the device
+# F, t, T: sampling frequency [Hz], sampling time [s] and period [s]
+# valueConversion: sensor to real value scaling
+# deviceTag, sensorTag: device and (comma separated) sensor identifiers
+# getValueFromSensor: acquisition function ('string' and 'numeric' modes)
+# getBlockFromSensor: acquisition function of n samples ('block' mode)
+
+# The remaining parameters match the ADVANCED PARAMETERS of the gateway client
+# (chunkSize is not used in 'features' edge mode)
+# startDelay: time between the start of the runtime and the registration of
+#   this device [s]
+
+class GatewayDevice:
+
+    def __init__(self,deviceName,F,t,T,valueConversion,deviceTag,sensorTag,
+                 getValueFromSensor=None,getBlockFromSensor=None,
+                 acquisitionMode='string',blockSize=100,blockPacing=1,sendPrecision=None,
+                 schedulerMode='hybrid',schedulerSpinTime=0.002,sendTimestamps=0,publishJitterStats=1,
+                 chunkSize=0,edgeMode='raw',featureWindow=0.1,featureBands=None,featurePeaks=3,
+                 featureThresholds=None,anomalyScoreLimit=0,baselineSamplings=10,
+                 alarmF=None,alarmT=None,alarmHold=3,publishCycleStats=0,startDelay=0):
+        self.deviceName = deviceName
+        self.F = F
+        self.t = t
+        self.T = T
+        self.valueConversion = valueConversion
+        self.deviceTag = deviceTag
+        self.sensorTag = sensorTag
+        self.getValueFromSensor = getValueFromSensor
+        self.getBlockFromSensor = getBlockFromSensor
+        self.acquisitionMode = acquisitionMode
+        self.blockSize = blockSize
+        self.blockPacing = blockPacing
+        self.sendPrecision = sendPrecision
+        self.sendTimestamps = sendTimestamps
+        self.publishJitterStats = publishJitterStats
+        self.chunkSize = chunkSize
+        self.deltaTime = 1/F
+        self.scheduler = SampleScheduler(self.deltaTime,schedulerMode,schedulerSpinTime,sendTimestamps)
+        self.publishCycleStats = publishCycleStats
+        self.startDelay = startDelay
+        self.messageIndex = 0
+        self.runtime = None
+        self.newCycle()
+        # Edge analytics
+        self.edgeMode = edgeMode
+        if edgeMode == 'features':
+            import xware_lib_features as features
+            self.features = features
+            self.featureWindow = featureWindow
+            self.featureBands = list(featureBands or [])
+            self.featurePeaks = featurePeaks
+            self.featureNames = features.featureNames(self.featureBands,featurePeaks)
+            self.detector = features.AnomalyDetector(self.featureNames,dict(featureThresholds or {}),anomalyScoreLimit,baselineSamplings)
+            self.chunkSize = 0
+            self.alarmHold = alarmHold
+            self.alarmCount = 0
+            # Sampling settings in normal and alarm state
+            # (samples taken at alarmF are sent with their capture times, as
+            # the Server only knows F)
+            alarmF = alarmF or F
+            alarmTimestamps = int(sendTimestamps or alarmF != F)
+            alarmScheduler = SampleScheduler(1/alarmF,schedulerMode,schedulerSpinTime,alarmTimestamps)
+            self.normalRate = (F, t, self.scheduler, sendTimestamps)
+            self.alarmRate = (alarmF, alarmT or t, alarmScheduler, alarmTimestamps)
+
+    # ===========
+    # Per-cycle measurements
+
+    def newCycle(self):
+        self.cycle = {'handshakeMs': 0.0, 'sensorReadMs': 0.0, 'sensorReadMaxUs': 0.0,
+                      'formatMs': 0.0, 'publishMs': 0.0, 'payloadBytes': 0}
+
+    # Summary of the cycle that just ended, as 'key=value,...' text
+    def cycleText(self):
+        summary = {'index': self.messageIndex}
+        summary.update(self.scheduler.stats())
+        summary.update(self.scheduler.intervalStats())
+        for key, value in self.cycle.items():
+            summary[key] = round(value, 3) if isinstance(value, float) else value
+        return statsToText(summary)
+
+    # ===========
+    # Set the OM2M targets and topics of this device (done by the runtime)
+
+    def attach(self,runtime):
+        self.runtime = runtime
+        serverCSE = runtime.serverCSE
+        serverName = runtime.serverName
+        self.topicReq = '/oneM2M/req/'+self.deviceName+'/'+serverCSE+'/json'
+        self.topicResp = '/oneM2M/resp/'+serverCSE+'/'+self.deviceName+'/json'
+        self.to_app = '/'+serverCSE+'/'+serverName
+        self.to_cont = '/'+serverCSE+'/'+serverName+'/'+self.deviceName
+        self.to_data = self.to_cont+'/'+runtime.containerName
+        self.to_events = self.to_cont+'/'+runtime.eventsContName
+
+    def request(self,buildPayload):
+        return self.runtime.mux.request(self.topicReq,buildPayload)
+
+    def send(self,payload):
+        self.runtime.send(self.topicReq,payload)
+
+    # ===========
+    # Create the OM2M application and containers of this device, if necessary
+
+    def register(self):
+        auth = self.runtime.authOM2M
+        containerName = self.runtime.containerName
+        eventsContName = self.runtime.eventsContName
+        # Check if OM2M application exists
+        apps = urilFromResponse(self.request(lambda rqi: searchApplicationsPayload(auth,self.to_app,rqi)))
+        # (numeric values are sent with a fixed number of decimals if
+        # sendPrecision is set, which the Server is told through a label)
+        precision = self.sendPrecision if self.acquisitionMode != 'string' else None
+        if not(self.deviceName in apps):
+            self.request(lambda rqi: createApplicationPayload(auth,self.to_app,rqi,self.F,self.t,self.T,
+                                                              self.valueConversion,self.deviceTag,self.sensorTag,self.deviceName,
+                                                              precision))
+        # Check if OM2M containers exist
+        containers = urilFromResponse(self.request(lambda rqi: searchContainersPayload(auth,self.to_cont,rqi)))
+        limits = self.runtime.containerLimits
+        if not(containerName in containers):
+            self.request(lambda rqi: createContainerPayload(auth,self.to_cont,rqi,containerName,*limits))
+        if not(eventsContName in containers):
+            self.request(lambda rqi: createContainerPayload(auth,self.to_cont,rqi,eventsContName,*limits))
+
+    # ===========
+    # Send START and wait for the TIMER answer of the Server
+
+    # If OM2M does not answer (to the START or while waiting for the TIMER) and
+    # the runtime has a queue, the START message is queued with the local start
+    # time instead, and acquisition goes on
+
+    def handshake(self):
+        auth = self.runtime.authOM2M
+        self.messageIndex += 1
+        startText = 'START\n'+self.deviceName+'\n'+str(self.messageIndex)
+        startTime = time.time()
+        try:
+            self.request(lambda rqi: createMessagePayload(auth,self.to_events,rqi,startText))
+            self.waitTimer()
+        except OM2MTimeoutError:
+            if self.runtime.queue is None:
+                raise
+            # (if the START did reach OM2M, the Server keeps its first start time)
+            print(self.deviceName + ': OM2M is unreachable, storing data locally')
+            self.send(createMessagePayload(auth,self.to_events,'123456',startText+'\n'+repr(startTime)))
+
+    # Wait for the TIMER answer to the last START
+    def waitTimer(self):
+        auth = self.runtime.authOM2M
+        listing = DiscoveryListing()
+        while True:
+            time.sleep(self.runtime.waitTime)
+            # Search for the messages that were not read yet
+            messageList = urilFromResponse(self.request(lambda rqi: searchMessagesPayload(auth,self.to_events,rqi)),listing)
+            # Read each message
+            for messageName in messageList:
+                to_message = self.to_events+'/'+messageName
+                obj = self.request(lambda rqi: readMessagePayload(auth,to_message,rqi))
+                try:
+                    messageText = obj["m2m:rsp"]["m2m:pc"]["m2m:cin"]["con"][1:-1]
+                except:
+                    # Not readable now: read it again at the next search
+                    messageText = '     '
+                    listing.retry([messageName])
+                # Check if this is the message we need
+                # (answers to STARTs that were sent while offline are discarded)
+                if messageText[:5] == 'TIMER':
+                    self.request(lambda rqi: deleteMessagePayload(auth,to_message,rqi))
+                    timerLines = messageText.splitlines()
+                    if len(timerLines) < 3 or timerLines[2] == str(self.messageIndex):
+                        return
+
+    # ===========
+    # Acquire one sampling (t*F samples)
+
+    # Returns the buffer text, or None if the sampling was sent in chunks of
+    # chunkSize samples while it was acquired
+
+    def acquire(self):
+        samplesInSampling = int(self.t*self.F)
+        currentBufferSize = 0
+        sentSamples = 0
+        chunkSeq = 0
+        deviceSamples = []
+        blockTimes = []
+        clock = self.scheduler.clock
+        readTime = 0.0
+        readMax = 0.0
+        self.scheduler.start()
+        while currentBufferSize < samplesInSampling:
+            readStart = clock()
+            if self.acquisitionMode == 'block':
+                n = min(self.blockSize, samplesInSampling - currentBufferSize)
+                blockTimes.append(readStart - self.scheduler.startTime)
+                deviceSamples.append(self.getBlockFromSensor(n))
+            else:
+                n = 1
+                deviceSamples.append(self.getValueFromSensor())
+            readDuration = clock() - readStart
+            readTime += readDuration
+            if readDuration > readMax:
+                readMax = readDuration
+            currentBufferSize += n
+            # Send a full chunk
+            if self.chunkSize and currentBufferSize - sentSamples >= self.chunkSize:
+                chunkBody = self.formatTimed(deviceSamples,blockTimes,sentSamples)
+                self.sendChunk(chunkSeq,0,chunkBody)
+                chunkSeq += 1
+                sentSamples = currentBufferSize
+                deviceSamples = []
+                blockTimes = []
+            if self.acquisitionMode != 'block' or self.blockPacing:
+                self.scheduler.wait(n)
+        deviceBuffer = self.formatTimed(deviceSamples,blockTimes,sentSamples)
+        self.cycle['sensorReadMs'] = readTime*1e3
+        self.cycle['sensorReadMaxUs'] = readMax*1e6
+        metrics.inc('xware_samples_total',currentBufferSize,device=self.deviceName,direction='sent')
+        if self.chunkSize:
+            self.sendChunk(chunkSeq,1,deviceBuffer)
+            return None
+        return deviceBuffer
+
+    # ===========
+    # Convert acquired samples to buffer text
+
+    def formatTimed(self,deviceSamples,blockTimes,firstSample=0):
+        with metrics.stage('format',device=self.deviceName) as timer:
+            deviceBuffer = self.formatBuffer(deviceSamples,blockTimes,firstSample)
+        self.cycle['formatMs'] += timer.duration*1e3
+        return deviceBuffer
+
+    # firstSample: position of the first of these samples in the sampling
+    # Capture times (if sent) of block samples are spaced 1/F apart from the
+    # time the block was requested
+
+    def formatBuffer(self,deviceSamples,blockTimes,firstSample=0):
+        if self.acquisitionMode == 'block':
+            deviceBuffer = ''
+            for block, blockTime in zip(deviceSamples, blockTimes):
+                blockTimestamps = None
+                if self.sendTimestamps:
+                    blockTimestamps = [blockTime + i*self.deltaTime for i in range(len(block))]
+                deviceBuffer += formatSampleBlock(block,self.sendPrecision,blockTimestamps)
+            return deviceBuffer
+        captureTimes = None
+        if self.sendTimestamps:
+            captureTimes = self.scheduler.captureTimes[firstSample:firstSample+len(deviceSamples)]
+        if self.acquisitionMode == 'numeric':
+            return formatSampleBlock(deviceSamples,self.sendPrecision,captureTimes)
+        return formatSampleBlock(list(map(str, deviceSamples)),None,captureTimes)
+
+    # ===========
+    # Send a buffer (if any) and the jitter statistics of its sampling
+
+    def sendBuffer(self,deviceBuffer):
+        auth = self.runtime.authOM2M
+        if deviceBuffer is not None:
+            if self.edgeMode == 'features':
+                self.sendFeatures(deviceBuffer)
+            elif self.runtime.dataPlane == 'mqtt':
+                self.sendChunk(0,1,deviceBuffer)
+            else:
+                self.sendData(deviceBuffer)
+        if self.publishJitterStats:
+            statsText = 'STATS\n'+self.deviceName+'\n'+str(self.messageIndex)+'\n'+statsToText(self.scheduler.stats())
+            self.send(createMessagePayload(auth,self.to_events,'123456',statsText))
+
+    def sendChunk(self,seq,final,body):
+        self.sendData(chunkMessage(self.messageIndex,seq,final,body))
+
+    def sendData(self,text):
+        metrics.inc('xware_buffers_total',device=self.deviceName,direction='sent')
+        metrics.inc('xware_bytes_total',len(text),device=self.deviceName,direction='sent')
+        publishStart = time.perf_counter()
+        if self.runtime.dataPlane == 'mqtt':
+            self.runtime.send(dataTopic(self.runtime.dataTopicPrefix,self.deviceName),text)
+        else:
+            self.send(createMessagePayload(self.runtime.authOM2M,self.to_data,'123456',text))
+        self.cycle['publishMs'] += (time.perf_counter() - publishStart)*1e3
+        self.cycle['payloadBytes'] += len(text)
+
+    # ===========
+    # Write the summary of the cycle to the cycle log (and to OM2M, if enabled)
+
+    def sendCycleStats(self):
+        text = self.cycleText()
+        if self.runtime.cycleLog is not None:
+            self.runtime.cycleLog.write(unixToDateString(time.time(),precision=3) + '\t' + self.deviceName + '\t' + text + '\n')
+        if self.publishCycleStats:
+            cycleMessage = 'CYCLE\n'+self.deviceName+'\n'+str(self.messageIndex)+'\n'+text
+            self.send(createMessagePayload(self.runtime.authOM2M,self.to_events,'123456',cycleMessage))
+
+    # ===========
+    # 'features' edge mode: send the features of a sampling, and its samples
+    # if it tripped or was taken in alarm state; then update the alarm state
+    # (the sampling settings change once the cycle statistics are sent)
+
+    def sendFeatures(self,deviceBuffer):
+        values = self.features.bufferToArray(deviceBuffer.splitlines(),self.valueConversion)
+        if len(values) == 0:
+            return
+        features = self.features.samplingFeatures(values,self.F,self.featureWindow,self.featureBands,self.featurePeaks)
+        tripped, score = self.detector.check(features)
+        alarmed = self.alarmCount > 0
+        # Samples first, so that the Server has them when it reads the features
+        if tripped or alarmed:
+            self.sendChunk(0,1,deviceBuffer)
+        sensorTagList = self.sensorTag.split(',')
+        windowSize = max(int(round(self.featureWindow*self.F)), 1)
+        rows = []
+        for i, windowRows in enumerate(features.tolist()):
+            for sensorTag, row in zip(sensorTagList, windowRows):
+                rows.append((i*windowSize/self.F, sensorTag, row))
+        self.sendData(featureMessage(self.messageIndex,tripped,score,self.featureNames,rows))
+        # Update alarm state (the baseline only learns from normal samplings)
+        if tripped:
+            if not(alarmed):
+                print(self.deviceName + ': anomaly detected (score ' + str(round(score, 2)) + '), sending samples')
+            self.alarmCount = self.alarmHold
+        elif alarmed:
+            self.alarmCount -= 1
+        else:
+            self.detector.learn(features)
+
+    def useRate(self,rate):
+        self.F, self.t, self.scheduler, self.sendTimestamps = rate
+        self.deltaTime = 1/self.F
+
+    # ===========
+    # Device thread: register, then sample every T seconds until stopped
+    # (after startDelay seconds, e.g. to ramp up many devices)
+
+    def run(self):
+        stopEvent = self.runtime.stopEvent
+        if stopEvent.wait(self.startDelay):
+            return
+        try:
+            # Registration needs OM2M; with a queue, keep retrying until it answers
+            while not(stopEvent.is_set()):
+                try:
+                    with metrics.stage('register',device=self.deviceName):
+                        self.register()
+                    break
+                except OM2MTimeoutError:
+                    if self.runtime.queue is None:
+                        raise
+                    print('Error: ' + self.deviceName + ' could not connect to OM2M, retrying')
+            nextTimePeriodT = time.time() + self.T
+            while not(stopEvent.is_set()):
+                print(self.deviceName + ': Begin cycle!')
+                # Trace ID of this sampling (its message index)
+                trace = self.deviceName + '/' + str(self.messageIndex + 1)
+                self.newCycle()
+                with metrics.stage('handshake',trace,device=self.deviceName) as timer:
+                    self.handshake()
+                self.cycle['handshakeMs'] = timer.duration*1e3
+                with metrics.stage('acquire',trace,device=self.deviceName):
+                    deviceBuffer = self.acquire()
+                print(self.deviceName + ': Done reading data! Sending buffer...')
+                with metrics.stage('upload',trace,device=self.deviceName):
+                    self.sendBuffer(deviceBuffer)
+                self.sendCycleStats()
+                if self.edgeMode == 'features':
+                    self.useRate(self.alarmRate if self.alarmCount > 0 else self.normalRate)
+                print(self.deviceName + ': Done sending data! Waiting for next period...')
+                stopEvent.wait(max(nextTimePeriodT - time.time(), 0))
+                nextTimePeriodT += self.T
+        except OM2MTimeoutError:
+            print('Error: ' + self.deviceName + ' could not connect to OM2M')
+
+
+# ===========================================
+# Gateway runtime: shared MQTT connection and one thread per device
+
+# brokerAddress: IP address of the MQTT broker
+# clientName: MQTT client ID of this gateway process
+# The OM2M names and wait times match the gateway client parameters
+# queue: optional DiskQueue for outgoing buffers (store-and-forward)
+# maxInflight: queued messages published before waiting for their QoS 1 acks
+# drainTime: when stopped, wait up to this long [s] for the queued messages to
+#   be delivered (0 = they stay on disk until the next start)
+# dataPlane: 'om2m' (samples are stored in OM2M) or 'mqtt' (samples are
+#   published to the dataTopicPrefix/[device name] topic, see xware_lib_stream)
+# cycleLog: optional RollingLog (xware_lib_functions) for the cycle summaries
+# containerMaxInstances, containerMaxBytes, containerMaxAge: limits (mni, mbs
+#   and mia) of the OM2M containers created for the devices (None = no limit)
+
+class GatewayRuntime:
+
+    def __init__(self,brokerAddress,clientName,serverCSE='in-cse',serverName='in-name',
+                 containerName='sampling',eventsContName='events',authOM2M='admin:admin',
+                 waitTime=0.1,retryWaitTime=1,maxWaitTime=6,queue=None,maxInflight=20,
+                 dataPlane='om2m',dataTopicPrefix='xware/data',cycleLog=None,
+                 containerMaxInstances=None,containerMaxBytes=None,containerMaxAge=None,drainTime=0):
+        self.serverCSE = serverCSE
+        self.serverName = serverName
+        self.containerName = containerName
+        self.eventsContName = eventsContName
+        self.authOM2M = authOM2M
+        self.waitTime = waitTime
+        self.retryWaitTime = retryWaitTime
+        self.maxWaitTime = maxWaitTime
+        self.queue = queue
+        self.maxInflight = maxInflight
+        self.drainTime = drainTime
+        self.dataPlane = dataPlane
+        self.dataTopicPrefix = dataTopicPrefix
+        self.cycleLog = cycleLog
+        self.containerLimits = (containerMaxInstances, containerMaxBytes, containerMaxAge)
+        self.mux = MQTTMultiplexer(clientName,brokerAddress,retryWaitTime,maxWaitTime)
+        self.devices = []
+        self.threads = []
+        self.stopEvent = threading.Event()
+        # The forwarding thread stops after the devices (see stop)
+        self.forwardStopEvent = threading.Event()
+        if queue is not None:
+            metrics.setFunction('xware_queue_depth',lambda: queue.diskUsage,queue='disk',unit='bytes')
+            metrics.setFunction('xware_dropped_messages_total',lambda: queue.droppedMessages,queue='disk')
+
+    def addDevice(self,device):
+        device.attach(self)
+        self.mux.subscribe(device.topicResp)
+        self.devices.append(device)
+        return device
+
+    # ===========
+    # Send a message, through the queue if there is one
+
+    def send(self,topicReq,payload):
+        if self.queue is None:
+            self.mux.publish(topicReq, payload)
+        elif not(self.queue.append(topicReq, payload)):
+            print('Error: local queue is full, message dropped')
+
+    # ===========
+    # Forwarding thread: deliver queued messages with QoS 1, oldest first
+
+    # Up to maxInflight messages are published at once; the queue only moves
+    # past the messages whose delivery the broker has acknowledged
+
+    def forward(self):
+        while not(self.forwardStopEvent.is_set()):
+            records = self.queue.peek(self.maxInflight, self.waitTime)
+            if not(records):
+                continue
+            if not(self.mux.isConnected()):
+                self.forwardStopEvent.wait(self.retryWaitTime)
+                continue
+            infos = [self.mux.publish(topic, payload, 1) for topic, payload, position in records]
+            delivered = None
+            for info, record in zip(infos, records):
+                try:
+                    info.wait_for_publish(self.maxWaitTime)
+                except (RuntimeError, ValueError):
+                    break
+                if not(info.is_published()):
+                    break
+                delivered = record[2]
+            if delivered is None:
+                self.forwardStopEvent.wait(self.retryWaitTime)
+            else:
+                self.queue.ack(delivered)
+
+    # ===========
+    # Connect and start one acquisition thread per device
+
+    def start(self):
+        self.mux.connect()
+        if self.queue is not None:
+            thread = threading.Thread(target=self.forward, name='forward', daemon=True)
+            thread.start()
+            self.forwardThread = thread
+        for device in self.devices:
+            thread = threading.Thread(target=device.run, name=device.deviceName, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopEvent.set()
+        for thread in self.threads:
+            thread.join()
+        if self.queue is not None:
+            # Deliver what the devices queued before they stopped
+            deadline = time.time() + self.drainTime
+            while self.queue.hasPending() and time.time() < deadline:
+                time.sleep(self.waitTime)
+            self.forwardStopEvent.set()
+            self.forwardThread.join()
+            self.queue.close()
+        self.mux.disconnect()
+
+    # ===========
+    # Run until every device stops, or until Ctrl+C is pressed
+
+    def run(self):
+        self.start()
+        try:
+            while any([thread.is_alive() for thread in self.threads]):
+                time.sleep(self.waitTime)
+        except KeyboardInterrupt:
+            pass
+        self.stop()
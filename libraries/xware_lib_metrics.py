@@ -0,0 +1,254 @@
+# Metrics and tracing for XWare
+# See Github repo (github.com/d-sanchezl/xware) for license details
+
+# A MetricsRegistry keeps counters, gauges and latency histograms, with
+# labels, and renders them in the Prometheus text format. startHTTP() serves
+# them on http://[address]:[port]/metrics, so that Prometheus (or curl) can
+# scrape the Server and the gateways while they run.
+
+# Per-stage latencies (e.g. 'fetch', 'write' or 'upload') go to the
+# xware_stage_seconds histogram, through stage():
+
+#with metrics.stage('fetch',device=deviceName):
+#    messageText = getMessageREST(...)
+
+# If tracing is enabled, every stage() with a trace ID is also written to a
+# file as a span (one JSON object per line), so the stages of a single buffer
+# can be followed from start to end.
+
+# The registry 'metrics' of this module is shared by all XWare libraries of a
+# process. Recording is cheap (a dictionary update), so it is always on; the
+# endpoint and the trace file are opt-in.
+
+# Import necessary packages
+import http.server
+import threading
+import bisect
+import json
+import time
+import math
+
+# Latency histogram buckets [s]
+latencyBuckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Metrics recorded by XWare: name, type and help text
+standardMetrics = [
+    ('xware_stage_seconds', 'histogram', 'Time spent in each processing stage'),
+    ('xware_buffers_total', 'counter', 'Sample buffers (or chunks) processed'),
+    ('xware_samples_total', 'counter', 'Samples processed'),
+    ('xware_bytes_total', 'counter', 'Bytes of sample buffers sent or received'),
+    ('xware_retries_total', 'counter', 'OM2M requests sent again after no response'),
+    ('xware_timeouts_total', 'counter', 'OM2M requests that got no response'),
+    ('xware_dropped_messages_total', 'counter', 'Messages dropped by a full local queue'),
+    ('xware_backlog_messages', 'gauge', 'Messages waiting to be processed, per device'),
+    ('xware_queue_depth', 'gauge', 'Messages or bytes waiting in a local queue'),
+    ('xware_container_fill_ratio', 'gauge', 'Messages or bytes in an OM2M container, relative to its mni or mbs limit'),
+    ]
+
+
+# ===========================================
+# Format label sets and values in the Prometheus text format
+
+def labelText(labels):
+    if not(labels):
+        return ''
+    items = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        items.append(key + '="' + value + '"')
+    return '{' + ','.join(items) + '}'
+
+def valueText(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+# ===========================================
+# Latency histogram of one label set
+
+class Histogram:
+
+    __slots__ = ('buckets', 'counts', 'total', 'count')
+
+    def __init__(self,buckets):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets)+1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self,value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+# ===========================================
+# Registry of all metrics of a process
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = {}
+        self.helps = {}
+        self.bucketsByName = {}
+        self.values = {}
+        self.functions = {}
+        self.traceFile = None
+        self.traceLock = threading.Lock()
+        self.httpServer = None
+        for name, kind, helpText in standardMetrics:
+            self.declare(name, kind, helpText)
+
+    # ===========
+    # Declare a metric (kind: 'counter', 'gauge' or 'histogram')
+
+    def declare(self,name,kind,helpText='',buckets=latencyBuckets):
+        with self.lock:
+            self.kinds[name] = kind
+            self.helps[name] = helpText
+            self.bucketsByName[name] = buckets
+            self.values.setdefault(name, {})
+
+    # ===========
+    # Record values; labels are given by name, e.g. inc('...',device='motor_1')
+
+    def inc(self,name,value=1,**labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values[name]
+            series[key] = series.get(key, 0) + value
+
+    def set(self,name,value,**labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[name][key] = value
+
+    def observe(self,name,value,**labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values[name]
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = Histogram(self.bucketsByName[name])
+                series[key] = histogram
+            histogram.observe(value)
+
+    # Gauge read when the metrics are rendered (e.g. the length of a queue)
+    def setFunction(self,name,function,**labels):
+        with self.lock:
+            self.functions[(name, tuple(sorted(labels.items())))] = function
+
+    # ===========
+    # Time a processing stage (and write a span, if tracing and given a trace ID)
+
+    def stage(self,stageName,trace=None,**labels):
+        return StageTimer(self,stageName,trace,labels)
+
+    def enableTracing(self,fileLocation):
+        self.traceFile = open(fileLocation, 'a', buffering=1)
+
+    def writeSpan(self,trace,stageName,startTime,duration,labels):
+        span = {'trace': trace, 'stage': stageName, 'start': round(startTime, 6), 'ms': round(duration*1e3, 3)}
+        span.update(labels)
+        with self.traceLock:
+            self.traceFile.write(json.dumps(span) + '\n')
+
+    # ===========
+    # Render all metrics in the Prometheus text format
+
+    def render(self):
+        with self.lock:
+            functions = list(self.functions.items())
+        computed = []
+        for (name, key), function in functions:
+            try:
+                computed.append((name, key, function()))
+            except Exception:
+                pass
+        lines = []
+        with self.lock:
+            for name, key, value in computed:
+                self.values[name][key] = value
+            for name in sorted(self.values):
+                series = self.values[name]
+                if not(series):
+                    continue
+                kind = self.kinds[name]
+                lines.append('# HELP ' + name + ' ' + self.helps[name])
+                lines.append('# TYPE ' + name + ' ' + kind)
+                for key in sorted(series):
+                    value = series[key]
+                    if kind != 'histogram':
+                        lines.append(name + labelText(key) + ' ' + valueText(value))
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(value.buckets + (math.inf,), value.counts):
+                        cumulative += count
+                        lines.append(name + '_bucket' + labelText(key + (('le', valueText(bound)),)) + ' ' + str(cumulative))
+                    lines.append(name + '_sum' + labelText(key) + ' ' + repr(value.total))
+                    lines.append(name + '_count' + labelText(key) + ' ' + str(value.count))
+        return '\n'.join(lines) + '\n'
+
+    # ===========
+    # Serve the metrics on http://[address]:[port]/metrics (in a thread)
+    # Returns the port (useful with port=0, which picks a free one)
+
+    def startHTTP(self,port,address='127.0.0.1'):
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def log_message(self,*args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpServer = http.server.ThreadingHTTPServer((address, port), Handler)
+        self.httpServer.daemon_threads = True
+        thread = threading.Thread(target=self.httpServer.serve_forever, name='metrics-http', daemon=True)
+        thread.start()
+        return self.httpServer.server_address[1]
+
+
+# ===========================================
+# Context manager returned by MetricsRegistry.stage()
+# (its 'duration' [s] can be read after the block)
+
+class StageTimer:
+
+    __slots__ = ('registry', 'stageName', 'trace', 'labels', 'startTime', 'duration')
+
+    def __init__(self,registry,stageName,trace,labels):
+        self.registry = registry
+        self.stageName = stageName
+        self.trace = trace
+        self.labels = labels
+
+    def __enter__(self):
+        self.startTime = time.perf_counter()
+        return self
+
+    def __exit__(self,excType,excValue,traceback):
+        duration = time.perf_counter() - self.startTime
+        self.duration = duration
+        self.registry.observe('xware_stage_seconds',duration,stage=self.stageName,**self.labels)
+        if self.trace is not None and self.registry.traceFile is not None:
+            self.registry.writeSpan(self.trace,self.stageName,time.time()-duration,duration,self.labels)
+        return False
+
+
+# Registry shared by the XWare libraries of this process
+metrics = MetricsRegistry()
@@ -5,8 +5,9 @@
 # https://github.com/SELF-Software-Evolution-Lab/Adaptive-Architecture-for-Transient-IoT-Systems
 
 # Import necessary packages
+import concurrent.futures
+import threading
 import requests
-import re
 import json
 import time
 
@@ -68,6 +69,27 @@ def onConnectMQTT(client, userdata, flags, rc):
     client.subscribe(userdata)
 
 
+# ===========================================
+# JSON encoding and decoding of OM2M payloads
+
+# orjson is used when it is installed, otherwise the standard library. Both
+# escape quotes, backslashes and control characters (e.g. the new lines in a
+# sample buffer), so any message text can be sent.
+
+# jsonDumps(obj): compact JSON text of obj
+# jsonLoads(text): parsed object of a JSON str or bytes
+
+try:
+    import orjson
+    def jsonDumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+    jsonLoads = orjson.loads
+except ImportError:
+    jsonEncoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    jsonDumps = jsonEncoder.encode
+    jsonLoads = json.loads
+
+
 # ===========================================
 # Create a primitive content MQTT payload for OM2M
 
@@ -78,19 +100,16 @@ def onConnectMQTT(client, userdata, flags, rc):
 # to = Target URL
 # op = Operation to perform
 # rqi = Request ID
-# pc = Request contents
+# pc = Request contents, as JSON text
 # ty = Object type
 
+# The payload is assembled from static fragments around the encoded fields,
+# so large contents (e.g. sample buffers) are only copied once
+
 def primitiveContentPayload(fr,to,op,rqi,pc,ty):
-    payload = '''{
-"m2m:rqp": {
-"m2m:fr" : "'''+fr+'''",
-"m2m:to" : "'''+to+'''",
-"m2m:op" : "'''+op+'''",
-"m2m:rqi": "'''+rqi+'''",
-"m2m:pc" : '''+pc+''',
-"m2m:ty" : "'''+ty+'''"}}'''
-    return payload
+    return '{"m2m:rqp":{"m2m:fr":' + jsonDumps(fr) + ',"m2m:to":' + jsonDumps(to) + \
+           ',"m2m:op":' + jsonDumps(op) + ',"m2m:rqi":' + jsonDumps(rqi) + \
+           ',"m2m:pc":' + pc + ',"m2m:ty":' + jsonDumps(ty) + '}}'
 
 
 # ===========================================
@@ -101,20 +120,23 @@ def primitiveContentPayload(fr,to,op,rqi,pc,ty):
 # sensor, var: XRepo tags
 # appName: OM2M name for the application
 
-def createApplicationPayload(auth,to,rqi,F,t,T,valueConversion,deviceTag,sensorTag,appName):
+def createApplicationPayload(auth,to,rqi,F,t,T,valueConversion,deviceTag,sensorTag,appName,precision=None):
     op = '1' # Operation: Create
     ty = '2' # Type: Application
-    pc = '''{
-"m2m:ae": {
-"api": "app-sensor",
-"rr": "false",
-"lbl": ["Frequency[Hz]/'''+str(F)+'''",
-"SampleTime[s]/'''+str(t)+'''",
-"Period[s]/'''+str(T)+'''",
-"ValueConversion/'''+str(valueConversion)+'''",
-"Device/'''+deviceTag+'''",
-"Sensor/'''+sensorTag+'''"],
-"rn": "'''+appName+'''"}}''' # Application metadata
+    labels = ["Frequency[Hz]/"+str(F),
+              "SampleTime[s]/"+str(t),
+              "Period[s]/"+str(T),
+              "ValueConversion/"+str(valueConversion),
+              "Device/"+deviceTag,
+              "Sensor/"+sensorTag]
+    # Decimal places of the values sent by the device, if fixed
+    if precision is not None:
+        labels.append("Precision/"+str(precision))
+    pc = jsonDumps({"m2m:ae": {
+        "api": "app-sensor",
+        "rr": "false",
+        "lbl": labels,
+        "rn": appName}}) # Application metadata
     return primitiveContentPayload(auth,to,op,rqi,pc,ty)
 
 
@@ -133,11 +155,18 @@ def deleteApplicationPayload(auth,to,rqi):
 # Create an MQTT payload, specifically to create a container
 # containerName = OM2M name for the container
 # to = target URL, which is usually '/in-cse/in-name/[app name]/'
+# mni, mbs, mia = optional limits of the container: maximum number of
+#   messages, total bytes and age [s]. Once a limit is reached, OM2M removes
+#   the oldest messages
 
-def createContainerPayload(auth,to,rqi,containerName):
+def createContainerPayload(auth,to,rqi,containerName,mni=None,mbs=None,mia=None):
     op = '1' # Operation: Create
     ty = '3' # Type: Container
-    pc = '''{"m2m:cnt": {"rn": "'''+containerName+'''"}}'''
+    container = {"rn": containerName}
+    for key, value in (("mni", mni), ("mbs", mbs), ("mia", mia)):
+        if value is not None:
+            container[key] = int(value)
+    pc = jsonDumps({"m2m:cnt": container})
     return primitiveContentPayload(auth,to,op,rqi,pc,ty)
 
 
@@ -149,7 +178,7 @@ def createContainerPayload(auth,to,rqi,containerName):
 def createMessagePayload(auth,to,rqi,message):
     op = '1' # Operation: Create
     ty = '4' # Type: Message
-    pc = '''{"m2m:cin": {"cnf": "message", "con": "'''+message+'''"}}'''
+    pc = '{"m2m:cin":{"cnf":"message","con":' + jsonDumps(message) + '}}'
     return primitiveContentPayload(auth,to,op,rqi,pc,ty)
 
 
@@ -184,14 +213,9 @@ def deleteMessagePayload(auth,to,rqi):
 # ty = Object type
 
 def filterCriteriaPayload(fr,to,rqi,ty):
-    payload = '''{
-"m2m:rqp": {
-"m2m:fr" : "'''+fr+'''",
-"m2m:to" : "'''+to+'''",
-"m2m:op" : "2",
-"m2m:rqi": "'''+rqi+'''",
-"m2m:fc" : {"m2m:fu": "1", "m2m:ty":"'''+ty+'''"}}}'''
-    return payload
+    return '{"m2m:rqp":{"m2m:fr":' + jsonDumps(fr) + ',"m2m:to":' + jsonDumps(to) + \
+           ',"m2m:op":"2","m2m:rqi":' + jsonDumps(rqi) + \
+           ',"m2m:fc":{"m2m:fu":"1","m2m:ty":' + jsonDumps(ty) + '}}}'
 
 
 # ===========================================
@@ -228,8 +252,8 @@ def createMessageREST(auth="admin:admin",ip="127.0.0.1:8080",serverCSE="in-cse",
     # Build and send POST
     header = {"X-M2M-Origin": auth, "Content-Type" : "application/json;ty=4"}
     url = "http://"+ip+"/~/"+serverCSE+"/"+serverName+"/"+appName+"/"+containerName
-    payload = {"m2m:cin": {"cnf": "message", "con": '"'+message+'"'}}
-    return requests.post(url, json=payload, headers=header)
+    payload = '{"m2m:cin":{"cnf":"message","con":' + jsonDumps('"'+message+'"') + '}}'
+    return requests.post(url, data=payload.encode('utf-8'), headers=header)
 
 
 # ===========================================
@@ -243,7 +267,7 @@ def listApplicationsREST(auth="admin:admin",ip="127.0.0.1:8080",serverCSE="in-cs
     # If successful, find individual message names
     if response.status_code == 200:
         # Get actual message contents
-        obj = json.loads(response.text)
+        obj = jsonLoads(response.content)
         return obj['m2m:uril']
     else:
         return []
@@ -260,7 +284,7 @@ def listMessagesREST(auth="admin:admin",ip="127.0.0.1:8080",serverCSE="in-cse",s
     # If successful, find individual message names
     if response.status_code == 200:
         # Get actual message contents
-        obj = json.loads(response.text)
+        obj = jsonLoads(response.content)
         return obj['m2m:uril']
     else:
         return []
@@ -277,7 +301,7 @@ def readApplicationLabelsREST(auth="admin:admin",ip="127.0.0.1:8080",serverCSE="
     response = requests.get(url, headers=header)
     # If successful, find app labels
     if response.status_code == 200:
-        obj = json.loads(response.text)
+        obj = jsonLoads(response.content)
         objList = obj['m2m:ae']['lbl']
         # Create dictionary of labels
         dictio = {}
@@ -291,6 +315,23 @@ def readApplicationLabelsREST(auth="admin:admin",ip="127.0.0.1:8080",serverCSE="
         return {}
 
 
+# ===========================================
+# Read a container via HTTP REST
+# The output is a dictionary of its attributes, e.g. 'cni' and 'cbs' (current
+# number of messages and bytes) and, if set, 'mni', 'mbs' and 'mia' (limits)
+
+def readContainerREST(auth="admin:admin",ip="127.0.0.1:8080",serverCSE="in-cse",serverName="in-name",appName="",containerName=""):
+    # Build and send GET
+    header = {"X-M2M-Origin": auth, "Accept": "application/json"}
+    url = "http://"+ip+"/~/"+serverCSE+"/"+serverName+"/"+appName+"/"+containerName
+    response = requests.get(url, headers=header)
+    # If successful, return the container attributes
+    if response.status_code == 200:
+        return jsonLoads(response.content)['m2m:cnt']
+    else:
+        return {}
+
+
 # ===========================================
 # Read a specific message from OM2M via HTTP REST
 
@@ -301,7 +342,7 @@ def getMessageREST(auth="admin:admin",ip="127.0.0.1:8080",serverCSE="in-cse",ser
     response = requests.get(url, headers=header)
     # If successful, find message contents
     if response.status_code == 200:
-        obj = json.loads(response.text)
+        obj = jsonLoads(response.content)
         return obj['m2m:cin']['con']
     else:
         return []
@@ -333,19 +374,220 @@ def deleteApplicationREST(auth="admin:admin",ip="127.0.0.1:8080",serverCSE="in-c
 # urlList = single url string or list of url strings
 
 def lastUrlItem(urlList):
-    itemsList = []
     # Verify if the input is a single string and act accordingly
     if isinstance(urlList, str):
         urlList = [urlList]
-    # For every item in the list
-    for item in urlList:
-        # Find the last slash
-        index = None
-        for m in re.finditer(r"/", item):
-            index = m.start()
-        # Add everything after the last slash
-        if not(index is None):
-            itemsList.append(item[index+1:])
-        else:
-            itemsList.append(item)
-    return itemsList
+    # Everything after the last slash of every item
+    return [item.rpartition('/')[2] for item in urlList]
+
+
+# ===========================================
+# Resource names of successive discovery responses (m2m:uril) of a container
+
+# update() returns, in order, the names of the resources that were not in the
+# previous listing (only their URI's are parsed), so that each message is
+# handed to the processing loop once. Names that could not be handled yet are
+# handed again by the next update() if they are passed to retry().
+
+# Usage:
+
+#listing = DiscoveryListing()
+#for messageName in listing.update(listMessagesREST(...)):
+#    ...
+
+class DiscoveryListing:
+
+    def __init__(self):
+        # URI: resource name, for every resource of the last listing
+        self.uris = {}
+
+    def __len__(self):
+        return len(self.uris)
+
+    def __contains__(self,name):
+        return name in self.uris.values()
+
+    # All names of the last listing
+    def names(self):
+        return list(self.uris.values())
+
+    # ===========
+    # Replace the listing; returns the names that are new
+
+    def update(self,urlList):
+        if isinstance(urlList, str):
+            urlList = [urlList]
+        previous = self.uris
+        self.uris = {}
+        newNames = []
+        for uri in urlList:
+            name = previous.get(uri)
+            if name is None:
+                name = uri.rpartition('/')[2]
+                newNames.append(name)
+            self.uris[uri] = name
+        return newNames
+
+    # Hand these names again at the next update()
+    def retry(self,names):
+        names = set(names)
+        for uri in [uri for uri, name in self.uris.items() if name in names]:
+            del self.uris[uri]
+
+
+# ===========================================
+# Delete OM2M resources concurrently, e.g. the old applications found when the
+# Server starts
+
+# Up to 'workers' requests are sent at once (each worker thread keeps its own
+# HTTP connection), and the progress is reported every progressInterval
+# seconds through the 'log' function.
+
+# Without a retention policy, whole applications are deleted. With one, the
+# applications and containers are kept, and only messages are deleted:
+# keepMessages: keep the last N messages of each container (None = no limit;
+#   OM2M lists messages in creation order)
+# maxAge: only delete messages older than this [s] (None = any age). Uses the
+#   'crb' (created before) discovery filter of OM2M, in the local time zone
+
+# run() blocks until every resource is deleted; start() runs it in a thread,
+# and isPending() tells which applications are still being cleaned up.
+
+# Usage:
+
+#cleaner = OM2MCleaner(auth,ip,serverCSE,serverName,workers=8)
+#cleaner.run(['induction_motor_1','induction_motor_2'])
+
+class OM2MCleaner:
+
+    def __init__(self,auth="admin:admin",ip="127.0.0.1:8080",serverCSE="in-cse",serverName="in-name",
+                 workers=8,keepMessages=None,maxAge=None,progressInterval=5,log=print,retries=2):
+        self.auth = auth
+        self.ip = ip
+        self.serverCSE = serverCSE
+        self.serverName = serverName
+        self.workers = workers
+        self.keepMessages = keepMessages
+        self.maxAge = maxAge
+        self.progressInterval = progressInterval
+        self.log = log
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pending = set()
+        self.total = 0
+        self.deleted = 0
+        self.failed = 0
+        self.thread = None
+
+    def isPending(self,appName):
+        with self.lock:
+            return appName in self.pending
+
+    # ===========
+    # HTTP requests (one connection per worker thread)
+    # uri: resource ID, e.g. '/in-cse/in-name/[app name]'
+
+    def send(self,method,uri,query=''):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            self.local.session = session
+        header = {"X-M2M-Origin": self.auth, "Accept": "application/json"}
+        return session.request(method, "http://"+self.ip+"/~"+uri+query, headers=header)
+
+    def discover(self,uri,ty,createdBefore=None):
+        query = "?fu=1&ty="+str(ty)
+        if createdBefore is not None:
+            query += "&crb="+time.strftime('%Y%m%dT%H%M%S', time.localtime(createdBefore))
+        response = self.send('GET', uri, query)
+        if response.status_code != 200:
+            return []
+        found = jsonLoads(response.content)['m2m:uril']
+        return found.split() if isinstance(found, str) else found
+
+    # ===========
+    # Resources to delete for one application, following the retention policy
+
+    def targets(self,appName):
+        appUri = '/'+self.serverCSE+'/'+self.serverName+'/'+appName
+        if self.keepMessages is None and self.maxAge is None:
+            return [appUri]
+        createdBefore = None if self.maxAge is None else time.time() - self.maxAge
+        uris = []
+        for containerUri in self.discover(appUri, 3):
+            messages = self.discover(containerUri, 4, createdBefore)
+            if self.keepMessages is not None:
+                kept = self.discover(containerUri, 4)[-self.keepMessages:] if self.keepMessages else []
+                kept = set(kept)
+                messages = [uri for uri in messages if not(uri in kept)]
+            uris += messages
+        return uris
+
+    # Delete one resource (retried on connection errors and server errors)
+    def delete(self,uri):
+        for attempt in range(self.retries+1):
+            try:
+                response = self.send('DELETE', uri)
+                if response.status_code < 500:
+                    return response.status_code in (200, 202, 204, 404)
+            except requests.RequestException:
+                pass
+        return False
+
+    # ===========
+    # Clean up the given applications (returns the number of failed deletes)
+
+    def run(self,appNames):
+        with self.lock:
+            self.pending = set(appNames)
+            self.total = 0
+            self.deleted = 0
+            self.failed = 0
+        if not(appNames):
+            return 0
+        startTime = time.time()
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            # List what to delete (all applications at once), then delete it
+            remaining = {}
+            futures = {}
+            for appName, uris in zip(appNames, pool.map(self.targets, appNames)):
+                remaining[appName] = len(uris)
+                for uri in uris:
+                    futures[pool.submit(self.delete, uri)] = appName
+            with self.lock:
+                self.total = len(futures)
+                self.pending = set([appName for appName, count in remaining.items() if count])
+            notDone = set(futures)
+            nextReport = time.time() + self.progressInterval
+            while notDone:
+                done, notDone = concurrent.futures.wait(notDone, max(nextReport - time.time(), 0),
+                                                        concurrent.futures.FIRST_COMPLETED)
+                with self.lock:
+                    for future in done:
+                        appName = futures[future]
+                        if future.result():
+                            self.deleted += 1
+                        else:
+                            self.failed += 1
+                        remaining[appName] -= 1
+                        if not(remaining[appName]):
+                            self.pending.discard(appName)
+                if time.time() >= nextReport and notDone:
+                    self.log(self.progressText())
+                    nextReport += self.progressInterval
+        self.log(self.progressText() + ' in ' + str(round(time.time() - startTime, 1)) + ' s')
+        return self.failed
+
+    def start(self,appNames):
+        with self.lock:
+            self.pending = set(appNames)
+        self.thread = threading.Thread(target=self.run, args=(appNames,), name='om2m-cleanup', daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def progressText(self):
+        text = 'OM2M cleanup: ' + str(self.deleted) + '/' + str(self.total) + ' resources deleted'
+        if self.failed:
+            text += ' (' + str(self.failed) + ' failed)'
+        return text
@@ -0,0 +1,210 @@
+# Durable outbound queue (store-and-forward) for the XWare gateway
+# See Github repo (github.com/d-sanchezl/xware) for license details
+
+# Messages are appended to segment files in a local folder, and are only
+# removed once they have been delivered. This keeps sampled buffers safe while
+# the MQTT broker or OM2M are unreachable, and across gateway restarts.
+
+# Folder layout:
+# * 000000000001.seg, 000000000002.seg, ...: append-only segment files
+# * cursor: segment number and offset of the next message to deliver
+
+# Each record in a segment is a 12-byte header (topic length, payload length
+# and CRC32 of both, big-endian) followed by the topic and the payload. A
+# partially written record at the end of a segment (e.g. after a power cut) is
+# detected by its length or CRC and ignored.
+
+# Import necessary packages
+import os
+import struct
+import threading
+import zlib
+
+headerFormat = '>III'
+headerSize = struct.calcsize(headerFormat)
+
+# ===========================================
+# Durable segment-based FIFO queue
+
+# location: folder where the segments are stored (created if necessary)
+# segmentSize: size at which a new segment file is started [bytes]
+# maxDiskUsage: maximum total size of the segments [bytes]
+# evictionPolicy: what to do when maxDiskUsage is reached:
+#   'drop-oldest' deletes the oldest segment, 'drop-newest' rejects new messages
+# sync: set to 1 to fsync every appended message (slower, survives power cuts)
+
+class DiskQueue:
+
+    def __init__(self,location,segmentSize=16*1024*1024,maxDiskUsage=512*1024*1024,
+                 evictionPolicy='drop-oldest',sync=0):
+        if not(evictionPolicy in ('drop-oldest', 'drop-newest')):
+            raise ValueError('Unknown eviction policy: ' + str(evictionPolicy))
+        self.location = location
+        self.segmentSize = segmentSize
+        self.maxDiskUsage = maxDiskUsage
+        self.evictionPolicy = evictionPolicy
+        self.sync = sync
+        self.lock = threading.Lock()
+        self.notEmpty = threading.Condition(self.lock)
+        self.droppedMessages = 0
+        if not(os.path.isdir(location)):
+            os.makedirs(location)
+        self.segments = sorted([int(name[:-4]) for name in os.listdir(location) if name.endswith('.seg')])
+        if not(self.segments):
+            self.segments = [1]
+        self.readSegment, self.readOffset = self.loadCursor()
+        if not(self.readSegment in self.segments):
+            self.readSegment, self.readOffset = self.segments[0], 0
+        self.repairTail()
+        self.writeFile = open(self.segmentPath(self.segments[-1]), 'ab')
+        self.diskUsage = sum([os.path.getsize(self.segmentPath(number)) for number in self.segments])
+
+    def segmentPath(self,number):
+        return os.path.join(self.location, '%012d.seg' % number)
+
+    # ===========
+    # Read and write the delivery cursor (replaced atomically)
+
+    def loadCursor(self):
+        try:
+            with open(os.path.join(self.location, 'cursor'), 'r') as file:
+                segment, offset = file.read().split()
+            return int(segment), int(offset)
+        except (OSError, ValueError):
+            return 0, 0
+
+    def saveCursor(self):
+        tempPath = os.path.join(self.location, 'cursor.tmp')
+        with open(tempPath, 'w') as file:
+            file.write(str(self.readSegment) + ' ' + str(self.readOffset))
+        os.replace(tempPath, os.path.join(self.location, 'cursor'))
+
+    # ===========
+    # Cut a partially written record from the end of the last segment
+
+    def repairTail(self):
+        path = self.segmentPath(self.segments[-1])
+        if not(os.path.isfile(path)):
+            return
+        with open(path, 'r+b') as file:
+            validEnd = 0
+            while self.readRecord(file):
+                validEnd = file.tell()
+            file.truncate(validEnd)
+
+    # ===========
+    # Append a message to the queue
+    # Returns 1 if the message was stored, or 0 if it was rejected
+
+    def append(self,topic,payload):
+        topic = topic.encode('utf-8')
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        header = struct.pack(headerFormat, len(topic), len(payload), zlib.crc32(payload, zlib.crc32(topic)))
+        record = header + topic + payload
+        with self.lock:
+            if not(self.makeRoom(len(record))):
+                self.droppedMessages += 1
+                return 0
+            if self.writeFile.tell() > 0 and self.writeFile.tell() + len(record) > self.segmentSize:
+                self.writeFile.close()
+                self.segments.append(self.segments[-1] + 1)
+                self.writeFile = open(self.segmentPath(self.segments[-1]), 'ab')
+            self.writeFile.write(record)
+            self.writeFile.flush()
+            if self.sync:
+                os.fsync(self.writeFile.fileno())
+            self.diskUsage += len(record)
+            self.notEmpty.notify_all()
+            return 1
+
+    # ===========
+    # Apply the eviction policy until a record of 'size' bytes fits
+    # (must be called with the lock held)
+
+    def makeRoom(self,size):
+        while self.diskUsage + size > self.maxDiskUsage:
+            if self.evictionPolicy == 'drop-newest' or len(self.segments) == 1:
+                return 0
+            oldest = self.segments.pop(0)
+            self.droppedMessages += self.countRecords(oldest, self.readOffset if oldest == self.readSegment else 0)
+            self.diskUsage -= os.path.getsize(self.segmentPath(oldest))
+            os.remove(self.segmentPath(oldest))
+            if self.readSegment <= oldest:
+                self.readSegment, self.readOffset = self.segments[0], 0
+                self.saveCursor()
+        return 1
+
+    def countRecords(self,number,offset):
+        count = 0
+        with open(self.segmentPath(number), 'rb') as file:
+            file.seek(offset)
+            while self.readRecord(file):
+                count += 1
+        return count
+
+    # ===========
+    # Read one record from an open segment file
+    # Returns (topic, payload), or None at the end of the written data
+
+    def readRecord(self,file):
+        header = file.read(headerSize)
+        if len(header) < headerSize:
+            return None
+        topicLength, payloadLength, crc = struct.unpack(headerFormat, header)
+        topic = file.read(topicLength)
+        payload = file.read(payloadLength)
+        if len(payload) < payloadLength or zlib.crc32(payload, zlib.crc32(topic)) != crc:
+            return None
+        return topic.decode('utf-8'), payload
+
+    # ===========
+    # Get up to n undelivered messages, oldest first, without removing them
+
+    # Returns a list of (topic, payload, position) tuples. Pass the position of
+    # the last delivered message to ack() to remove it and all before it.
+
+    def peek(self,n=1,timeout=None):
+        with self.lock:
+            if timeout and not(self.hasPending()):
+                self.notEmpty.wait(timeout)
+            records = []
+            segment, offset = self.readSegment, self.readOffset
+            while len(records) < n:
+                with open(self.segmentPath(segment), 'rb') as file:
+                    file.seek(offset)
+                    while len(records) < n:
+                        record = self.readRecord(file)
+                        if record is None:
+                            break
+                        offset = file.tell()
+                        records.append(record + ((segment, offset),))
+                # Continue in the next segment, if there is one
+                if len(records) < n and segment != self.segments[-1]:
+                    segment, offset = self.segments[self.segments.index(segment) + 1], 0
+                else:
+                    break
+            return records
+
+    def hasPending(self):
+        return self.readSegment != self.segments[-1] or self.readOffset < self.writeFile.tell()
+
+    # ===========
+    # Mark messages as delivered, up to and including 'position'
+    # Segments that have been fully delivered are deleted
+
+    def ack(self,position):
+        with self.lock:
+            segment, offset = position
+            if not(segment in self.segments) or (segment, offset) < (self.readSegment, self.readOffset):
+                return
+            while self.segments[0] < segment:
+                oldest = self.segments.pop(0)
+                self.diskUsage -= os.path.getsize(self.segmentPath(oldest))
+                os.remove(self.segmentPath(oldest))
+            self.readSegment, self.readOffset = segment, offset
+            self.saveCursor()
+
+    def close(self):
+        with self.lock:
+            self.writeFile.close()
@@ -0,0 +1,124 @@
+# Fast replay of recorded samples, for simulated gateways and load tests
+# See Github repo (github.com/d-sanchezl/xware) for license details
+
+# The input files ('time<tab>value' or 'time,value' lines, such as
+# examples/simulated_input.txt) are loaded once into a single NumPy array of
+# values. The times in the files are ignored. Consecutive values are grouped
+# into samples of 'sensors' values, and the files are replayed in a loop, so
+# a block of any size is served with one array operation.
+
+# The source can pace itself: with F given, each block is only returned once
+# its samples would have been acquired at F*speed samples per second. A speed
+# of 10 replays 10 s of data every second. Use it with the 'block'
+# acquisition mode and blockPacing = 0. If the caller stops asking for blocks
+# for a while (e.g. between samplings), pacing starts again from that moment
+# instead of catching up in a burst.
+
+# This module requires NumPy
+
+# Usage:
+
+#replay = ReplaySource('C:/Users/User/XWare/simulated_acquisition',sensors=3,F=1000,speed=10)
+#def getBlockFromSensor(n):
+#    return replay.readBlock(n)
+
+# Import necessary packages
+import numpy as np
+import time
+import os
+
+
+# ===========================================
+# Load the values of one input file
+
+# fullFileName: path of a 'time<tab>value' or 'time,value' text file
+# cache: set to 1 to keep a binary copy ([file].npy) next to the file, which
+#   is memory-mapped on the next load instead of parsing the text again
+
+def loadValues(fullFileName,cache=0):
+    cacheName = fullFileName + '.npy'
+    if cache and os.path.isfile(cacheName) and os.path.getmtime(cacheName) >= os.path.getmtime(fullFileName):
+        return np.load(cacheName, mmap_mode='r')
+    with open(fullFileName, 'r') as file:
+        text = file.read()
+    items = text.replace('\t', ',').split()
+    values = np.array([line.split(',', 1)[1] for line in items if ',' in line], dtype=float)
+    if cache:
+        np.save(cacheName, values)
+    return values
+
+
+# ===========================================
+# Replay source
+
+# location: folder of input files (all '.txt' and '.csv' files in it, in name
+#   order), a single file, a list of files, or the values of another source
+#   (to share them, e.g. replay.values)
+# sensors: values per sample
+# F: nominal sampling frequency [Hz]; None returns blocks right away
+# speed: replay speed, relative to real time
+# cache: see loadValues()
+# maxLag: delay behind the pacing deadlines after which pacing starts again [s]
+
+class ReplaySource:
+
+    def __init__(self,location,sensors=1,F=None,speed=1,cache=0,maxLag=0.1):
+        if isinstance(location, np.ndarray):
+            self.values = location
+        else:
+            if isinstance(location, (list, tuple)):
+                fileList = list(location)
+            elif os.path.isdir(location):
+                fileList = [os.path.join(location, name) for name in sorted(os.listdir(location))
+                            if name.endswith('.txt') or name.endswith('.csv')]
+            else:
+                fileList = [location]
+            self.values = np.concatenate([loadValues(fileName,cache) for fileName in fileList])
+        if len(self.values) == 0:
+            raise ValueError('No values found in ' + str(location))
+        self.sensors = sensors
+        self.position = 0
+        self.samplePeriod = 1/(F*speed) if F else 0
+        self.maxLag = maxLag
+        self.startTime = None
+        self.samplesServed = 0
+
+    # ===========
+    # Next n samples, as an (n x sensors) array
+
+    def readBlock(self,n):
+        count = n*self.sensors
+        start = self.position
+        self.position = (start + count) % len(self.values)
+        if start + count <= len(self.values):
+            block = self.values[start:start+count]
+        else:
+            block = np.take(self.values, np.arange(start, start+count), mode='wrap')
+        if self.samplePeriod:
+            self.pace(n)
+        return block.reshape(n, self.sensors)
+
+    # Next sample, as numbers ('numeric' mode) or as text ('string' mode)
+    def readSample(self):
+        return self.readBlock(1)[0]
+
+    def readString(self):
+        return ','.join(map(repr, self.readBlock(1)[0].tolist()))
+
+    # ===========
+    # Wait until the last of the samples served so far is due
+    # (deadlines are absolute, counted from the first block after a pause)
+
+    def pace(self,n):
+        now = time.perf_counter()
+        if self.startTime is None or now - (self.startTime + self.samplesServed*self.samplePeriod) > self.maxLag:
+            self.restart(now)
+        self.samplesServed += n
+        deadline = self.startTime + self.samplesServed*self.samplePeriod
+        if deadline > now:
+            time.sleep(deadline - now)
+
+    # Restart the pacing clock
+    def restart(self,now=None):
+        self.startTime = now
+        self.samplesServed = 0
@@ -0,0 +1,137 @@
+# Sampling schedulers used by the XWare gateway
+# See Github repo (github.com/d-sanchezl/xware) for license details
+
+# A scheduler paces the 1/F acquisition loop. Deadlines are absolute (they are
+# computed from the start time, never from the time a sample was taken), so
+# the schedule does not drift when a single read is slow.
+
+# Any object with the same start(), wait(), captureTimes and stats() members
+# can be used by the gateway instead of the SampleScheduler below.
+
+# Import necessary packages
+import time
+import math
+
+# ===========================================
+# Sample scheduler with absolute deadlines and jitter statistics
+
+# deltaTime: nominal time between samples [s], i.e. 1/F
+# mode: 'hybrid' (sleep, then spin until the deadline), 'sleep' or 'spin'
+# spinTime: in 'hybrid' mode, time before the deadline when sleeping stops [s]
+# recordTimestamps: set to 1 to keep the capture time of every sample
+# clock: high precision clock function, e.g. time.monotonic or time.perf_counter
+
+class SampleScheduler:
+
+    def __init__(self,deltaTime,mode='hybrid',spinTime=0.002,recordTimestamps=0,clock=time.perf_counter):
+        if not(mode in ('hybrid', 'sleep', 'spin')):
+            raise ValueError('Unknown scheduler mode: ' + str(mode))
+        self.deltaTime = deltaTime
+        self.mode = mode
+        self.spinTime = spinTime
+        self.recordTimestamps = recordTimestamps
+        self.clock = clock
+        self.start()
+
+    # ===========
+    # Start a new sampling: set the first deadline and clear statistics
+    # The first sample is captured right away, at time 0
+
+    def start(self,startTime=None):
+        if startTime is None:
+            startTime = self.clock()
+        self.startTime = startTime
+        self.sampleIndex = 0
+        self.lateness = []
+        self.intervals = []
+        self.lastCapture = 0.0
+        self.missedDeadlines = 0
+        self.captureTimes = []
+        if self.recordTimestamps:
+            self.captureTimes.append(0.0)
+
+    # ===========
+    # Wait until the deadline of the sample that follows the next n samples
+    # Returns the capture time of that sample, relative to the start [s]
+
+    def wait(self,n=1):
+        self.sampleIndex += n
+        deadline = self.startTime + self.sampleIndex*self.deltaTime
+        now = self.clock()
+        # Overrun: the deadline passed before the previous read finished
+        # The schedule is kept, so the following samples catch up on it
+        if now > deadline:
+            self.missedDeadlines += 1
+        else:
+            if self.mode == 'sleep':
+                while now < deadline:
+                    time.sleep(deadline - now)
+                    now = self.clock()
+            else:
+                if self.mode == 'hybrid' and deadline - now > self.spinTime:
+                    time.sleep(deadline - now - self.spinTime)
+                while now < deadline:
+                    now = self.clock()
+        self.lateness.append(now - deadline)
+        captureTime = now - self.startTime
+        self.intervals.append((captureTime - self.lastCapture)/n)
+        self.lastCapture = captureTime
+        if self.recordTimestamps:
+            self.captureTimes.append(captureTime)
+        return captureTime
+
+    # ===========
+    # Jitter statistics of the current sampling, as a dictionary
+    # Lateness values are given in microseconds
+
+    def stats(self):
+        ordered = sorted(self.lateness)
+        return {'samples': self.sampleIndex,
+                'p50LatenessUs': round(percentile(ordered,50)*1e6, 1),
+                'p99LatenessUs': round(percentile(ordered,99)*1e6, 1),
+                'maxLatenessUs': round((ordered[-1] if ordered else 0.0)*1e6, 1),
+                'missedDeadlines': self.missedDeadlines}
+
+    # ===========
+    # Actual time between samples of the current sampling, as a dictionary
+    # (in 'block' mode, the time between blocks divided by the block size)
+    # Values are given in microseconds
+
+    def intervalStats(self):
+        ordered = sorted(self.intervals)
+        return {'nominalIntervalUs': round(self.deltaTime*1e6, 1),
+                'minIntervalUs': round((ordered[0] if ordered else 0.0)*1e6, 1),
+                'p1IntervalUs': round(percentile(ordered,1)*1e6, 1),
+                'p50IntervalUs': round(percentile(ordered,50)*1e6, 1),
+                'p99IntervalUs': round(percentile(ordered,99)*1e6, 1),
+                'maxIntervalUs': round((ordered[-1] if ordered else 0.0)*1e6, 1)}
+
+
+# ===========================================
+# Nearest-rank percentile of an already sorted list
+
+# ordered: sorted list of numbers
+# p: percentile, from 0 to 100
+
+def percentile(ordered,p):
+    if not(ordered):
+        return 0.0
+    rank = max(int(math.ceil(p/100*len(ordered))), 1)
+    return ordered[rank-1]
+
+
+# ===========================================
+# Convert jitter statistics to message text and back
+
+# The text form ('key=value,key=value') has no quotes, so it can be placed
+# directly in an OM2M message
+
+def statsToText(stats):
+    return ','.join([key + '=' + str(value) for key, value in stats.items()])
+
+def textToStats(text):
+    stats = {}
+    for item in text.split(','):
+        key, _, value = item.partition('=')
+        stats[key] = float(value)
+    return stats
@@ -0,0 +1,348 @@
+# Per-device sampling state of the XWare Server
+# See Github repo (github.com/d-sanchezl/xware) for license details
+
+# For every device, the Server needs the index of the last sampling it wrote
+# and the start time of each sampling whose START it has received but whose
+# values it has not written yet. Each device keeps these in a DeviceState: a
+# ring of ringSize (index, start time) slots, so memory does not grow with
+# the number of samplings. A START overwrites the slot of the sampling
+# ringSize indexes before it, which is usually long done. If that sampling is
+# still pending (the Server lags more than ringSize samplings, or a gateway
+# sends the STARTs it queued while offline), the ring is doubled instead, so
+# no pending START is ever lost.
+
+# A DeviceStateStore holds the states of all devices and can save them to a
+# small text file (replaced atomically), one line per device:
+
+#  [device name]\t[current index]\t[index]:[start time],[index]:[start time],...
+
+# The file is saved at most every checkpointInterval seconds (and at exit),
+# and loaded when the store is created, so a restarted Server resumes the
+# samplings that were pending when it stopped. A gateway that restarts counts
+# its samplings from 1 again: a START at or below the current index, while no
+# sampling of the device is pending, restarts its state (see restart).
+
+# An IngestJournal is a write-ahead log of the buffers the Server processes.
+# A line is appended (and flushed) at each step:
+
+#  START\t[device]\t[index]\t[start time]   (START received)
+#  BEGIN\t[device]\t[index]\t[file name]\t[1 if chunked]   (output opened)
+#  CHUNK\t[device]\t[index]\t[next seq]\t[next sample time]\t[bytes]   (chunks written)
+#  DONE\t[device]\t[index]\t[OM2M message name]   (output complete)
+#  END\t[device]\t[index]   (message deleted from OM2M)
+#  RESTART\t[device]\t[index]   (gateway restarted, at sampling 'index')
+
+# Output files are written as [file name].part and renamed once complete, so
+# a CSV file is either whole or missing. After a crash, recover() brings the
+# device states up to date from the journal and returns the samplings that
+# were in flight: the message of a DONE sampling only has to be deleted, an
+# unfinished whole buffer is processed again, to the same file name (its
+# OM2M message was not deleted), and a chunked sampling goes on from its last
+# CHUNK line (the .part file is cut back to its size then, and the chunks
+# after it are still in OM2M). Each output is thus written exactly once.
+
+# File names are [device]_[start time].csv, as before the journal, and are
+# keyed by device and index all the same: the start time of a sampling is
+# set by its first START (a repeated START does not change it) and is
+# journaled, so a sampling that is processed again gets the same name.
+
+# The journal is rewritten (atomically) with only the current indexes,
+# pending STARTs and open samplings every compactRecords lines.
+
+# Usage:
+
+#deviceStates = DeviceStateStore('C:/Users/User/XWare/logs/state.txt')
+#state = deviceStates.get(deviceName)
+#state.setStart(index,time.time())
+#...
+#deviceStates.checkpoint()
+
+# Import necessary packages
+import atexit
+import time
+import os
+
+
+# ===========================================
+# State of one device
+
+class DeviceState:
+
+    __slots__ = ('currentIndex', 'indexes', 'startTimes')
+
+    def __init__(self,ringSize=16):
+        self.currentIndex = 0
+        self.indexes = [0]*ringSize
+        self.startTimes = [0.0]*ringSize
+
+    # ===========
+    # Start times of samplings, by index
+
+    def setStart(self,index,startTime):
+        slot = index % len(self.indexes)
+        # Never overwrite a START that is still pending
+        while self.indexes[slot] > self.currentIndex and self.indexes[slot] != index:
+            self.grow()
+            slot = index % len(self.indexes)
+        self.indexes[slot] = index
+        self.startTimes[slot] = startTime
+
+    # Double the ring (until the pending start times fit in different slots),
+    # keeping the pending start times
+    def grow(self):
+        pending = self.pending()
+        ringSize = 2*len(self.indexes)
+        while len(set([index % ringSize for index, startTime in pending])) < len(pending):
+            ringSize *= 2
+        self.indexes = [0]*ringSize
+        self.startTimes = [0.0]*ringSize
+        for index, startTime in pending:
+            self.indexes[index % ringSize] = index
+            self.startTimes[index % ringSize] = startTime
+
+    def hasStart(self,index):
+        return index > 0 and self.indexes[index % len(self.indexes)] == index
+
+    def startTime(self,index):
+        slot = index % len(self.indexes)
+        if index <= 0 or self.indexes[slot] != index:
+            raise KeyError(index)
+        return self.startTimes[slot]
+
+    # Start times that are still pending, as (index, start time) pairs
+    def pending(self):
+        return sorted([(index, startTime) for index, startTime in zip(self.indexes, self.startTimes)
+                       if index > self.currentIndex])
+
+    # ===========
+    # Mark the sampling 'index' as written
+
+    def advance(self,index):
+        if index > self.currentIndex:
+            self.currentIndex = index
+
+    # ===========
+    # A START for 'index' comes from a gateway that restarted (it is not a
+    # repeated START: those are only ever pending)
+
+    def isRestart(self,index):
+        return 0 < index <= self.currentIndex and not(self.pending())
+
+    # Count the samplings from 'index' again
+    def restart(self,index):
+        self.currentIndex = index - 1
+        self.indexes = [0]*len(self.indexes)
+        self.startTimes = [0.0]*len(self.startTimes)
+
+
+# ===========================================
+# States of all devices, checkpointed to a file
+
+# fileLocation: full path of the state file ('' = not saved)
+# ringSize: pending samplings kept per device
+# checkpointInterval: minimum time between saves [s]
+
+class DeviceStateStore:
+
+    def __init__(self,fileLocation='',ringSize=16,checkpointInterval=10):
+        self.fileLocation = fileLocation
+        self.ringSize = ringSize
+        self.checkpointInterval = checkpointInterval
+        self.states = {}
+        self.lastCheckpoint = time.time()
+        if fileLocation:
+            self.load()
+            atexit.register(self.checkpoint, 1)
+
+    def __contains__(self,deviceName):
+        return deviceName in self.states
+
+    def __len__(self):
+        return len(self.states)
+
+    # State of a device (created if it is new)
+    def get(self,deviceName):
+        state = self.states.get(deviceName)
+        if state is None:
+            state = DeviceState(self.ringSize)
+            self.states[deviceName] = state
+        return state
+
+    # ===========
+    # Save the states if checkpointInterval has passed since the last save
+    # (or right away, if force is set)
+
+    def checkpoint(self,force=0):
+        if not(self.fileLocation) or not(force or time.time() - self.lastCheckpoint >= self.checkpointInterval):
+            return
+        self.lastCheckpoint = time.time()
+        lines = []
+        for deviceName, state in self.states.items():
+            pending = ','.join([str(index) + ':' + repr(startTime) for index, startTime in state.pending()])
+            lines.append(deviceName + '\t' + str(state.currentIndex) + '\t' + pending + '\n')
+        tempPath = self.fileLocation + '.tmp'
+        with open(tempPath, 'w') as file:
+            file.write(''.join(lines))
+        os.replace(tempPath, self.fileLocation)
+
+    def load(self):
+        try:
+            with open(self.fileLocation, 'r') as file:
+                lines = file.read().splitlines()
+        except OSError:
+            return
+        for line in lines:
+            items = line.split('\t')
+            if len(items) != 3:
+                continue
+            state = self.get(items[0])
+            state.currentIndex = int(items[1])
+            for item in items[2].split(','):
+                if item:
+                    index, _, startTime = item.partition(':')
+                    state.setStart(int(index), float(startTime))
+
+
+# ===========================================
+# Write-ahead journal of the samplings being processed
+
+# fileLocation: full path of the journal file ('' = not saved)
+# sync: set to 1 to fsync every line (slower, survives power cuts)
+# compactRecords: lines written between compactions
+
+class IngestJournal:
+
+    def __init__(self,fileLocation='',sync=0,compactRecords=1000):
+        self.fileLocation = fileLocation
+        self.sync = sync
+        self.compactRecords = compactRecords
+        self.records = 0
+        # (device, index): [file name, chunked, done, message name, next seq,
+        # next sample time, bytes written]
+        self.entries = {}
+        self.file = None
+        if fileLocation:
+            self.file = open(fileLocation, 'a')
+            # Finish a line that was cut by a crash
+            if self.file.tell() > 0:
+                with open(fileLocation, 'rb') as file:
+                    file.seek(-1, os.SEEK_END)
+                    if file.read(1) != b'\n':
+                        self.file.write('\n')
+
+    def write(self,*items):
+        if self.file is None:
+            return
+        self.file.write('\t'.join([str(item) for item in items]) + '\n')
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+        self.records += 1
+
+    # ===========
+    # Steps of a sampling
+
+    def start(self,deviceName,index,startTime):
+        self.write('START', deviceName, index, repr(startTime))
+
+    def begin(self,deviceName,index,fileName,chunked=0):
+        self.entries[(deviceName, index)] = [fileName, int(chunked), 0, '', 0, 0.0, 0]
+        self.write('BEGIN', deviceName, index, fileName, int(chunked))
+
+    # Chunks up to nextSeq (excluded) are in the output file, which is
+    # 'size' bytes long; currentTime is the relative time of the next sample
+    def chunk(self,deviceName,index,nextSeq,currentTime,size):
+        entry = self.entries.setdefault((deviceName, index), ['', 1, 0, '', 0, 0.0, 0])
+        entry[4:7] = [nextSeq, currentTime, size]
+        self.write('CHUNK', deviceName, index, nextSeq, repr(currentTime), size)
+
+    def done(self,deviceName,index,messageName=None):
+        entry = self.entries.setdefault((deviceName, index), ['', 0, 0, '', 0, 0.0, 0])
+        entry[2] = 1
+        entry[3] = messageName or ''
+        self.write('DONE', deviceName, index, entry[3])
+
+    def end(self,deviceName,index):
+        if self.entries.pop((deviceName, index), None) is not None:
+            self.write('END', deviceName, index)
+
+    # The gateway of a device restarted: forget its open samplings
+    def restart(self,deviceName,index):
+        for key in [key for key in self.entries if key[0] == deviceName]:
+            del self.entries[key]
+        self.write('RESTART', deviceName, index)
+
+    # End the completed samplings of a device (once their message is deleted)
+    def endDevice(self,deviceName):
+        for key in [key for key, entry in self.entries.items() if key[0] == deviceName and entry[2]]:
+            self.end(*key)
+
+    # ===========
+    # Replay the journal into the device states (a DeviceStateStore)
+    # Returns the open samplings, as (device, index, file name, chunked, done,
+    # message name, next seq, next sample time, bytes written) tuples
+
+    def recover(self,deviceStates):
+        try:
+            with open(self.fileLocation, 'r') as file:
+                lines = file.read().splitlines()
+        except (OSError, TypeError):
+            lines = []
+        for line in lines:
+            items = line.split('\t')
+            try:
+                kind, deviceName, index = items[0], items[1], int(items[2])
+            except (IndexError, ValueError):
+                # Last line cut by a crash
+                continue
+            state = deviceStates.get(deviceName)
+            if kind == 'INDEX':
+                state.advance(index)
+            elif kind == 'START' and len(items) > 3:
+                state.setStart(index, float(items[3]))
+            elif kind == 'BEGIN' and len(items) > 4:
+                self.entries[(deviceName, index)] = [items[3], int(items[4]), 0, '', 0, 0.0, 0]
+            elif kind == 'CHUNK' and len(items) > 5:
+                entry = self.entries.setdefault((deviceName, index), ['', 1, 0, '', 0, 0.0, 0])
+                entry[4:7] = [int(items[3]), float(items[4]), int(items[5])]
+            elif kind == 'DONE':
+                entry = self.entries.setdefault((deviceName, index), ['', 0, 0, '', 0, 0.0, 0])
+                entry[2] = 1
+                entry[3] = items[3] if len(items) > 3 else ''
+                state.advance(index)
+            elif kind == 'END':
+                self.entries.pop((deviceName, index), None)
+            elif kind == 'RESTART':
+                state.restart(index)
+                for key in [key for key in self.entries if key[0] == deviceName]:
+                    del self.entries[key]
+        return [(key[0], key[1]) + tuple(entry) for key, entry in sorted(self.entries.items())]
+
+    # ===========
+    # Rewrite the journal with the current state only, if compactRecords
+    # lines were written since the last time (or right away, if force is set)
+
+    def compact(self,deviceStates,force=0):
+        if self.file is None or not(force or self.records >= self.compactRecords):
+            return
+        lines = []
+        for deviceName, state in deviceStates.states.items():
+            lines.append('INDEX\t' + deviceName + '\t' + str(state.currentIndex) + '\n')
+            for index, startTime in state.pending():
+                lines.append('START\t' + deviceName + '\t' + str(index) + '\t' + repr(startTime) + '\n')
+        for (deviceName, index), (fileName, chunked, done, messageName, nextSeq, currentTime, size) in sorted(self.entries.items()):
+            lines.append('BEGIN\t' + deviceName + '\t' + str(index) + '\t' + fileName + '\t' + str(chunked) + '\n')
+            if nextSeq:
+                lines.append('CHUNK\t' + deviceName + '\t' + str(index) + '\t' + str(nextSeq) + '\t' +
+                             repr(currentTime) + '\t' + str(size) + '\n')
+            if done:
+                lines.append('DONE\t' + deviceName + '\t' + str(index) + '\t' + messageName + '\n')
+        tempPath = self.fileLocation + '.tmp'
+        with open(tempPath, 'w') as file:
+            file.write(''.join(lines))
+            file.flush()
+            os.fsync(file.fileno())
+        self.file.close()
+        os.replace(tempPath, self.fileLocation)
+        self.file = open(self.fileLocation, 'a')
+        self.records = 0
@@ -0,0 +1,171 @@
+# Chunked streaming of long samplings in XWare
+# See Github repo (github.com/d-sanchezl/xware) for license details
+
+# Instead of sending a whole sampling (t*F samples) as one message, a gateway
+# can send it as a sequence of chunks while it is still sampling. Each chunk is
+# a normal message in the 'sampling' container, with a 4-line header:
+
+#  CHUNK
+#  [sampling index, as in the START message]
+#  [chunk sequence number, starting at 0]
+#  [1 if this is the last chunk of the sampling, otherwise 0]
+
+# followed by the sample lines. The Server puts the chunks of each sampling
+# back in order with a ChunkReassembler, and can write each one to the output
+# file as soon as it is in order.
+
+# With the 'mqtt' data plane, sample data skips OM2M: gateways publish chunk
+# messages straight to a data topic of the broker, which the Server subscribes
+# to. A whole sampling is then sent as a single, final chunk.
+
+# Gateways in 'features' edge mode send, for each sampling, a feature message
+# instead of the samples (sent on the same path as chunks), with a 5-line
+# header:
+
+#  FEATURES
+#  [sampling index, as in the START message]
+#  [1 if the sampling tripped the anomaly detection, otherwise 0]
+#  [anomaly score]
+#  [feature names, comma separated]
+
+# followed by one 'offset,sensor,value,value,...' line per window and sensor,
+# where offset is the start of the window from the start of the sampling [s].
+
+# ===========================================
+# Create the text of a chunk message
+
+# index: sampling index
+# seq: chunk sequence number
+# final: 1 for the last chunk of the sampling
+# body: sample lines, as produced by formatSampleBlock()
+
+def chunkMessage(index,seq,final,body):
+    return 'CHUNK\n' + str(index) + '\n' + str(seq) + '\n' + str(int(final)) + '\n' + body
+
+
+# ===========================================
+# MQTT data topic of a device ('mqtt' data plane)
+
+# prefix: data topic prefix shared by gateways and Server, e.g. 'xware/data'
+# deviceName: OM2M name of the device, or '+' to subscribe to all devices
+
+def dataTopic(prefix,deviceName):
+    return prefix + '/' + deviceName
+
+
+# ===========================================
+# Check if a message is a chunk, and split it into its header and samples
+# Returns (index, seq, final, sampleLines)
+
+def isChunkMessage(text):
+    return text[:6] == 'CHUNK\n'
+
+def parseChunkMessage(text):
+    lines = text.splitlines()
+    return int(lines[1]), int(lines[2]), int(lines[3]), lines[4:]
+
+
+# ===========================================
+# Reassembly state of one sampling
+
+# nextSeq: sequence number of the next chunk to hand out
+# pending: chunks received ahead of their turn, by sequence number
+# context: free slot for the user (e.g. the open output file)
+# done: 1 once the final chunk has been handed out
+# readyTags: tags of the chunks handed out by the last add()
+
+class ChunkStream:
+
+    __slots__ = ('nextSeq', 'pending', 'context', 'done', 'readyTags')
+
+    def __init__(self):
+        self.nextSeq = 0
+        self.pending = {}
+        self.context = None
+        self.done = 0
+        self.readyTags = []
+
+
+# ===========================================
+# Put chunks back in order, for any number of samplings at once
+
+# Usage:
+
+#stream, ready = reassembler.add((deviceName,index),seq,final,sampleLines)
+#for sampleLines in ready:
+#    ... write sampleLines ...
+#if stream.done:
+#    reassembler.close((deviceName,index))
+
+class ChunkReassembler:
+
+    def __init__(self):
+        self.streams = {}
+
+    # ===========
+    # Add a chunk; returns its stream and the chunks that are now in order
+    # tag: anything that identifies the chunk (e.g. its OM2M message name), for
+    # the chunks that are held until the ones before them arrive
+
+    def add(self,key,seq,final,sampleLines,tag=None):
+        stream = self.streams.get(key)
+        if stream is None:
+            stream = ChunkStream()
+            self.streams[key] = stream
+        if seq >= stream.nextSeq:
+            stream.pending[seq] = (final, sampleLines, tag)
+        ready = []
+        stream.readyTags = []
+        while stream.nextSeq in stream.pending:
+            final, sampleLines, tag = stream.pending.pop(stream.nextSeq)
+            ready.append(sampleLines)
+            stream.readyTags.append(tag)
+            stream.nextSeq += 1
+            if final:
+                stream.done = 1
+        return stream, ready
+
+    def close(self,key):
+        return self.streams.pop(key, None)
+
+    # Stream of a sampling whose chunks before nextSeq were already handled
+    # (e.g. before the Server was restarted)
+    def resume(self,key,nextSeq):
+        stream = ChunkStream()
+        stream.nextSeq = nextSeq
+        self.streams[key] = stream
+        return stream
+
+
+# ===========================================
+# Create the text of a feature message ('features' edge mode)
+
+# index: sampling index
+# tripped, score: result of the anomaly detection of the sampling
+# names: list of feature names
+# rows: list of (offset, sensor tag, list of feature values)
+# precision: decimal places of the feature values
+
+def featureMessage(index,tripped,score,names,rows,precision=6):
+    valueForm = '%.' + str(precision) + 'g'
+    lines = ['FEATURES', str(index), str(int(tripped)), valueForm % score, ','.join(names)]
+    for offset, sensorTag, values in rows:
+        lines.append(repr(round(offset, 9)) + ',' + sensorTag + ',' + ','.join([valueForm % value for value in values]))
+    return '\n'.join(lines) + '\n'
+
+
+# ===========================================
+# Check if a message holds features, and split it into its parts
+# Returns (index, tripped, score, names, rows), with rows as in featureMessage()
+# (feature values are kept as text)
+
+def isFeatureMessage(text):
+    return text[:9] == 'FEATURES\n'
+
+def parseFeatureMessage(text):
+    lines = text.splitlines()
+    rows = []
+    for line in lines[5:]:
+        items = line.split(',')
+        rows.append((float(items[0]), items[1], items[2:]))
+    return int(lines[1]), int(lines[2]), float(lines[3]), lines[4].split(','), rows
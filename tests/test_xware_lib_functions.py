@@ -0,0 +1,106 @@
+# Tests of the XWare helpers (xware_lib_functions.py)
+# See Github repo (github.com/d-sanchezl/xware) for license details
+
+# Run from the repository root:
+#  python -m pytest tests
+#  python -m unittest discover tests
+
+# Import necessary packages
+import unittest
+import random
+import time
+import sys
+import io
+import os
+
+# Import xware libraries
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'libraries'))
+from xware_lib_functions import *
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class FormatSampleBlockTest(unittest.TestCase):
+
+    def testRowsOfAnySequence(self):
+        expected = '1.50,-2.00\n3.25,4.00\n'
+        self.assertEqual(formatSampleBlock([[1.5, -2], [3.25, 4]], 2), expected)
+        self.assertEqual(formatSampleBlock([(1.5, -2), (3.25, 4)], 2), expected)
+        self.assertEqual(formatSampleBlock([range(2), range(1, 3)], 1), '0.0,1.0\n1.0,2.0\n')
+
+    def testSingleSensor(self):
+        self.assertEqual(formatSampleBlock([1.5, 2], 1), '1.5\n2.0\n')
+        self.assertEqual(formatSampleBlock([1.5, 2]), '1.5\n2.0\n')
+
+    @unittest.skipIf(np is None, 'NumPy is not installed')
+    def testNumpyRows(self):
+        # 'numeric' mode: one 1D array per sample
+        samples = [np.array([1.5, -2.0]), np.array([3.25, 4.0])]
+        self.assertEqual(formatSampleBlock(samples, 2), '1.50,-2.00\n3.25,4.00\n')
+        self.assertEqual(formatSampleBlock(samples), '1.5,-2.0\n3.25,4.0\n')
+        self.assertEqual(formatSampleBlock(np.array(samples), 2), '1.50,-2.00\n3.25,4.00\n')
+        self.assertEqual(formatSampleBlock([np.float64(1.5), np.float64(2)], 1), '1.5\n2.0\n')
+
+    def testTimestamps(self):
+        self.assertEqual(formatSampleBlock(['1,2'], None, [0.5]), '0.5000000\t1,2\n')
+
+
+
+# CSV lines of a buffer as they were written before CsvFormatter, one
+# preciseUnixTime and csvFormatLine call per line. Where the fraction of a
+# second rounded up to 1, that path wrote '.000000' without carrying the
+# second; the carry is added here, as CsvFormatter writes the correct time.
+def referenceCsvBuffer(valueBuffer,startTime,currentTime,deltaTime,deviceTag,sensorTagList,valueConversion,timePrecision,valuePrecision):
+    text = ''
+    for valueStrRaw in valueBuffer:
+        tabPos = valueStrRaw.find('\t')
+        if tabPos != -1:
+            currentTime = float(valueStrRaw[:tabPos])
+            valueStrRaw = valueStrRaw[tabPos+1:]
+        second, fraction = preciseUnixTime(startTime,0,currentTime,timePrecision)
+        if fraction >= 1:
+            second, fraction = second + 1, 0.0
+        timeUnix = str(second) + format(fraction, '.'+str(timePrecision)+'f')[1:]
+        for sensorTag, valueStr in zip(sensorTagList, valueStrRaw.split(',')):
+            text += csvFormatLine(timeUnix,deviceTag,sensorTag,float(valueStr)*valueConversion,valuePrecision)
+        currentTime += deltaTime
+    return text
+
+
+class CsvFormatterTest(unittest.TestCase):
+
+    def check(self,valueBuffer,startTime,currentTime=0,deltaTime=0.001,valueConversion=1,timePrecision=6,valuePrecision=5):
+        file = io.StringIO()
+        writeCsvBuffer(file,valueBuffer,startTime,currentTime,deltaTime,'dev',['x','y'],valueConversion,timePrecision,valuePrecision)
+        expected = referenceCsvBuffer(valueBuffer,startTime,currentTime,deltaTime,'dev',['x','y'],valueConversion,timePrecision,valuePrecision)
+        self.assertEqual(file.getvalue(), expected)
+
+    def testRandomBuffers(self):
+        generator = random.Random(49)
+        for trial in range(200):
+            startTime = time.time() + generator.uniform(-1e7, 1e7)
+            valueBuffer = ['%r,%r' % (generator.uniform(-1e3, 1e3), generator.gauss(0, 1)) for sample in range(20)]
+            self.check(valueBuffer,startTime,generator.uniform(0, 10),1/generator.choice([100, 1000, 2500, 48000]),
+                       generator.choice([1, 0.5, 9.80665]),generator.choice([3, 6, 7]),generator.choice([2, 5]))
+
+    # The fraction of the start time rounds up to the next second
+    def testSubMicrosecondCarry(self):
+        self.check(['1,2', '3,4'], 1700000000.9999996)
+        self.check(['1,2'], 1700000000.9999995, 0.0000004)
+        self.check(['1,2'], 1700000000.4, 0.59999996, timePrecision=7)
+
+    # Times and values written with negative exponents
+    def testNegativeExponents(self):
+        self.check(['1e-07\t1.5e-06,-2e-05', '2.5e-05\t1e-10,3'], 1700000000.25)
+        self.check(['4.2e-06,-7e-06'], 1700000000.0, 1e-07, deltaTime=1e-06, valueConversion=1e-3)
+
+    # Capture times sent by the device replace the sample interval
+    def testCaptureTimes(self):
+        self.check(['0.0\t1,2', '0.00105\t3,4', '0.0021\t5,6'], 1700000000.123456)
+
+
+if __name__ == '__main__':
+    unittest.main()
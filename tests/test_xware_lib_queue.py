@@ -0,0 +1,124 @@
+# Tests of the gateway store-and-forward queue (xware_lib_queue.py)
+# See Github repo (github.com/d-sanchezl/xware) for license details
+
+# Run from the repository root:
+#  python -m pytest tests
+#  python -m unittest discover tests
+
+# Import necessary packages
+import tempfile
+import unittest
+import sys
+import os
+
+# Import xware libraries
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'libraries'))
+from xware_lib_queue import *
+
+
+# Size of a record with a 5-byte topic and a 100-byte payload
+recordSize = headerSize + 5 + 100
+
+
+def payload(number):
+    return ('%03d' % number) * 33 + '.'
+
+
+class DiskQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.location = os.path.join(self.folder.name, 'queue')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def segmentFiles(self):
+        return sorted([name for name in os.listdir(self.location) if name.endswith('.seg')])
+
+    # A new segment is started when the current one would exceed segmentSize,
+    # and messages are read across segments in order
+    def testSegmentRotation(self):
+        queue = DiskQueue(self.location, segmentSize=3*recordSize)
+        for number in range(10):
+            self.assertEqual(queue.append('topic', payload(number)), 1)
+        self.assertEqual(len(self.segmentFiles()), 4)
+        records = queue.peek(10)
+        self.assertEqual([record[1].decode() for record in records], [payload(number) for number in range(10)])
+        # Fully delivered segments are deleted
+        queue.ack(records[6][2])
+        self.assertEqual(len(self.segmentFiles()), 2)
+        self.assertEqual([record[1].decode() for record in queue.peek(10)], [payload(number) for number in range(7, 10)])
+        self.assertEqual(queue.diskUsage, sum([os.path.getsize(os.path.join(self.location, name)) for name in self.segmentFiles()]))
+        queue.close()
+
+    # 'drop-oldest' deletes whole segments, oldest first, to stay under maxDiskUsage
+    def testDropOldest(self):
+        queue = DiskQueue(self.location, segmentSize=2*recordSize, maxDiskUsage=6*recordSize)
+        for number in range(8):
+            self.assertEqual(queue.append('topic', payload(number)), 1)
+        self.assertLessEqual(queue.diskUsage, 6*recordSize)
+        self.assertEqual(queue.droppedMessages, 2)
+        self.assertEqual([record[1].decode() for record in queue.peek(10)], [payload(number) for number in range(2, 8)])
+        queue.close()
+
+    # 'drop-newest' rejects new messages once maxDiskUsage is reached
+    def testDropNewest(self):
+        queue = DiskQueue(self.location, segmentSize=2*recordSize, maxDiskUsage=6*recordSize,
+                          evictionPolicy='drop-newest')
+        stored = [queue.append('topic', payload(number)) for number in range(8)]
+        self.assertEqual(stored, [1]*6 + [0]*2)
+        self.assertEqual(queue.droppedMessages, 2)
+        self.assertEqual([record[1].decode() for record in queue.peek(10)], [payload(number) for number in range(6)])
+        queue.close()
+
+    # Delivered messages stay delivered after the queue is opened again
+    def testAckPersistsAcrossReopen(self):
+        queue = DiskQueue(self.location, segmentSize=3*recordSize)
+        for number in range(5):
+            queue.append('topic', payload(number))
+        records = queue.peek(2)
+        queue.ack(records[-1][2])
+        queue.close()
+        queue = DiskQueue(self.location, segmentSize=3*recordSize)
+        self.assertEqual([record[1].decode() for record in queue.peek(10)], [payload(number) for number in range(2, 5)])
+        queue.ack(queue.peek(3)[-1][2])
+        self.assertFalse(queue.hasPending())
+        queue.close()
+        queue = DiskQueue(self.location, segmentSize=3*recordSize)
+        self.assertEqual(queue.peek(10), [])
+        queue.close()
+
+    # A record cut by a crash is removed, and new messages are appended after
+    # the last whole one
+    def testTruncatedTailRepair(self):
+        queue = DiskQueue(self.location)
+        for number in range(3):
+            queue.append('topic', payload(number))
+        queue.close()
+        path = os.path.join(self.location, self.segmentFiles()[-1])
+        with open(path, 'r+b') as file:
+            file.truncate(3*recordSize - 10)
+        queue = DiskQueue(self.location)
+        self.assertEqual(os.path.getsize(path), 2*recordSize)
+        queue.append('topic', payload(3))
+        self.assertEqual([record[1].decode() for record in queue.peek(10)], [payload(0), payload(1), payload(3)])
+        queue.close()
+
+    # A record with a bad CRC ends the readable data the same way
+    def testCorruptTailRepair(self):
+        queue = DiskQueue(self.location)
+        for number in range(2):
+            queue.append('topic', payload(number))
+        queue.close()
+        path = os.path.join(self.location, self.segmentFiles()[-1])
+        with open(path, 'r+b') as file:
+            file.seek(2*recordSize - 1)
+            file.write(b'!')
+        queue = DiskQueue(self.location)
+        self.assertEqual([record[1].decode() for record in queue.peek(10)], [payload(0)])
+        queue.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# Tests of the Server device state (xware_lib_state.py)
+# See Github repo (github.com/d-sanchezl/xware) for license details
+
+# Run from the repository root:
+#  python -m pytest tests
+#  python -m unittest discover tests
+
+# Import necessary packages
+import tempfile
+import unittest
+import sys
+import os
+
+# Import xware libraries
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'libraries'))
+from xware_lib_state import *
+
+
+class DeviceStateTest(unittest.TestCase):
+
+    # More STARTs than ringSize arrive before any sampling is written
+    def testQueuedStartsOverRingSize(self):
+        state = DeviceState(16)
+        for index in range(1, 41):
+            state.setStart(index, 1000.0 + index)
+        for index in range(1, 41):
+            self.assertTrue(state.hasStart(index))
+            self.assertEqual(state.startTime(index), 1000.0 + index)
+        self.assertEqual([index for index, startTime in state.pending()], list(range(1, 41)))
+        # The samplings are written one after the other
+        for index in range(1, 41):
+            self.assertTrue(state.hasStart(state.currentIndex+1))
+            state.advance(index)
+        self.assertEqual(state.pending(), [])
+
+    # Written samplings are overwritten without growing the ring
+    def testRingDoesNotGrowWhenCaughtUp(self):
+        state = DeviceState(4)
+        for index in range(1, 101):
+            state.setStart(index, float(index))
+            state.advance(index)
+        self.assertEqual(len(state.indexes), 4)
+
+    # A gateway restarts after 50 samplings and sends START 1 again
+    def testGatewayRestart(self):
+        state = DeviceState(16)
+        for index in range(1, 51):
+            state.setStart(index, float(index))
+            state.advance(index)
+        self.assertTrue(state.isRestart(1))
+        state.restart(1)
+        state.setStart(1, 100.0)
+        self.assertTrue(state.hasStart(state.currentIndex+1))
+        self.assertEqual(state.startTime(1), 100.0)
+        # A repeated START of a pending sampling is not a restart
+        self.assertFalse(state.isRestart(1))
+        state.advance(1)
+        self.assertFalse(state.isRestart(2))
+
+    def testCheckpointKeepsQueuedStarts(self):
+        with tempfile.TemporaryDirectory() as folder:
+            fileLocation = os.path.join(folder, 'state.txt')
+            store = DeviceStateStore(fileLocation, 16)
+            state = store.get('motor_1')
+            for index in range(1, 21):
+                state.setStart(index, 1000.0 + index)
+            state.advance(2)
+            store.checkpoint(1)
+            loadedStore = DeviceStateStore(fileLocation, 16)
+            loaded = loadedStore.get('motor_1')
+            self.assertEqual(loaded.currentIndex, 2)
+            self.assertEqual(loaded.pending(), state.pending())
+            # (no saves at exit, the folder is removed)
+            store.fileLocation = loadedStore.fileLocation = ''
+
+
+class IngestJournalTest(unittest.TestCase):
+
+    # A chunked sampling cut by a restart goes on from its last CHUNK line,
+    # also after the journal is compacted
+    def testChunkProgressIsRecovered(self):
+        with tempfile.TemporaryDirectory() as folder:
+            fileLocation = os.path.join(folder, 'journal.txt')
+            journal = IngestJournal(fileLocation)
+            journal.start('motor_1', 1, 1000.5)
+            journal.begin('motor_1', 1, 'motor_1_1.csv', 1)
+            journal.chunk('motor_1', 1, 1, 0.1, 120)
+            journal.chunk('motor_1', 1, 2, 0.2, 240)
+            journal.file.close()
+            states = DeviceStateStore()
+            recovered = IngestJournal(fileLocation)
+            expected = [('motor_1', 1, 'motor_1_1.csv', 1, 0, '', 2, 0.2, 240)]
+            self.assertEqual(recovered.recover(states), expected)
+            self.assertEqual(states.get('motor_1').startTime(1), 1000.5)
+            recovered.compact(states, 1)
+            recovered.file.close()
+            self.assertEqual(IngestJournal(fileLocation).recover(DeviceStateStore()), expected)
+
+    # The restart is replayed after a crash, even if the state file is older
+    def testRestartIsRecovered(self):
+        with tempfile.TemporaryDirectory() as folder:
+            fileLocation = os.path.join(folder, 'journal.txt')
+            journal = IngestJournal(fileLocation)
+            for index in range(1, 51):
+                journal.start('motor_1', index, float(index))
+                journal.begin('motor_1', index, 'motor_1_' + str(index) + '.csv')
+                journal.done('motor_1', index, 'cin_' + str(index))
+            journal.restart('motor_1', 1)
+            journal.start('motor_1', 1, 100.0)
+            journal.file.close()
+            states = DeviceStateStore()
+            states.get('motor_1').currentIndex = 50
+            self.assertEqual(IngestJournal(fileLocation).recover(states), [])
+            state = states.get('motor_1')
+            self.assertEqual(state.currentIndex, 0)
+            self.assertEqual(state.pending(), [(1, 100.0)])
+
+
+if __name__ == '__main__':
+    unittest.main()